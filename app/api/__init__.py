@@ -7,6 +7,7 @@ from .tags_res import tags_router
 from .match_res import match_router
 from .auth.decode_res import decode_router
 from .upload_res import upload_router
+from .connection.media_res import media_router
 api_router = APIRouter()
 # 注册所有子路由
 api_router.include_router(auth_router)
@@ -16,4 +17,5 @@ api_router.include_router(user_router)
 api_router.include_router(match_router)
 api_router.include_router(comment_router)
 api_router.include_router(post_router)
-api_router.include_router(tags_router)
\ No newline at end of file
+api_router.include_router(tags_router)
+api_router.include_router(media_router)
\ No newline at end of file
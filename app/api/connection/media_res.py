@@ -1,6 +1,10 @@
+import json
 from fastapi import APIRouter,Depends,HTTPException,Request
 from app.config import settings
 from app.models.post_model import PostVideo,PostAudio,PostImage
+from app.models.media_pipeline_model import MediaPipeline
+from app.tasks import media_pipeline, media_preview
+from app.services import oss_upload
 from app.models.base import get_async_db
 from sqlalchemy.ext.asyncio import AsyncSession
 from app.core.security import hash_password,get_current_user, get_admin_user
@@ -14,9 +18,13 @@ media_router = APIRouter(prefix="/media", tags=["Media"])
 返回:
 {
 	"mc":"asdfasdfasdfasdfasdf"
+	"mf":"AQPQAQ..."
 	"ms":"proxy.sanaoll.com"
 	"du":"http://127.0.0.1:1992/mbticompass/decode/"
 	"h":1
+	"r":["360p","540p","720p"]
+	"ri":[{"l":"360p","b":912000,"res":"640x360","c":"avc1.640028,mp4a.40.2"}, ...]
+	"pv":{"poster":"/v1/pv/2503/xxxx/poster.jpg","vtt":"/v1/pv/2503/xxxx/thumbs.vtt"}
 }
 '''
 @media_router.get("/vod/{v_id}")
@@ -33,16 +41,51 @@ async def get_video_media_with_id(
 
         _resp = {
             "mc": video.media_code,  # 假设 media_code 是视频的唯一标识
+            "mf": video.media_manifest,  # 二进制清单（含每片时长、分段拼接的不连续点），旧数据为 None 时客户端回退到 mc
             "ms": settings.MEDIA_SERVER,
             "du": settings.MEDIA_DECODER_SERVER,
-            "h": video.definition #是否支持高清
+            "h": video.definition, #是否支持高清
+            "r": video.renditions.split(",") if video.renditions else [], #码率阶梯（从低到高），播放器据此自适应切换
+            # 各档峰值码率（bit/s）/ 分辨率 / CODECS，对应 master 播放列表的 EXT-X-STREAM-INF 属性，旧数据为空列表
+            "ri": json.loads(video.rendition_info) if video.rendition_info else [],
+            "pv": {  # 封面与进度条缩略图轨（雪碧图路径相对于 vtt 文件）
+                "poster": oss_upload.preview_object_key(f"{video.preview}{media_preview.POSTER_NAME}"),
+                "vtt": oss_upload.preview_object_key(f"{video.preview}{media_preview.VTT_NAME}"),
+            } if video.preview else None
         }
         return _resp
 
-@media_router.post("/vcl")
-def get_voice_media():
-    pass
+async def load_pipeline(db: AsyncSession, post_id: int, current_user: User) -> MediaPipeline:
+    result = await db.execute(select(MediaPipeline).where(MediaPipeline.post_id == post_id))
+    pipeline = result.scalars().first()
+    if not pipeline:
+        raise HTTPException(status_code=404, detail="Pipeline not found")
+    if pipeline.user_id != current_user.id and current_user.role != UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail="无权限查看此帖子的处理进度")
+    return pipeline
 
-@media_router.post("/img")
-def get_img_media():
-    pass
+@media_router.get("/pipeline/{post_id}")
+async def get_media_pipeline(
+    post_id: int,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: User = Depends(get_current_user)
+):
+    """ 查询帖子的媒体处理流水线：最后完成的阶段、各清晰度状态、产物、重试次数、最近错误 """
+    async with db:
+        pipeline = await load_pipeline(db, post_id, current_user)
+        return media_pipeline.to_dict(pipeline)
+
+@media_router.post("/pipeline/{post_id}/resume")
+async def resume_media_pipeline(
+    post_id: int,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: User = Depends(get_current_user)
+):
+    """ 从最后完成的阶段继续处理（已完成的清晰度 / 已上传的分片不会重复处理） """
+    async with db:
+        pipeline = await load_pipeline(db, post_id, current_user)
+        # 运行中的流水线只允许管理员强制继续（进程崩溃后状态会停留在 running）
+        if pipeline.status == "running" and current_user.role != UserRole.ADMIN:
+            raise HTTPException(status_code=409, detail="流水线正在运行")
+        media_pipeline.resume_pipeline.send(post_id)
+        return {"post_id": post_id, "stage": pipeline.stage, "status": "resuming"}
@@ -1,17 +1,42 @@
 import os
+import time
 import datetime
-from fastapi import APIRouter, Depends, UploadFile, File, Form, HTTPException
+from fastapi import APIRouter, Depends, UploadFile, File, Form, HTTPException, Request
 from fastapi.responses import JSONResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.routing import APIRoute
 from sqlalchemy.ext.asyncio import AsyncSession
 from app.models.base import get_async_db
 from app.models.user_model import User
 from app.core.security import get_current_user
 from app.config import settings
-from app.models.post_model import Post
+from app.models.post_model import Post, PostVideo, MediaCollectionItem
+from app.models.media_pipeline_model import MediaPipeline
+from sqlalchemy.future import select
 from app.core.logger import log_event
+from app.services import upload_session, upload_admission, oss_upload
+from app.tasks.process_convert_2_ts import segment_video
+from app.tasks import media_lifecycle
+from app.tasks.process_m3u8_crypto import parse_filename
+from app.utils.checksum import ChunkChecksum
 from pydantic import BaseModel
 
-upload_router = APIRouter(prefix="/upload", tags=["File Uploads"])
+class TimedUploadRoute(APIRoute):
+    """
+    在读取请求体之前记录请求到达时间（request.state.received_at）：
+    multipart 分片在进入接口函数前已被完整读入，接口内计时不包含网络传输
+    """
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def timed_handler(request: Request):
+            request.state.received_at = time.monotonic()
+            return await handler(request)
+
+        return timed_handler
+
+upload_router = APIRouter(prefix="/upload", tags=["File Uploads"], route_class=TimedUploadRoute)
 
 def get_upload_dir(subfolder: str):
     now = datetime.datetime.now()
@@ -20,31 +45,157 @@ def get_upload_dir(subfolder: str):
     os.makedirs(upload_path, exist_ok=True)
     return upload_path
 
+# 流式分片上传：媒体类型 -> (子目录, 允许的后缀, 中文名)
+STREAM_MEDIA_TYPES = {
+    "video": ("vods", (".mp4",), "视频"),
+    "audio": ("vocs", (".m4a",), "音频"),
+    "image": ("imgs", (".jpg", ".jpeg", ".png"), "图片"),
+}
+
+# 流式写盘时的缓冲大小，攒够后一次 pwrite，避免每个网络小包都切一次线程
+STREAM_WRITE_BUFFER = 1024 * 1024
+
+async def write_stream_at(request: Request, file_path: str, offset: int, limit: int,
+                          checksum: ChunkChecksum = None) -> int:
+    """
+    将请求体直接流式写入预分配文件的 offset 处（不经过 multipart / 临时文件）
+    磁盘写入放到线程池执行，不阻塞事件循环；传入 checksum 时边写边计算校验和
+    :return: 实际写入的字节数
+    """
+    fd = await run_in_threadpool(upload_session.file_handles.acquire, file_path)
+    written = 0
+    buffer = bytearray()
+    try:
+        async for piece in request.stream():
+            if not piece:
+                continue
+            if written + len(buffer) + len(piece) > limit:
+                raise HTTPException(status_code=413, detail="分片大小超出限制")
+            if checksum is not None:
+                checksum.update(piece)
+            buffer += piece
+            if len(buffer) >= STREAM_WRITE_BUFFER:
+                await run_in_threadpool(os.pwrite, fd, bytes(buffer), offset + written)
+                written += len(buffer)
+                buffer.clear()
+        if buffer:
+            await run_in_threadpool(os.pwrite, fd, bytes(buffer), offset + written)
+            written += len(buffer)
+    finally:
+        upload_session.file_handles.release(file_path)
+    return written
+
+def load_session(filename: str, media_type: str, current_user: User, cached: bool = True) -> dict:
+    """
+    读取上传会话并校验归属与类型
+    分片请求走进程内注册表（cached=True）；需要最新状态（完成、去重）时直接读 Redis
+    """
+    if cached:
+        session = upload_session.session_registry.get(filename)
+    else:
+        session = upload_session.get_session(filename)
+    label = STREAM_MEDIA_TYPES[media_type][2]
+    if not session or session["media_type"] != media_type:
+        raise HTTPException(status_code=400, detail=f"{label}文件未初始化")
+    if session["user_id"] != current_user.id:
+        raise HTTPException(status_code=403, detail="无权限操作此上传")
+    return session
+
+def make_checksum(spec: str):
+    """ 解析客户端提供的分片校验和，未提供时返回 None """
+    if not spec:
+        return None
+    try:
+        return ChunkChecksum(spec)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def verify_checksum(checksum: ChunkChecksum, chunk_index: int):
+    if checksum is not None and not checksum.matches():
+        log_event("upload", f"❌ 分片校验失败 chunk={chunk_index} {checksum.algo}={checksum.hexdigest()}", "warning")
+        raise HTTPException(status_code=422, detail=f"分片 {chunk_index} 校验失败，请重传")
+
+def check_chunk_index(session: dict, chunk_index: int):
+    if session.get("storage") == "cos":
+        raise HTTPException(status_code=400, detail="直传模式请使用预签名 URL 上传分片")
+    if chunk_index < 0 or chunk_index >= session["total_chunks"]:
+        raise HTTPException(status_code=400, detail="分片序号超出文件范围")
+
+def check_total_chunks(session: dict, total_chunks: int):
+    """ 客户端的分片数与会话协商的不一致：说明仍按旧的全局分片大小切分，写入偏移会错位 """
+    if total_chunks != session["total_chunks"]:
+        raise HTTPException(status_code=409, detail=f"分片数与上传会话不一致: {total_chunks}/{session['total_chunks']}，"
+                                                    f"请按 chunk_size={session['chunk_size']} 切分")
+
+def expected_chunk_size(session: dict, chunk_index: int) -> int:
+    """ 分片应有的字节数：最后一片为剩余大小，其余为协商的 chunk_size """
+    return min(session["chunk_size"], session["total_size"] - chunk_index * session["chunk_size"])
+
+def check_chunk_size(session: dict, chunk_index: int, size: int):
+    expected = expected_chunk_size(session, chunk_index)
+    if size != expected:
+        raise HTTPException(status_code=400, detail=f"分片大小不正确: {size}/{expected}")
+
 def generate_filename(user_id: int, post_id: int, collection_code: str, suffix: str) -> str:
     now = datetime.datetime.now()
     timestamp = now.strftime('%y%m%d%H')
     return f"u{user_id}_{timestamp}_{post_id}_{collection_code}.{suffix}"
 
+async def start_direct_video_upload(total_size: int, collection_code: str, db: AsyncSession, current_user: User):
+    """
+    ✅ 直传模式：在对象存储上创建分片上传并返回每个分片的预签名 URL，
+    客户端直接把分片 PUT 到对象存储，API 不经手文件数据；分片号 = chunk_index + 1
+    """
+    new_post = Post(user_id=current_user.id, post_type="video", created_at=datetime.datetime.now())
+    db.add(new_post)
+    await db.flush()
+
+    filename = generate_filename(current_user.id, new_post.id, collection_code, "mp4")
+    object_key = oss_upload.raw_object_key("vods", datetime.datetime.now().strftime('%y%m'), filename)
+    chunk_size = upload_session.choose_chunk_size("video", total_size, current_user.id)
+    part_size = oss_upload.choose_part_size(total_size, chunk_size)
+    upload_id = await run_in_threadpool(oss_upload.create_multipart_upload, object_key)
+    session = upload_session.create_session(filename, "", "video", current_user.id, new_post.id,
+                                            total_size, part_size, storage="cos",
+                                            object_key=object_key, upload_id=upload_id)
+    parts = await run_in_threadpool(oss_upload.presign_part_urls, object_key, upload_id,
+                                    range(1, session["total_chunks"] + 1))
+
+    await db.commit()
+    return {"message": "视频直传初始化成功", "post_id": new_post.id, "filename": filename, "mode": "direct",
+            "chunk_size": part_size, "total_chunks": session["total_chunks"], "parts": parts}
+
 @upload_router.post("/start/video")
 async def start_video_upload(
     total_size: int = Form(...),
     collection_code: str = Form("0000"),
+    mode: str = Form("local"),
     db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_user)
 ):
-    log_event("upload", f"🎬 初始化视频上传 user={current_user.id}, size={total_size}, code={collection_code}")
+    log_event("upload", f"🎬 初始化视频上传 user={current_user.id}, size={total_size}, code={collection_code}, mode={mode}")
+    if total_size <= 0:
+        raise HTTPException(status_code=400, detail="文件大小无效")
+    if mode == "direct":
+        return await start_direct_video_upload(total_size, collection_code, db, current_user)
+    if mode != "local":
+        raise HTTPException(status_code=400, detail="上传模式仅支持 local / direct")
     upload_dir = get_upload_dir("vods")
+    upload_admission.check_disk_capacity(upload_dir, total_size)
     new_post = Post(user_id=current_user.id, post_type="video", created_at=datetime.datetime.now())
     db.add(new_post)
     await db.flush()
 
     filename = generate_filename(current_user.id, new_post.id, collection_code, "mp4")
     file_path = os.path.join(upload_dir, filename)
-    with open(file_path, "wb") as f:
-        f.truncate(total_size)
+    await run_in_threadpool(upload_session.preallocate, file_path, total_size)
+    chunk_size = upload_session.choose_chunk_size("video", total_size, current_user.id)
+    session = upload_session.create_session(filename, file_path, "video", current_user.id, new_post.id,
+                                            total_size, chunk_size)
 
     await db.commit()
-    return {"message": "视频上传初始化成功", "post_id": new_post.id, "filename": filename, "file_path": file_path}
+    return {"message": "视频上传初始化成功", "post_id": new_post.id, "filename": filename, "file_path": file_path,
+            "chunk_size": chunk_size, "total_chunks": session["total_chunks"]}
 
 @upload_router.post("/start/audio")
 async def start_audio_upload(
@@ -54,18 +205,24 @@ async def start_audio_upload(
     current_user: User = Depends(get_current_user)
 ):
     log_event("upload", f"🎧 初始化音频上传 user={current_user.id}, size={total_size}, code={collection_code}")
+    if total_size <= 0:
+        raise HTTPException(status_code=400, detail="文件大小无效")
     upload_dir = get_upload_dir("vocs")
+    upload_admission.check_disk_capacity(upload_dir, total_size)
     new_post = Post(user_id=current_user.id, post_type="audio", created_at=datetime.datetime.now())
     db.add(new_post)
     await db.flush()
 
     filename = generate_filename(current_user.id, new_post.id, collection_code, "m4a")
     file_path = os.path.join(upload_dir, filename)
-    with open(file_path, "wb") as f:
-        f.truncate(total_size)
+    await run_in_threadpool(upload_session.preallocate, file_path, total_size)
+    chunk_size = upload_session.choose_chunk_size("audio", total_size, current_user.id)
+    session = upload_session.create_session(filename, file_path, "audio", current_user.id, new_post.id,
+                                            total_size, chunk_size)
 
     await db.commit()
-    return {"message": "音频上传初始化成功", "post_id": new_post.id, "filename": filename, "file_path": file_path}
+    return {"message": "音频上传初始化成功", "post_id": new_post.id, "filename": filename, "file_path": file_path,
+            "chunk_size": chunk_size, "total_chunks": session["total_chunks"]}
 
 @upload_router.post("/start/image")
 async def start_image_upload(
@@ -75,124 +232,328 @@ async def start_image_upload(
     current_user: User = Depends(get_current_user)
 ):
     log_event("upload", f"🖼️ 初始化图片上传 user={current_user.id}, size={total_size}, code={collection_code}")
+    if total_size <= 0:
+        raise HTTPException(status_code=400, detail="文件大小无效")
     upload_dir = get_upload_dir("imgs")
+    upload_admission.check_disk_capacity(upload_dir, total_size)
     new_post = Post(user_id=current_user.id, post_type="image", created_at=datetime.datetime.now())
     db.add(new_post)
     await db.flush()
 
     filename = generate_filename(current_user.id, new_post.id, collection_code, "jpg")
     file_path = os.path.join(upload_dir, filename)
-    with open(file_path, "wb") as f:
-        f.truncate(total_size)
+    await run_in_threadpool(upload_session.preallocate, file_path, total_size)
+    chunk_size = upload_session.choose_chunk_size("image", total_size, current_user.id)
+    session = upload_session.create_session(filename, file_path, "image", current_user.id, new_post.id,
+                                            total_size, chunk_size)
 
     await db.commit()
-    return {"message": "图片上传初始化成功", "post_id": new_post.id, "filename": filename, "file_path": file_path}
+    return {"message": "图片上传初始化成功", "post_id": new_post.id, "filename": filename, "file_path": file_path,
+            "chunk_size": chunk_size, "total_chunks": session["total_chunks"]}
 
 @upload_router.post("/chunk/video")
 async def upload_video_chunk(
+    request: Request,
     filename: str = Form(...),
     chunk_index: int = Form(...),
     total_chunks: int = Form(...),
     file: UploadFile = File(...),
+    checksum: str = Form(None),
     current_user: User = Depends(get_current_user)
 ):
+    # 请求体接收耗时（含网络传输），作为该客户端的吞吐样本
+    elapsed = time.monotonic() - request.state.received_at
     valid_types = ["video/mp4"]
     if file.content_type not in valid_types and not filename.lower().endswith(".mp4"):
         raise HTTPException(status_code=400, detail="视频格式仅支持 mp4")
     log_event("upload", f"📦 上传视频分片: {filename} chunk={chunk_index}/{total_chunks}")
-    upload_dir = get_upload_dir("vods")
-    file_path = os.path.join(upload_dir, filename)
-    if not os.path.exists(file_path):
-        raise HTTPException(status_code=400, detail="视频文件未初始化")
+    session = load_session(filename, "video", current_user)
+    check_chunk_index(session, chunk_index)
+    check_total_chunks(session, total_chunks)
+    file_path = session["file_path"]
+    chunk_checksum = make_checksum(checksum)
+
+    async with upload_admission.chunk_slot(current_user.id):
+        data = await file.read()
+        check_chunk_size(session, chunk_index, len(data))
+        upload_session.record_throughput(current_user.id, len(data), elapsed)
+        if chunk_checksum is not None:
+            chunk_checksum.update(data)
+            verify_checksum(chunk_checksum, chunk_index)
 
-    offset = chunk_index * settings.CHUNK_SIZE
-    with open(file_path, "r+b") as f:
-        f.seek(offset)
-        f.write(await file.read())
+        offset = chunk_index * session["chunk_size"]
+        await run_in_threadpool(upload_session.write_at, file_path, offset, data)
+        upload_session.mark_chunk(filename, chunk_index)
+    await run_in_threadpool(upload_session.advance_hash, session)
 
     return {"message": f"视频分片 {chunk_index}/{total_chunks} 上传成功"}
 
 @upload_router.post("/chunk/audio")
 async def upload_audio_chunk(
+    request: Request,
     filename: str = Form(...),
     chunk_index: int = Form(...),
     total_chunks: int = Form(...),
     file: UploadFile = File(...),
+    checksum: str = Form(None),
     current_user: User = Depends(get_current_user)
 ):
+    # 请求体接收耗时（含网络传输），作为该客户端的吞吐样本
+    elapsed = time.monotonic() - request.state.received_at
     if not filename.lower().endswith(".m4a"):
         raise HTTPException(status_code=400, detail="音频格式仅支持 m4a")
     log_event("upload", f"📦 上传音频分片: {filename} chunk={chunk_index}/{total_chunks}")
-    upload_dir = get_upload_dir("vocs")
-    file_path = os.path.join(upload_dir, filename)
-    if not os.path.exists(file_path):
-        raise HTTPException(status_code=400, detail="音频文件未初始化")
+    session = load_session(filename, "audio", current_user)
+    check_chunk_index(session, chunk_index)
+    check_total_chunks(session, total_chunks)
+    file_path = session["file_path"]
+    chunk_checksum = make_checksum(checksum)
+
+    async with upload_admission.chunk_slot(current_user.id):
+        data = await file.read()
+        check_chunk_size(session, chunk_index, len(data))
+        upload_session.record_throughput(current_user.id, len(data), elapsed)
+        if chunk_checksum is not None:
+            chunk_checksum.update(data)
+            verify_checksum(chunk_checksum, chunk_index)
 
-    offset = chunk_index * settings.CHUNK_SIZE
-    with open(file_path, "r+b") as f:
-        f.seek(offset)
-        f.write(await file.read())
+        offset = chunk_index * session["chunk_size"]
+        await run_in_threadpool(upload_session.write_at, file_path, offset, data)
+        upload_session.mark_chunk(filename, chunk_index)
+    await run_in_threadpool(upload_session.advance_hash, session)
 
     return {"message": f"音频分片 {chunk_index}/{total_chunks} 上传成功"}
 
 @upload_router.post("/chunk/image")
 async def upload_image_chunk(
+    request: Request,
     filename: str = Form(...),
     chunk_index: int = Form(...),
     total_chunks: int = Form(...),
     file: UploadFile = File(...),
+    checksum: str = Form(None),
     current_user: User = Depends(get_current_user)
 ):
+    # 请求体接收耗时（含网络传输），作为该客户端的吞吐样本
+    elapsed = time.monotonic() - request.state.received_at
     if not filename.lower().endswith((".jpg", ".jpeg", ".png")):
         raise HTTPException(status_code=400, detail="图片格式仅支持 jpg/jpeg/png")
     log_event("upload", f"📦 上传图片分片: {filename} chunk={chunk_index}/{total_chunks}")
-    upload_dir = get_upload_dir("imgs")
-    file_path = os.path.join(upload_dir, filename)
-    if not os.path.exists(file_path):
-        raise HTTPException(status_code=400, detail="图片文件未初始化")
+    session = load_session(filename, "image", current_user)
+    check_chunk_index(session, chunk_index)
+    check_total_chunks(session, total_chunks)
+    file_path = session["file_path"]
+    chunk_checksum = make_checksum(checksum)
 
-    offset = chunk_index * settings.CHUNK_SIZE
-    with open(file_path, "r+b") as f:
-        f.seek(offset)
-        f.write(await file.read())
+    async with upload_admission.chunk_slot(current_user.id):
+        data = await file.read()
+        check_chunk_size(session, chunk_index, len(data))
+        upload_session.record_throughput(current_user.id, len(data), elapsed)
+        if chunk_checksum is not None:
+            chunk_checksum.update(data)
+            verify_checksum(chunk_checksum, chunk_index)
+
+        offset = chunk_index * session["chunk_size"]
+        await run_in_threadpool(upload_session.write_at, file_path, offset, data)
+        upload_session.mark_chunk(filename, chunk_index)
+    await run_in_threadpool(upload_session.advance_hash, session)
 
     return {"message": f"图片分片 {chunk_index}/{total_chunks} 上传成功"}
 
+@upload_router.put("/stream/{media_type}/{filename}/{chunk_index}")
+async def upload_chunk_stream(
+    media_type: str,
+    filename: str,
+    chunk_index: int,
+    request: Request,
+    current_user: User = Depends(get_current_user)
+):
+    """
+    ✅ 原始请求体分片上传（Content-Type: application/octet-stream）
+    请求体直接写入预分配文件的 chunk_index * chunk_size 处，不在内存中缓存整个分片
+    """
+    if media_type not in STREAM_MEDIA_TYPES:
+        raise HTTPException(status_code=404, detail="不支持的媒体类型")
+    subfolder, suffixes, label = STREAM_MEDIA_TYPES[media_type]
+    if not filename.lower().endswith(suffixes):
+        raise HTTPException(status_code=400, detail=f"{label}格式仅支持 {'/'.join(s.lstrip('.') for s in suffixes)}")
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+    if content_type != "application/octet-stream":
+        raise HTTPException(status_code=415, detail="分片请求体必须为 application/octet-stream")
+
+    session = load_session(filename, media_type, current_user)
+    check_chunk_index(session, chunk_index)
+    file_path = session["file_path"]
+    chunk_checksum = make_checksum(request.headers.get("x-chunk-checksum"))
+
+    offset = chunk_index * session["chunk_size"]
+    limit = expected_chunk_size(session, chunk_index)
+
+    log_event("upload", f"📦 流式上传{label}分片: {filename} chunk={chunk_index}")
+    async with upload_admission.chunk_slot(current_user.id):
+        started = time.monotonic()
+        try:
+            written = await write_stream_at(request, file_path, offset, limit, chunk_checksum)
+            # 流式接收的耗时包含网络传输，作为该客户端的吞吐样本
+            upload_session.record_throughput(current_user.id, written, time.monotonic() - started)
+            if written != limit:
+                raise HTTPException(status_code=400, detail=f"分片大小不完整: {written}/{limit}")
+            verify_checksum(chunk_checksum, chunk_index)
+        except BaseException:
+            # 边收边写，失败时磁盘上的该分片已不可信（可能覆盖了之前收到的正确数据），必须重传
+            upload_session.invalidate_chunk(filename, chunk_index)
+            raise
+        upload_session.mark_chunk(filename, chunk_index)
+    await run_in_threadpool(upload_session.advance_hash, session)
+    return {"message": f"{label}分片 {chunk_index} 上传成功", "size": written}
+
+@upload_router.get("/{filename}/status")
+async def get_upload_status(
+    filename: str,
+    current_user: User = Depends(get_current_user)
+):
+    """ ✅ 查询上传进度，返回缺失的分片区间，客户端只需重传缺失部分 """
+    session = upload_session.get_session(filename)
+    if not session:
+        raise HTTPException(status_code=404, detail="上传会话不存在或已过期")
+    if session["user_id"] != current_user.id:
+        raise HTTPException(status_code=403, detail="无权限操作此上传")
+    if session.get("storage") == "cos":
+        parts = await run_in_threadpool(oss_upload.list_uploaded_parts, session["object_key"], session["upload_id"])
+        missing = upload_session.collect_missing(session["total_chunks"], lambda index: index + 1 in parts)
+        received = len(parts)
+    else:
+        missing = upload_session.missing_ranges(session)
+        received = upload_session.received_count(filename)
+    return {
+        "filename": filename,
+        "status": session["status"],
+        "total_size": session["total_size"],
+        "chunk_size": session["chunk_size"],
+        "total_chunks": session["total_chunks"],
+        "received": received,
+        "missing": [[start, end] for start, end in missing],
+        "complete": not missing,
+    }
+
 class CompleteUploadBody(BaseModel):
     filename: str
 
+async def finish_session(filename: str, media_type: str, current_user: User) -> dict:
+    """ 校验位图已满后计算整文件 SHA-256 并将会话标记为完成，未收齐时拒绝并返回缺失区间 """
+    session = load_session(filename, media_type, current_user, cached=False)
+    label = STREAM_MEDIA_TYPES[media_type][2]
+    if session["status"] == "complete" and session.get("sha256"):
+        return session
+    if not os.path.exists(session["file_path"]):
+        raise HTTPException(status_code=400, detail=f"{label}文件未找到")
+    if not upload_session.is_complete(session):
+        missing = upload_session.missing_ranges(session)
+        raise HTTPException(status_code=409, detail={
+            "message": f"{label}分片未全部上传",
+            "missing": [[start, end] for start, end in missing],
+        })
+    upload_session.file_handles.close(session["file_path"])
+    upload_session.session_registry.discard(filename)
+    await run_in_threadpool(upload_session.finalize_hash, session)
+    upload_session.update_session(filename, status="complete")
+    return session
+
+async def link_duplicate_media(db: AsyncSession, session: dict):
+    """
+    ✅ 秒传去重：相同内容（SHA-256）的视频已发布时，新帖子直接复用已有 media_code
+    只复用流水线已到 published 的视频（分片已全部落地 OSS），并按文件名中的合集编号写入合集条目
+    命中后在会话中记录 duplicate_of，转码任务据此跳过 segment_video / process_m3u8_file
+    （音频 / 图片不记录 content_hash，不参与去重）
+    :return: 被复用的帖子 ID，未命中返回 None
+    """
+    if session.get("duplicate_of"):
+        return int(session["duplicate_of"])
+    result = await db.execute(
+        select(PostVideo)
+        .join(MediaPipeline, MediaPipeline.post_id == PostVideo.post_id)
+        .where(PostVideo.content_hash == session["sha256"], PostVideo.media_code != "",
+               MediaPipeline.stage == "published")
+        .limit(1)
+    )
+    existing = result.scalars().first()
+    if not existing:
+        return None
+
+    db.add(PostVideo(
+        post_id=session["post_id"], media_code=existing.media_code, content_hash=session["sha256"],
+        definition=existing.definition, renditions=existing.renditions,
+        media_manifest=existing.media_manifest, preview=existing.preview, rendition_info=existing.rendition_info,
+    ))
+    parsed = parse_filename(session["filename"])
+    if parsed and parsed[3] != "0000":
+        db.add(MediaCollectionItem(collection_id=int(parsed[3]), post_id=session["post_id"], sort_order=0))
+    await db.commit()
+    upload_session.update_session(session["filename"], duplicate_of=existing.post_id)
+    log_event("upload", f"♻️ 内容重复，复用帖子 {existing.post_id} 的媒体: {session['filename']}")
+    return existing.post_id
+
+async def complete_direct_video_upload(session: dict, current_user: User):
+    """ ✅ 直传完成：确认所有分片已到达对象存储后合并对象，转码任务直接从对象存储拉流 """
+    if session["user_id"] != current_user.id:
+        raise HTTPException(status_code=403, detail="无权限操作此上传")
+    object_key = session["object_key"]
+    if session["status"] != "complete":
+        parts = await run_in_threadpool(oss_upload.list_uploaded_parts, object_key, session["upload_id"])
+        missing = upload_session.collect_missing(session["total_chunks"], lambda index: index + 1 in parts)
+        if missing:
+            raise HTTPException(status_code=409, detail={
+                "message": "视频分片未全部上传",
+                "missing": [[start, end] for start, end in missing],
+            })
+        await run_in_threadpool(oss_upload.complete_multipart_upload, object_key, session["upload_id"], parts)
+        upload_session.update_session(session["filename"], status="complete")
+        segment_video.send(session["filename"], source_key=object_key)
+    log_event("upload", f"✅ 视频直传完成: {session['filename']} -> {object_key}")
+    return {"message": "视频上传完成", "filename": session["filename"], "object_key": object_key}
+
 @upload_router.post("/complete/video")
 async def complete_video_upload(
     body: CompleteUploadBody,
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_user)
 ):
-    upload_dir = get_upload_dir("vods")
-    file_path = os.path.join(upload_dir, body.filename)
-    if not os.path.exists(file_path):
-        raise HTTPException(status_code=400, detail="视频文件未找到")
-    log_event("upload", f"✅ 视频上传完成: {body.filename}")
-    return {"message": "视频上传完成", "file_path": file_path, "filename": body.filename}
+    session = upload_session.get_session(body.filename)
+    if session and session.get("storage") == "cos":
+        return await complete_direct_video_upload(session, current_user)
+    session = await finish_session(body.filename, "video", current_user)
+    file_path = session["file_path"]
+    duplicate_of = await link_duplicate_media(db, session)
+    if duplicate_of is None:
+        # 直接投递转码，不再等待 watchdog 轮询文件大小（watchdog 仅作兜底，重复投递由流水线记录去重）
+        segment_video.send(file_path)
+    else:
+        # 秒传命中：原始文件不会再被转码，保留期后清理
+        media_lifecycle.schedule_delete([file_path])
+    log_event("upload", f"✅ 视频上传完成: {body.filename} sha256={session['sha256']}")
+    return {"message": "视频上传完成", "file_path": file_path, "filename": body.filename,
+            "sha256": session["sha256"], "duplicate_of": duplicate_of}
 
 @upload_router.post("/complete/audio")
 async def complete_audio_upload(
     body: CompleteUploadBody,
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_user)
 ):
-    upload_dir = get_upload_dir("vocs")
-    file_path = os.path.join(upload_dir, body.filename)
-    if not os.path.exists(file_path):
-        raise HTTPException(status_code=400, detail="音频文件未找到")
-    log_event("upload", f"✅ 音频上传完成: {body.filename}")
-    return {"message": "音频上传完成", "file_path": file_path, "filename": body.filename}
+    session = await finish_session(body.filename, "audio", current_user)
+    file_path = session["file_path"]
+    log_event("upload", f"✅ 音频上传完成: {body.filename} sha256={session['sha256']}")
+    return {"message": "音频上传完成", "file_path": file_path, "filename": body.filename,
+            "sha256": session["sha256"]}
 
 @upload_router.post("/complete/image")
 async def complete_image_upload(
     body: CompleteUploadBody,
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_user)
 ):
-    upload_dir = get_upload_dir("imgs")
-    file_path = os.path.join(upload_dir, body.filename)
-    if not os.path.exists(file_path):
-        raise HTTPException(status_code=400, detail="图片文件未找到")
-    log_event("upload", f"✅ 图片上传完成: {body.filename}")
-    return {"message": "图片上传完成", "file_path": file_path, "filename": body.filename}
\ No newline at end of file
+    session = await finish_session(body.filename, "image", current_user)
+    file_path = session["file_path"]
+    log_event("upload", f"✅ 图片上传完成: {body.filename} sha256={session['sha256']}")
+    return {"message": "图片上传完成", "file_path": file_path, "filename": body.filename,
+            "sha256": session["sha256"]}
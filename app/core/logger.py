@@ -1,10 +1,15 @@
 import json
 import logging
 from datetime import datetime
+from app.config import settings
 from app.db.redis_client import redis_client
 
 logger = logging.getLogger("fastapi")
 
+# 每个任务在 task_logs:<task_id> 中保留的最新日志条数与过期时间（秒），避免长任务的进度日志无限增长
+TASK_LOG_MAX_LEN = getattr(settings, "TASK_LOG_MAX_LEN", 200)
+TASK_LOG_TTL = getattr(settings, "TASK_LOG_TTL", 24 * 3600)
+
 def decode_message(message: str) -> str:
     """
     如果 message 是 JSON 字符串，则解析后重新生成，
@@ -53,7 +58,12 @@ def log_event(task_id: str, message: str, log_type: str = "info", is_task_log: b
 
     if is_task_log:
         # 推送任务日志到 Redis 队列时，也使用 ws_log
-        redis_client.lpush(f"task_logs:{task_id}", ws_log)
+        key = f"task_logs:{task_id}"
+        pipe = redis_client.pipeline()
+        pipe.lpush(key, ws_log)
+        pipe.ltrim(key, 0, TASK_LOG_MAX_LEN - 1)
+        pipe.expire(key, TASK_LOG_TTL)
+        pipe.execute()
         logging.info(console_log)
 
     # 如果不是任务日志，也通过 logger 输出原始 message
@@ -11,8 +11,8 @@ REDIS_PASSWORD = settings.REDIS_PASSWORD
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("redis")
 
-def get_redis_connection():
-    """ 获取 Redis 连接 """
+def get_redis_connection(decode_responses: bool = True):
+    """ 获取 Redis 连接（decode_responses=False 时返回原始 bytes，用于位图等二进制数据） """
     logger.info(f"redis host: {REDIS_HOST} port: {REDIS_PORT} db: {REDIS_DB}")
     try:
         redis_client = redis.Redis(
@@ -20,7 +20,7 @@ def get_redis_connection():
             port=REDIS_PORT,
             db=REDIS_DB,
             password=REDIS_PASSWORD,
-            decode_responses=True,
+            decode_responses=decode_responses,
         )
         # 测试连接
         redis_client.ping()
@@ -32,3 +32,5 @@ def get_redis_connection():
 
 # 连接 Redis
 redis_client = get_redis_connection()
+# 二进制连接（上传分片位图等）
+redis_raw_client = get_redis_connection(decode_responses=False)
@@ -9,6 +9,7 @@ from .comment_model import *
 from .callsession_model import *
 from .m2m_associations_model import *
 from .match_model import *
+from .media_pipeline_model import *
 
 class Base(DeclarativeBase):
     pass
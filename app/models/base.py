@@ -21,6 +21,17 @@ sync_engine = create_engine(
 )
 SyncSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=sync_engine)
 
+# ✅ **dramatiq worker / watchdog 专用的小连接池同步引擎（与 API 连接池隔离，不开 echo）**
+worker_engine = create_engine(
+    SYNC_DATABASE_URL,
+    pool_size=getattr(settings, "WORKER_DB_POOL_SIZE", 2),
+    max_overflow=getattr(settings, "WORKER_DB_MAX_OVERFLOW", 2),
+    pool_timeout=settings.DB_POOL_TIMEOUT,
+    pool_recycle=settings.DB_POOL_RECYCLE,
+    pool_pre_ping=settings.DB_POOL_PRE_PING
+)
+WorkerSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=worker_engine)
+
 # ✅ **异步引擎 & Session**
 async_engine = create_async_engine(
     ASYNC_DATABASE_URL,
@@ -0,0 +1,25 @@
+from sqlalchemy import Column, Integer, String, DateTime, Text, Boolean
+from datetime import datetime
+from .base import Base
+
+
+class MediaPipeline(Base):
+    """
+    每个帖子的媒体处理流水线记录：上传 → 转码 → 加密 → 发布（上传 OSS）
+    失败或进程崩溃后据此从最后完成的阶段继续，不重复转码 / 上传已完成的部分
+    """
+    __tablename__ = "media_pipelines"
+
+    id = Column(Integer, primary_key=True, index=True)
+    post_id = Column(Integer, nullable=False, unique=True, index=True)  # 帖子在转码完成后才入库，这里不加外键
+    user_id = Column(Integer, nullable=True)
+    filename = Column(String(255), nullable=False)  # 原始上传文件名，例如 u4_25032921_30_0000.mp4
+    stage = Column(String(20), nullable=False, default="uploaded")  # 最后完成的阶段：uploaded/transcoded/encrypted/published
+    status = Column(String(20), nullable=False, default="pending")  # 当前状态：pending/running/failed/done
+    renditions = Column(Text, nullable=True)  # 各清晰度状态（JSON），例如 {"720p": {"status": "encrypted", "chunks": 120}}
+    artifacts = Column(Text, nullable=True)  # 各阶段产物（JSON）：源文件路径 / 对象存储 Key、加密输出目录等
+    attempts = Column(Integer, nullable=False, default=0)  # 各阶段累计执行次数
+    last_error = Column(Text, nullable=True)
+    media_pending = Column(Boolean, nullable=False, default=False, index=True)  # 已发布、帖子 / 视频信息待批量写库
+    created_at = Column(DateTime, default=datetime.now)
+    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Text,Boolean
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Text,Boolean, UniqueConstraint
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from .base import Base
@@ -41,6 +41,7 @@ class MediaCollection(Base):
 
 class MediaCollectionItem(Base):
     __tablename__ = "media_collection_items"
+    __table_args__ = (UniqueConstraint("collection_id", "post_id", name="uq_collection_post"),)  # 批量 upsert 依赖该唯一键
     id = Column(Integer, primary_key=True, index=True)
     collection_id = Column(Integer, ForeignKey("media_collections.id"), nullable=False)
     post_id = Column(Integer, ForeignKey("posts.id"), nullable=False)
@@ -67,7 +68,12 @@ class PostVideo(Base):
     id = Column(Integer, primary_key=True, index=True)
     post_id = Column(Integer, ForeignKey("posts.id"), nullable=True, unique=True)  # 唯一约束，确保一对一
     definition = Column(Boolean, nullable=True,default=False)
+    renditions = Column(String(64), nullable=True)  # 清晰度列表，例如 "360p,540p,720p"
     media_code = Column(String(255), nullable=False)  # 视频 URL，最大 255 字符
+    preview = Column(String(64), nullable=True)  # 封面 / 雪碧图 / 缩略图轨所在目录，例如 "2503/<chunk_code>/"
+    rendition_info = Column(Text, nullable=True)  # 各清晰度峰值码率 / 分辨率 / CODECS（JSON），客户端据此生成 master 播放列表
+    media_manifest = Column(Text, nullable=True)  # 二进制清单（分片时长 / chunk_code / token / 年月前缀），见 app/utils/media_manifest.py
+    content_hash = Column(String(64), nullable=True, index=True)  # 原始文件 SHA-256，用于秒传去重
     uploaded_at = Column(DateTime, default=datetime.now)  # 上传时间
     post = relationship("Post", back_populates="video")  # 关联帖子表
 
@@ -0,0 +1,193 @@
+import os
+import math
+import time
+import random
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from qcloud_cos import CosConfig, CosS3Client
+from qcloud_cos.cos_exception import CosClientError, CosServiceError
+from app.config import settings
+
+# 腾讯云 OSS 配置（可改为读取 config.ini）
+SECRET_ID = settings.ACCESS_KEY_ID
+SECRET_KEY = settings.ACCESS_KEY_SECRET
+REGION = settings.JAPAN_REGION
+BUCKET = settings.JAPAN_BUCKET_NAME
+OSS_PREFIX = "/v1/vol/"
+# 各清晰度在 OSS 上的子目录（沿用 720p -> 7、1080p -> 10 的约定）
+RENDITION_OSS_DIRS = {"360p": "3", "540p": "5", "720p": "7", "1080p": "10"}
+# 客户端直传的原始文件前缀
+RAW_PREFIX = "/v1/raw/"
+# 视频封面 / 雪碧图 / WebVTT 缩略图轨（不加密）
+PREVIEW_PREFIX = "/v1/pv/"
+
+# 可选：自定义 Endpoint（本地 S3 兼容服务，如 MinIO）
+COS_ENDPOINT = getattr(settings, "COS_ENDPOINT", None)
+COS_SCHEME = getattr(settings, "COS_SCHEME", "https")
+
+# 分片直传：S3 协议要求除最后一片外每片 ≥ 5MB，最多 10000 片
+MULTIPART_MIN_PART_SIZE = 5 * 1024 * 1024
+MULTIPART_MAX_PARTS = 10000
+# 预签名 URL 有效期（秒）
+PRESIGN_EXPIRES = getattr(settings, "COS_PRESIGN_EXPIRES", 6 * 3600)
+
+# 分片集合并发上传：并发数（同时也是连接池大小）、最大重试次数、退避基数（秒）
+OSS_UPLOAD_WORKERS = getattr(settings, "OSS_UPLOAD_WORKERS", 8)
+OSS_UPLOAD_RETRIES = getattr(settings, "OSS_UPLOAD_RETRIES", 5)
+OSS_RETRY_BASE = getattr(settings, "OSS_RETRY_BASE", 0.5)
+
+# 所有上传线程共享同一个客户端，连接池不小于并发数，避免每个请求重新建连
+cos_options = dict(Region=REGION, SecretId=SECRET_ID, SecretKey=SECRET_KEY,
+                   PoolConnections=OSS_UPLOAD_WORKERS, PoolMaxSize=OSS_UPLOAD_WORKERS)
+if COS_ENDPOINT:
+    cos_config = CosConfig(Endpoint=COS_ENDPOINT, Scheme=COS_SCHEME, **cos_options)
+else:
+    cos_config = CosConfig(**cos_options)
+cos_client = CosS3Client(cos_config)
+
+
+def raw_object_key(subfolder: str, ym: str, filename: str) -> str:
+    """ 原始上传文件在对象存储中的 Key，例如 /v1/raw/vods/2503/u4_25032921_30_0000.mp4 """
+    return f"{RAW_PREFIX}{subfolder}/{ym}/{filename}"
+
+
+def rendition_object_key(label: str, relative_path: str) -> str:
+    """ 加密分片在对象存储中的 Key，例如 /v1/vol/7/2503/xxxx.mct（720p -> 7、1080p -> 10） """
+    return f"{OSS_PREFIX}{RENDITION_OSS_DIRS.get(label, '10')}/{relative_path}"
+
+
+def preview_object_key(relative_path: str) -> str:
+    """ 预览图在对象存储中的 Key，例如 /v1/pv/2503/<chunk_code>/poster.jpg """
+    return f"{PREVIEW_PREFIX}{relative_path}"
+
+
+def file_md5(local_path: str) -> str:
+    digest = hashlib.md5()
+    with open(local_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def object_matches(local_path: str, key: str, md5: str) -> bool:
+    """ HEAD 检查对象是否已存在且内容一致（单次 PUT 的 ETag 即内容 MD5） """
+    try:
+        response = cos_client.head_object(Bucket=BUCKET, Key=key)
+    except CosServiceError as e:
+        if e.get_status_code() == 404:
+            return False
+        raise
+    return response.get("ETag", "").strip('"') == md5
+
+
+def _retryable(error: Exception) -> bool:
+    if isinstance(error, CosServiceError):
+        status = error.get_status_code()
+        return status >= 500 or status in (408, 429)
+    return isinstance(error, (CosClientError, OSError))
+
+
+def put_segment(local_path: str, key: str) -> bool:
+    """
+    上传单个分片：已存在且 ETag 一致时跳过；可重试错误按指数退避（带抖动）重试 OSS_UPLOAD_RETRIES 次
+    :return: True 表示实际上传，False 表示已存在被跳过
+    """
+    md5 = file_md5(local_path)
+    for attempt in range(OSS_UPLOAD_RETRIES + 1):
+        try:
+            if object_matches(local_path, key, md5):
+                return False
+            with open(local_path, "rb") as f:
+                cos_client.put_object(Bucket=BUCKET, Body=f, Key=key)
+            return True
+        except Exception as e:
+            if attempt == OSS_UPLOAD_RETRIES or not _retryable(e):
+                raise
+            delay = OSS_RETRY_BASE * (2 ** attempt)
+            time.sleep(delay + random.uniform(0, delay))
+
+
+def upload_segment_set(files: list, workers: int = OSS_UPLOAD_WORKERS) -> dict:
+    """
+    并发上传一个视频的完整分片集合 [(本地路径, Key), ...]，共享连接池、并发数有界
+    全部成功落地才返回统计；任一分片重试耗尽后抛出异常（已上传的分片下次会被 HEAD 跳过）
+    """
+    stats = {"uploaded": 0, "skipped": 0}
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="oss-upload") as executor:
+        futures = {executor.submit(put_segment, local_path, key): key for local_path, key in files}
+        for future in as_completed(futures):
+            stats["uploaded" if future.result() else "skipped"] += 1
+    return stats
+
+
+def choose_part_size(total_size: int, preferred: int) -> int:
+    """ 分片大小：不小于 5MB，且保证总片数不超过 10000 """
+    return max(MULTIPART_MIN_PART_SIZE, preferred, math.ceil(total_size / MULTIPART_MAX_PARTS))
+
+
+def create_multipart_upload(key: str) -> str:
+    """ 创建分片上传，返回 UploadId """
+    response = cos_client.create_multipart_upload(Bucket=BUCKET, Key=key)
+    return response["UploadId"]
+
+
+def presign_part_urls(key: str, upload_id: str, part_numbers) -> list:
+    """ 为指定分片号生成预签名 PUT URL，客户端直接上传到对象存储 """
+    return [
+        {
+            "part_number": part_number,
+            "url": cos_client.get_presigned_url(
+                Bucket=BUCKET, Key=key, Method="PUT", Expired=PRESIGN_EXPIRES,
+                Params={"partNumber": str(part_number), "uploadId": upload_id},
+            ),
+        }
+        for part_number in part_numbers
+    ]
+
+
+def list_uploaded_parts(key: str, upload_id: str) -> dict:
+    """ 查询已上传的分片，返回 {PartNumber: ETag} """
+    parts = {}
+    marker = 0
+    while True:
+        response = cos_client.list_parts(Bucket=BUCKET, Key=key, UploadId=upload_id,
+                                         MaxParts=1000, PartNumberMarker=marker)
+        for part in response.get("Part", []):
+            parts[int(part["PartNumber"])] = part["ETag"]
+        if str(response.get("IsTruncated", "false")).lower() != "true":
+            return parts
+        marker = int(response["NextPartNumberMarker"])
+
+
+def complete_multipart_upload(key: str, upload_id: str, parts: dict):
+    """ 按分片号顺序合并对象 """
+    cos_client.complete_multipart_upload(
+        Bucket=BUCKET, Key=key, UploadId=upload_id,
+        MultipartUpload={"Part": [{"PartNumber": n, "ETag": parts[n]} for n in sorted(parts)]},
+    )
+
+
+def presign_download_url(key: str, expires: int = PRESIGN_EXPIRES) -> str:
+    """ 转码端通过预签名 URL 直接从对象存储拉流（ffmpeg 支持 HTTP Range 读取） """
+    return cos_client.get_presigned_download_url(Bucket=BUCKET, Key=key, Expired=expires)
+
+
+def object_size(key: str) -> int:
+    response = cos_client.head_object(Bucket=BUCKET, Key=key)
+    return int(response["Content-Length"])
+
+
+def upload_source(local_path: str, key: str, part_size: int = 16 * 1024 * 1024):
+    """
+    把本机的原始上传文件分块并发上传到对象存储，供其他主机的转码任务通过预签名 URL 读取
+    同名对象已存在且大小一致时跳过（重试 / 继续时不重复上传）
+    """
+    try:
+        if object_size(key) == os.path.getsize(local_path):
+            return
+    except CosServiceError as e:
+        if e.get_status_code() != 404:
+            raise
+    cos_client.upload_file(Bucket=BUCKET, Key=key, LocalFilePath=local_path,
+                           PartSize=choose_part_size(os.path.getsize(local_path), part_size) // (1024 * 1024),
+                           MAXThread=OSS_UPLOAD_WORKERS)
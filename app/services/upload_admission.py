@@ -0,0 +1,68 @@
+import asyncio
+import shutil
+from contextlib import asynccontextmanager
+from fastapi import HTTPException
+from app.config import settings
+from app.db.redis_client import redis_client
+from app.core.logger import log_event
+
+# 单个用户同时写入的分片数上限（跨进程，Redis 计数）
+UPLOAD_MAX_INFLIGHT_PER_USER = getattr(settings, "UPLOAD_MAX_INFLIGHT_PER_USER", 4)
+# 单个进程同时写盘的分片数上限
+UPLOAD_MAX_CONCURRENT_WRITES = getattr(settings, "UPLOAD_MAX_CONCURRENT_WRITES", 16)
+# 全局名额已满时最多排队等待的秒数，超时返回 503
+UPLOAD_SLOT_WAIT_SECONDS = getattr(settings, "UPLOAD_SLOT_WAIT_SECONDS", 5)
+# 上传目录所在磁盘使用率高水位（0~1），超过后拒绝新的上传
+UPLOAD_DISK_HIGH_WATERMARK = getattr(settings, "UPLOAD_DISK_HIGH_WATERMARK", 0.85)
+# 被拒绝时建议客户端的重试间隔（秒）
+UPLOAD_RETRY_AFTER = getattr(settings, "UPLOAD_RETRY_AFTER", 30)
+
+# 计数 key 的兜底过期时间，防止进程崩溃后计数无法归还
+_INFLIGHT_TTL = 300
+
+_write_slots = asyncio.Semaphore(UPLOAD_MAX_CONCURRENT_WRITES)
+
+
+def inflight_key(user_id: int) -> str:
+    return f"upload:inflight:{user_id}"
+
+
+def _reject(status_code: int, detail: str, retry_after: int):
+    raise HTTPException(status_code=status_code, detail=detail, headers={"Retry-After": str(retry_after)})
+
+
+@asynccontextmanager
+async def chunk_slot(user_id: int):
+    """
+    分片写入准入控制：先占用户名额（超出直接 429），再排队等待进程内写盘名额（等待超时 503）
+    """
+    key = inflight_key(user_id)
+    pipe = redis_client.pipeline()
+    pipe.incr(key)
+    pipe.expire(key, _INFLIGHT_TTL)
+    inflight, _ = pipe.execute()
+    try:
+        if inflight > UPLOAD_MAX_INFLIGHT_PER_USER:
+            _reject(429, f"同时上传的分片过多（上限 {UPLOAD_MAX_INFLIGHT_PER_USER}）", 1)
+        try:
+            await asyncio.wait_for(_write_slots.acquire(), timeout=UPLOAD_SLOT_WAIT_SECONDS)
+        except asyncio.TimeoutError:
+            log_event("upload", f"⏳ 写盘名额已满，拒绝分片 user={user_id}", "warning")
+            _reject(503, "服务器繁忙，请稍后重试", UPLOAD_SLOT_WAIT_SECONDS)
+        try:
+            yield
+        finally:
+            _write_slots.release()
+    finally:
+        redis_client.decr(key)
+
+
+def check_disk_capacity(upload_dir: str, total_size: int):
+    """
+    初始化上传前检查磁盘：预分配 total_size 后使用率超过高水位则拒绝，避免写满 static/upload 拖垮转码
+    """
+    usage = shutil.disk_usage(upload_dir)
+    projected = (usage.used + total_size) / usage.total
+    if total_size >= usage.free or projected > UPLOAD_DISK_HIGH_WATERMARK:
+        log_event("upload", f"💾 磁盘使用率 {projected:.1%} 超过高水位，拒绝新上传 size={total_size}", "warning")
+        _reject(503, "存储空间紧张，请稍后重试", UPLOAD_RETRY_AFTER)
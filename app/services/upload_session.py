@@ -0,0 +1,415 @@
+import os
+import math
+import hashlib
+import time
+import threading
+from collections import OrderedDict
+from typing import Optional, List, Tuple
+from app.config import settings
+from app.db.redis_client import redis_client, redis_raw_client
+
+# 上传会话有效期（秒），超时未完成的上传需要重新初始化
+UPLOAD_SESSION_TTL = getattr(settings, "UPLOAD_SESSION_TTL", 24 * 3600)
+
+# 每个进程缓存的上传会话数量 / 打开的文件句柄数量
+UPLOAD_SESSION_CACHE_SIZE = getattr(settings, "UPLOAD_SESSION_CACHE_SIZE", 1024)
+UPLOAD_FD_CACHE_SIZE = getattr(settings, "UPLOAD_FD_CACHE_SIZE", 64)
+# 文件句柄空闲超过该时长（秒）即关闭
+UPLOAD_FD_IDLE_SECONDS = getattr(settings, "UPLOAD_FD_IDLE_SECONDS", 60)
+
+# 自适应分片大小：上下限、对齐粒度、期望单个分片耗时（秒）
+UPLOAD_MIN_CHUNK_SIZE = getattr(settings, "UPLOAD_MIN_CHUNK_SIZE", 256 * 1024)
+UPLOAD_MAX_CHUNK_SIZE = getattr(settings, "UPLOAD_MAX_CHUNK_SIZE", 64 * 1024 * 1024)
+UPLOAD_CHUNK_ALIGN = 256 * 1024
+UPLOAD_CHUNK_TARGET_SECONDS = getattr(settings, "UPLOAD_CHUNK_TARGET_SECONDS", 4)
+# 吞吐量滑动平均权重（新样本占比）
+_THROUGHPUT_ALPHA = 0.3
+_THROUGHPUT_TTL = 7 * 24 * 3600
+
+# 整文件 SHA-256 读取块大小
+HASH_READ_BLOCK = 1024 * 1024
+
+# 会话中需要转换为整数的字段
+_INT_FIELDS = ("user_id", "post_id", "total_size", "chunk_size", "total_chunks")
+
+
+def session_key(filename: str) -> str:
+    return f"upload:session:{filename}"
+
+
+def bitmap_key(filename: str) -> str:
+    return f"upload:bitmap:{filename}"
+
+
+def throughput_key(user_id: int) -> str:
+    return f"upload:throughput:{user_id}"
+
+
+def record_throughput(user_id: int, size: int, elapsed: float):
+    """ 记录客户端实测上传吞吐（字节/秒），按指数滑动平均保存 """
+    if size <= 0 or elapsed <= 0:
+        return
+    sample = size / elapsed
+    previous = redis_client.get(throughput_key(user_id))
+    value = sample if previous is None else _THROUGHPUT_ALPHA * sample + (1 - _THROUGHPUT_ALPHA) * float(previous)
+    redis_client.setex(throughput_key(user_id), _THROUGHPUT_TTL, int(value))
+
+
+def choose_chunk_size(media_type: str, total_size: int, user_id: int) -> int:
+    """
+    为本次上传选择分片大小：
+      - 小于上限的图片一次传完；
+      - 有该客户端实测吞吐时，按 “单个分片约 UPLOAD_CHUNK_TARGET_SECONDS 秒” 计算，网络好的大视频使用更大分片；
+      - 没有吞吐数据时使用全局默认 CHUNK_SIZE。
+    结果限制在 [UPLOAD_MIN_CHUNK_SIZE, UPLOAD_MAX_CHUNK_SIZE] 并按 256KB 对齐
+    """
+    if media_type == "image" and total_size <= UPLOAD_MAX_CHUNK_SIZE:
+        return max(total_size, 1)
+
+    throughput = redis_client.get(throughput_key(user_id))
+    if throughput is None:
+        chunk_size = settings.CHUNK_SIZE
+    else:
+        chunk_size = int(float(throughput) * UPLOAD_CHUNK_TARGET_SECONDS)
+
+    chunk_size = max(UPLOAD_MIN_CHUNK_SIZE, min(UPLOAD_MAX_CHUNK_SIZE, chunk_size))
+    chunk_size = max(UPLOAD_CHUNK_ALIGN, chunk_size // UPLOAD_CHUNK_ALIGN * UPLOAD_CHUNK_ALIGN)
+    # 文件本身不大时，两片以内传完
+    if total_size <= chunk_size * 2:
+        return max(total_size, 1) if total_size <= chunk_size else math.ceil(total_size / 2)
+    return chunk_size
+
+
+def create_session(filename: str, file_path: str, media_type: str, user_id: int, post_id: int,
+                   total_size: int, chunk_size: int, **extra) -> dict:
+    """
+    创建上传会话：记录目标路径、预期大小、分片大小，分片接收情况用 Redis 位图记录
+    extra 为附加字段（如直传模式的 storage / object_key / upload_id）
+    """
+    session = {
+        "filename": filename,
+        "file_path": file_path,
+        "media_type": media_type,
+        "user_id": user_id,
+        "post_id": post_id,
+        "total_size": total_size,
+        "chunk_size": chunk_size,
+        "total_chunks": math.ceil(total_size / chunk_size),
+        "status": "uploading",
+        **extra,
+    }
+    pipe = redis_client.pipeline()
+    pipe.delete(session_key(filename), bitmap_key(filename))
+    pipe.hset(session_key(filename), mapping=session)
+    pipe.expire(session_key(filename), UPLOAD_SESSION_TTL)
+    pipe.execute()
+    session_registry.put(session)
+    return session
+
+
+def get_session(filename: str) -> Optional[dict]:
+    """ 读取上传会话，不存在时返回 None """
+    data = redis_client.hgetall(session_key(filename))
+    if not data:
+        return None
+    for field in _INT_FIELDS:
+        if field in data:
+            data[field] = int(data[field])
+    return data
+
+
+class SessionRegistry:
+    """
+    进程内上传会话注册表（LRU）
+    分片请求只需要目标路径、分片大小等初始化后不再变化的字段，命中本地缓存即可，不必每个分片都查询 Redis
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, filename: str) -> Optional[dict]:
+        with self._lock:
+            session = self._sessions.get(filename)
+            if session is not None:
+                self._sessions.move_to_end(filename)
+                return session
+        session = get_session(filename)
+        if session is not None:
+            self.put(session)
+        return session
+
+    def put(self, session: dict):
+        with self._lock:
+            self._sessions[session["filename"]] = session
+            self._sessions.move_to_end(session["filename"])
+            while len(self._sessions) > self.capacity:
+                self._sessions.popitem(last=False)
+
+    def discard(self, filename: str):
+        with self._lock:
+            self._sessions.pop(filename, None)
+
+
+class FileHandleCache:
+    """
+    有界 LRU 文件句柄缓存：同一上传的连续分片复用同一个 fd，用 pwrite 按偏移写入，免去每个分片 open/seek/close
+    正在使用（引用计数 > 0）的句柄不会被淘汰
+    上传可能在其他进程完成（只有完成的进程会调用 close），空闲超过 idle_seconds 的句柄由后台线程关闭，
+    已删除的原始上传文件不会因为残留的 fd 继续占用磁盘
+    """
+
+    def __init__(self, capacity: int, idle_seconds: float):
+        self.capacity = capacity
+        self.idle_seconds = idle_seconds
+        self._entries = OrderedDict()  # path -> [fd, 引用计数, 最近使用时间]
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def acquire(self, file_path: str, fd: int = None) -> int:
+        with self._lock:
+            entry = self._entries.get(file_path)
+            if entry is None:
+                if fd is None:
+                    fd = os.open(file_path, os.O_WRONLY)
+                entry = self._entries[file_path] = [fd, 0, time.monotonic()]
+            elif fd is not None:
+                os.close(fd)
+            entry[1] += 1
+            entry[2] = time.monotonic()
+            self._entries.move_to_end(file_path)
+            self._evict()
+            self._start_sweeper()
+            return entry[0]
+
+    def release(self, file_path: str):
+        with self._lock:
+            entry = self._entries.get(file_path)
+            if entry is not None:
+                entry[1] -= 1
+                entry[2] = time.monotonic()
+            self._evict()
+
+    def close(self, file_path: str):
+        """ 上传完成后关闭句柄（仍在写入时保留，由淘汰逻辑稍后关闭） """
+        with self._lock:
+            entry = self._entries.get(file_path)
+            if entry is not None and entry[1] <= 0:
+                del self._entries[file_path]
+                os.close(entry[0])
+
+    def _evict(self):
+        idle_before = time.monotonic() - self.idle_seconds
+        for path in list(self._entries):
+            fd, refs, used_at = self._entries[path]
+            if len(self._entries) <= self.capacity and used_at > idle_before:
+                break
+            if refs <= 0:
+                del self._entries[path]
+                os.close(fd)
+
+    def _start_sweeper(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._sweep_loop, name="upload-fd-sweeper", daemon=True)
+            self._thread.start()
+
+    def _sweep_loop(self):
+        while True:
+            time.sleep(self.idle_seconds / 2)
+            with self._lock:
+                self._evict()
+
+
+session_registry = SessionRegistry(UPLOAD_SESSION_CACHE_SIZE)
+file_handles = FileHandleCache(UPLOAD_FD_CACHE_SIZE, UPLOAD_FD_IDLE_SECONDS)
+
+
+def preallocate(file_path: str, total_size: int):
+    """
+    创建并预分配上传文件：优先 posix_fallocate 真正分配磁盘块（truncate 只会生成稀疏文件），
+    不支持的平台/文件系统退回 ftruncate；打开的句柄直接放入句柄缓存供后续分片复用
+    """
+    fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        if hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(fd, 0, total_size)
+            except OSError:
+                os.ftruncate(fd, total_size)
+        else:
+            os.ftruncate(fd, total_size)
+    except Exception:
+        os.close(fd)
+        raise
+    file_handles.acquire(file_path, fd)
+    file_handles.release(file_path)
+
+
+def write_at(file_path: str, offset: int, data: bytes):
+    """ 通过缓存的句柄在 offset 处写入数据 """
+    fd = file_handles.acquire(file_path)
+    try:
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(fd, view, offset)
+            view = view[written:]
+            offset += written
+    finally:
+        file_handles.release(file_path)
+
+
+def update_session(filename: str, **fields):
+    """ 更新会话字段 """
+    if fields:
+        redis_client.hset(session_key(filename), mapping=fields)
+
+
+def mark_chunk(filename: str, chunk_index: int):
+    """
+    在位图中标记分片已接收
+    分片此前已标记过（客户端重传）时，任何进程中已计入增量哈希的内容都可能已过期，标记会话在完成时整文件重算
+    """
+    pipe = redis_client.pipeline()
+    pipe.setbit(bitmap_key(filename), chunk_index, 1)
+    pipe.expire(bitmap_key(filename), UPLOAD_SESSION_TTL)
+    previous, _ = pipe.execute()
+    if previous:
+        redis_client.hset(session_key(filename), "hash_dirty", 1)
+
+
+def invalidate_chunk(filename: str, chunk_index: int):
+    """
+    分片写入失败（校验和不符、请求体不完整、连接中断）：流式写入可能已覆盖此前收到的正确数据，
+    清除位图中的标记要求客户端重传；此前已标记过时该分片可能已计入增量哈希，标记会话在完成时整文件重算
+    """
+    previous = redis_client.setbit(bitmap_key(filename), chunk_index, 0)
+    if previous:
+        redis_client.hset(session_key(filename), "hash_dirty", 1)
+
+
+def received_count(filename: str) -> int:
+    """ 已接收的分片数量 """
+    return redis_client.bitcount(bitmap_key(filename))
+
+
+def is_complete(session: dict) -> bool:
+    """ 位图是否已满（所有分片均已接收） """
+    return received_count(session["filename"]) >= session["total_chunks"]
+
+
+def missing_ranges(session: dict) -> List[Tuple[int, int]]:
+    """
+    计算缺失的分片区间（闭区间），例如 [(0, 0), (5, 9)]
+    Redis 位图中 offset 0 对应第一个字节的最高位
+    """
+    bitmap = redis_raw_client.get(bitmap_key(session["filename"])) or b""
+
+    def received(index):
+        byte_index = index >> 3
+        return byte_index < len(bitmap) and bitmap[byte_index] & (0x80 >> (index & 7))
+
+    return collect_missing(session["total_chunks"], received)
+
+
+def collect_missing(total: int, received) -> List[Tuple[int, int]]:
+    """ 根据 received(index) 判断函数把缺失的分片序号合并为闭区间 """
+    ranges = []
+    start = None
+    for index in range(total):
+        if not received(index) and start is None:
+            start = index
+        elif received(index) and start is not None:
+            ranges.append((start, index - 1))
+            start = None
+    if start is not None:
+        ranges.append((start, total - 1))
+    return ranges
+
+
+class _HashState:
+    """ 进程内的整文件增量哈希状态：frontier 之前的分片已计入 sha256 """
+
+    def __init__(self):
+        self.sha256 = hashlib.sha256()
+        self.frontier = 0
+        self.touched_at = time.monotonic()
+        self.lock = threading.Lock()
+
+
+# 按最近使用排序；放弃、过期或在其他进程完成的上传不会调用 finalize_hash，由 _evict_hash_states 回收
+_hash_states = OrderedDict()
+_hash_states_lock = threading.Lock()
+
+
+def _evict_hash_states():
+    """ 回收超过会话有效期未推进的状态，并限制总数（被回收的上传在完成时整文件读取一次） """
+    expired_at = time.monotonic() - UPLOAD_SESSION_TTL
+    while _hash_states:
+        filename, state = next(iter(_hash_states.items()))
+        if state.touched_at > expired_at and len(_hash_states) <= UPLOAD_SESSION_CACHE_SIZE:
+            break
+        del _hash_states[filename]
+
+
+def _hash_range(hasher, file_path: str, offset: int, length: int):
+    with open(file_path, "rb") as f:
+        f.seek(offset)
+        while length > 0:
+            block = f.read(min(HASH_READ_BLOCK, length))
+            if not block:
+                break
+            hasher.update(block)
+            length -= len(block)
+
+
+def _chunk_received(filename: str, chunk_index: int) -> bool:
+    return bool(redis_client.getbit(bitmap_key(filename), chunk_index))
+
+
+def advance_hash(session: dict):
+    """
+    推进整文件 SHA-256：从 frontier 开始把已连续收到的分片依次计入哈希
+    顺序上传时刚写入的分片仍在页缓存中，回读几乎没有磁盘开销；乱序到达的分片等前面补齐后再计入
+    哈希状态只保存在本进程；其他进程写入的分片同样从磁盘读取，complete 落在其他进程时回退为整文件读取
+    """
+    filename = session["filename"]
+    with _hash_states_lock:
+        state = _hash_states.get(filename)
+        if state is None:
+            state = _hash_states[filename] = _HashState()
+        state.touched_at = time.monotonic()
+        _hash_states.move_to_end(filename)
+        _evict_hash_states()
+    with state.lock:
+        chunk_size = session["chunk_size"]
+        while state.frontier < session["total_chunks"] and _chunk_received(filename, state.frontier):
+            offset = state.frontier * chunk_size
+            length = min(chunk_size, session["total_size"] - offset)
+            _hash_range(state.sha256, session["file_path"], offset, length)
+            state.frontier += 1
+
+
+def finalize_hash(session: dict) -> str:
+    """
+    完成上传时取得整文件 SHA-256：优先使用增量状态（只补算剩余分片），否则整文件读取一次
+    有分片被重传过（hash_dirty）时增量状态不可信，同样整文件读取
+    结果写入会话字段 sha256
+    """
+    filename = session["filename"]
+    with _hash_states_lock:
+        state = _hash_states.pop(filename, None)
+    if redis_client.hget(session_key(filename), "hash_dirty"):
+        state = None
+    if state is not None:
+        with state.lock:
+            offset = state.frontier * session["chunk_size"]
+            _hash_range(state.sha256, session["file_path"], offset, session["total_size"] - offset)
+            digest = state.sha256.hexdigest()
+    else:
+        hasher = hashlib.sha256()
+        _hash_range(hasher, session["file_path"], 0, session["total_size"])
+        digest = hasher.hexdigest()
+    update_session(filename, sha256=digest)
+    session["sha256"] = digest
+    return digest
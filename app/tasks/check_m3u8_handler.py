@@ -1,14 +1,20 @@
 
+import os
 import dramatiq
 from app.tasks.process_m3u8_crypto import process_m3u8_file
+from app.tasks.media_lifecycle import schedule_delete
+from app.utils.media_manifest import parse_m3u8_segments
 
 @dramatiq.actor
 def check_m3u8(file_path: str, output_root: str = None):
     try:
         print(f"[check_m3u8] 检测到 m3u8 文件: {file_path}")
-        new_m3u8_path, media_code = process_m3u8_file(file_path, output_root)
-        print(f"[check_m3u8] 新 m3u8 文件: {new_m3u8_path}")
+        segments = parse_m3u8_segments(file_path)
+        media_code = process_m3u8_file(file_path, output_root)
         print(f"[check_m3u8] 生成 media_code: {media_code}")
+        # 已加密完成：明文播放列表和 TS 分片保留期后清理
+        m3u8_dir = os.path.dirname(file_path)
+        schedule_delete([file_path] + [os.path.join(m3u8_dir, ts_file) for ts_file, _ in segments])
     except Exception as e:
         print(f"[check_m3u8] 处理异常: {e}")
 
@@ -0,0 +1,266 @@
+import os
+import math
+import functools
+import shutil
+import dramatiq
+from app.config import settings
+from app.services import oss_upload
+from app.tasks import media_pipeline, media_lifecycle, media_preview
+from app.tasks.transcode_scheduler import transcode_scheduler, TRANSCODE_TIME_LIMIT
+from app.tasks.ffmpeg_progress import run_ffmpeg_with_progress
+from app.tasks.media_probe import ABR_LADDER
+from app.tasks.process_convert_2_ts import build_split_filter, hls_output_args, progress_task_id
+from app.tasks.process_m3u8_crypto import (BASE_DIR, derive_media_keys, write_key_info, encryption_output_dir,
+                                           generate_chunk_name, get_current_ym_prefix, record_media_info)
+from app.utils.media_manifest import parse_m3u8_segments, segment_peak_bitrate
+
+# 每个区间的目标时长（秒），区间过多时自动加长
+CHUNKED_TRANSCODE_RANGE_SECONDS = getattr(settings, "CHUNKED_TRANSCODE_RANGE_SECONDS", 5 * 60)
+CHUNKED_TRANSCODE_MAX_RANGES = getattr(settings, "CHUNKED_TRANSCODE_MAX_RANGES", 16)
+
+
+def plan_spans(duration: float, value: int, range_seconds: int = CHUNKED_TRANSCODE_RANGE_SECONDS,
+               max_ranges: int = CHUNKED_TRANSCODE_MAX_RANGES) -> list:
+    """
+    把 [0, duration) 拆成若干区间 [[start, end], ...]：
+      - 区间长度是切片时长 value 的整数倍，边界正好落在输出的强制关键帧（-force_key_frames 每 value 秒一个）上，
+        每个区间都从 IDR 帧和新的切片开始，区间内的分片数是确定的；
+      - 最后一个区间延伸到片尾，不足半个区间的尾巴并入前一个区间
+    """
+    length = math.ceil(max(range_seconds, duration / max_ranges) / value) * value
+    spans, start = [], 0
+    while start < duration:
+        end = start + length
+        if duration - end < length / 2:
+            end = duration
+        spans.append([start, end])
+        start = end
+    return spans
+
+
+def start_chunked(post_id: int, record: dict, file_path: str, source_key: str, duration: float, value: int,
+                  fps: int, encoded: list, labels: list, infos: dict, preview: dict = None) -> dict:
+    """
+    规划（或沿用上次的规划）并投递各区间的编码任务，返回规划
+    区间任务可能运行在其他主机上：本机上传的源文件先传到对象存储，各区间通过预签名 URL 读取
+    infos 为各清晰度的分辨率 / CODECS（media_probe.rendition_info），拼接时连同峰值码率写入清晰度状态
+    preview 为预览图参数（缩略图尺寸、封面高度），已生成过预览图时为 None：
+    各区间在编码的同一次解码中输出该区间的雪碧图，第一个区间另外输出封面，直接上传到预览目录
+    """
+    chunked = record["artifacts"].get("chunked")
+    encoded_labels = [r.label for r in encoded]
+    if not chunked or chunked["value"] != value or chunked["labels"] != encoded_labels:
+        spans = plan_spans(duration, value)
+        offsets = [0]
+        for start, end in spans[:-1]:
+            offsets.append(offsets[-1] + round((end - start) / value))
+        chunked = {"ym": get_current_ym_prefix(), "value": value, "fps": fps, "labels": encoded_labels,
+                   "all_labels": labels, "spans": spans, "offsets": offsets, "done": {}, "peaks": {}}
+    chunked["infos"] = infos
+    # 输出高度随规划保存：低于最低档的源视频按源高度输出（见 select_ladder），不能按标签取阶梯默认高度
+    chunked["heights"] = {r.label: r.height for r in encoded}
+    if preview:
+        chunk_code, _, _ = derive_media_keys(f"{os.path.splitext(os.path.basename(file_path))[0]}.m3u8")
+        preview = dict(preview, prefix=f"{chunked['ym']}{chunk_code}/", duration=duration)
+    chunked["preview"] = preview
+    if not source_key and not record["artifacts"].get("source_key"):
+        source_key = oss_upload.raw_object_key("vods", chunked["ym"], os.path.basename(file_path))
+        oss_upload.upload_source(file_path, source_key)
+    media_pipeline.update_artifacts(post_id, chunked=chunked,
+                                    source_key=source_key or record["artifacts"].get("source_key"))
+
+    for index in range(len(chunked["spans"])):
+        if str(index) not in chunked["done"]:
+            transcode_range.send(post_id, index=index)
+    print(f"🧩 帖子 {post_id} 拆分为 {len(chunked['spans'])} 个区间并行编码：{'/'.join(encoded_labels)}")
+    return chunked
+
+
+def aggregate_progress(post_id: int, chunked: dict, index: int, progress: dict) -> dict:
+    """
+    把一个区间的进度换算成整片进度：各区间的已编码秒数记录在流水线记录中，按区间时长加权汇总，
+    所有区间共用帖子的进度频道（与整片转码相同），预计剩余时间按并行区间的速度之和估算
+    """
+    start, end = chunked["spans"][index]
+    duration = chunked["spans"][-1][1]
+    out_time = end - start if progress["status"] == "done" else min(progress["out_time"], end - start)
+    try:
+        encoded, speed = media_pipeline.update_range_progress(post_id, str(index), out_time, progress["speed"])
+    except Exception as e:
+        # 进度只用于展示，记录失败不影响转码，本次不推送
+        print(f"⚠️ 帖子 {post_id} 区间 {index} 进度记录失败：{e}")
+        return None
+    finished = encoded >= duration
+    return dict(
+        progress,
+        percent=100.0 if finished else round(min(99.9, encoded / duration * 100), 1),
+        out_time=round(encoded, 1),
+        duration=round(duration, 1),
+        speed=round(speed, 2),
+        eta=0 if finished else (round((duration - encoded) / speed) if speed else None),
+        status="done" if finished else "running",
+        range=index,
+    )
+
+
+def encode_range(record: dict, chunked: dict, index: int) -> dict:
+    """
+    编码一个区间：一次解码、split 输出所有清晰度的加密 HLS，
+    -output_ts_offset 让时间戳接续在整片时间轴上，分片按全局序号命名后直接上传对象存储
+    :return: ({清晰度: [该区间各分片时长]}, {清晰度: 该区间峰值码率})
+    """
+    base_name = os.path.splitext(record["filename"])[0]
+    start, end = chunked["spans"][index]
+    last = index == len(chunked["spans"]) - 1
+    value, fps, ym = chunked["value"], chunked["fps"], chunked["ym"]
+    heights = chunked.get("heights", {})
+    ladder = [r._replace(height=heights.get(r.label, r.height)) for r in reversed(ABR_LADDER)
+              if r.label in chunked["labels"]]
+    input_path = oss_upload.presign_download_url(record["artifacts"]["source_key"])
+    chunk_code, token, encryption_key = derive_media_keys(f"{base_name}.m3u8")
+    staging_root = os.path.join(BASE_DIR, "static", "encryption", "staging")
+
+    # 预览图与各清晰度共用本区间的解码：每个区间一组雪碧图，第一个区间另外输出封面
+    preview = chunked.get("preview")
+    preview_chains = None
+    if preview:
+        thumb_w, thumb_h = preview["thumb"]
+        preview_chains = media_preview.preview_filter_chains(preview["poster_height"], thumb_w, thumb_h,
+                                                             poster=index == 0)
+
+    # 中间区间按帧数截断，保证分片数与规划一致（最后一个区间读到片尾）
+    expected = None if last else round((end - start) / value)
+    range_args = ["-output_ts_offset", str(start)]
+    if not last:
+        range_args += ["-frames:v", str(int(round((end - start) * fps)))]
+
+    name = f"{base_name} #{index} [{start}s-{end}s]"
+    with transcode_scheduler.slot(name) as threads:
+        encoder_threads = transcode_scheduler.encoder_threads(len(ladder))
+        command = ["ffmpeg", "-threads", str(threads), "-ss", str(start)]
+        if not last:
+            command += ["-t", str(end - start)]
+        command += [
+            "-i", input_path,
+            "-filter_complex_threads", str(min(threads, 2)),
+            "-filter_complex", build_split_filter(ladder, fps, preview_chains),
+        ]
+        staging = {}
+        for i, rendition in enumerate(ladder):
+            out_dir = os.path.join(staging_root, rendition.label, base_name, f"r{index:03d}")
+            shutil.rmtree(out_dir, ignore_errors=True)
+            os.makedirs(out_dir, exist_ok=True)
+            key_info_file = write_key_info(out_dir, token, encryption_key)
+            staging[rendition.label] = os.path.join(out_dir, f"{base_name}.m3u8")
+            command += ["-map", f"[v{i}]", "-map", "0:a?"]
+            command += hls_output_args(rendition, value, fps, os.path.join(out_dir, "segment_%05d.ts"),
+                                       staging[rendition.label], encoder_threads, key_info_file, range_args)
+        if preview:
+            preview_dir = os.path.join(staging_root, "preview", base_name, f"r{index:03d}")
+            shutil.rmtree(preview_dir, ignore_errors=True)
+            os.makedirs(preview_dir, exist_ok=True)
+            command += media_preview.preview_output_args(preview_dir, poster=index == 0,
+                                                         sprite_pattern=media_preview.range_sprite_pattern(index))
+        print(f"【{name}】执行命令: {' '.join(command)}")
+        run_ffmpeg_with_progress(command, progress_task_id(base_name), end - start,
+                                 aggregate=functools.partial(aggregate_progress, record["post_id"], chunked, index))
+
+    durations, peaks, files = {}, {}, []
+    for label, m3u8_file in staging.items():
+        segments = parse_m3u8_segments(m3u8_file)
+        peaks[label] = segment_peak_bitrate(m3u8_file)
+        if expected is not None and len(segments) != expected:
+            raise RuntimeError(f"{label} 区间 {index} 分片数 {len(segments)} 与规划的 {expected} 不一致")
+        output_dir = encryption_output_dir(label, ym, media_pipeline.PIPELINE_OUTPUT_ROOT)
+        for i, (segment, _) in enumerate(segments):
+            chunk_name = generate_chunk_name(chunk_code, chunked["offsets"][index] + i)
+            local_path = os.path.join(output_dir, chunk_name)
+            os.replace(os.path.join(os.path.dirname(m3u8_file), segment), local_path)
+            files.append((local_path, oss_upload.rendition_object_key(label, f"{ym}{chunk_name}")))
+        durations[label] = [duration for _, duration in segments]
+        shutil.rmtree(os.path.dirname(m3u8_file), ignore_errors=True)
+
+    if preview:
+        # 封面没有命中场景变化时按整片 10% 处 seek 取一帧，只解码一帧
+        if index == 0:
+            media_preview.extract_poster_fallback(input_path, preview_dir, preview["duration"],
+                                                  preview["poster_height"])
+        files += [(os.path.join(preview_dir, name), oss_upload.preview_object_key(f"{preview['prefix']}{name}"))
+                  for name in media_preview.preview_files(preview_dir)]
+
+    stats = oss_upload.upload_segment_set(files)
+    print(f"📤 【{name}】分片上传完成：上传 {stats['uploaded']}，已存在跳过 {stats['skipped']}")
+    media_lifecycle.schedule_delete([local_path for local_path, _ in files] + ([preview_dir] if preview else []))
+    return durations, peaks
+
+
+@dramatiq.actor(time_limit=TRANSCODE_TIME_LIMIT)
+def transcode_range(post_id: int, index: int = 0):
+    """ 分段并行转码的一个区间，最后完成的部分负责投递拼接任务 """
+    record = media_pipeline.get_pipeline(post_id)
+    if not record or media_pipeline.stage_reached(record, "encrypted"):
+        return
+    chunked = record["artifacts"].get("chunked")
+    if not chunked or str(index) in chunked["done"]:
+        return
+    try:
+        durations, peaks = encode_range(record, chunked, index)
+        if media_pipeline.complete_range(post_id, str(index), durations, peaks):
+            stitch_ranges.send(post_id)
+    except BaseException as e:
+        print(f"处理帖子 {post_id} 区间 {index} 时出错：{media_pipeline.error_text(e)}")
+        media_pipeline.fail_stage(post_id, f"range {index}: {media_pipeline.error_text(e)}")
+        if not isinstance(e, Exception):
+            raise
+
+
+def stitch_preview(filename: str, chunked: dict):
+    """ 写出整片的 vtt 缩略图轨并上传，返回与单次转码相同结构的预览产物（已发布）；本次没有生成预览图时返回 None """
+    preview = chunked.get("preview")
+    if not preview:
+        return None
+    preview_dir = os.path.join(BASE_DIR, "static", "encryption", "staging", "preview",
+                               os.path.splitext(filename)[0], "vtt")
+    os.makedirs(preview_dir, exist_ok=True)
+    thumb_w, thumb_h = preview["thumb"]
+    media_preview.write_thumbnail_vtt(preview_dir, preview["duration"], thumb_w, thumb_h, chunked["spans"])
+    vtt_path = os.path.join(preview_dir, media_preview.VTT_NAME)
+    oss_upload.put_segment(vtt_path, oss_upload.preview_object_key(f"{preview['prefix']}{media_preview.VTT_NAME}"))
+    media_lifecycle.schedule_delete([preview_dir])
+    return {"prefix": preview["prefix"], "files": media_preview.range_preview_files(chunked["spans"]),
+            "published": True}
+
+
+@dramatiq.actor(time_limit=TRANSCODE_TIME_LIMIT)
+def stitch_ranges(post_id: int):
+    """
+    拼接：各区间分片已按全局序号命名并上传，这里按区间顺序合并分片时长生成清单，
+    区间交界处记为不连续点（各区间独立编码，TS 连续计数与音频编码器状态在交界处重置），
+    预览图由各区间上传，这里只生成并上传引用各区间雪碧图的 vtt，
+    然后与单次转码一样进入发布阶段（已上传的分片不会重复上传）
+    """
+    record = media_pipeline.get_pipeline(post_id)
+    if not record or media_pipeline.stage_reached(record, "encrypted"):
+        return
+    chunked = record["artifacts"]["chunked"]
+    base_filename = f"{os.path.splitext(record['filename'])[0]}.m3u8"
+    chunk_code, token, _ = derive_media_keys(base_filename)
+    try:
+        for label in chunked["labels"]:
+            durations = [d for index in range(len(chunked["spans"])) for d in chunked["done"][str(index)][label]]
+            media = record_media_info(base_filename, len(durations), durations, chunk_code, token, chunked["ym"],
+                                      chunked["all_labels"], chunked["offsets"][1:])
+            bandwidth = max(chunked["peaks"][str(index)][label] for index in range(len(chunked["spans"])))
+            media_pipeline.update_rendition(post_id, label, artifacts={"media": media}, status="encrypted",
+                                            chunks=len(durations), ym=chunked["ym"], m3u8=base_filename,
+                                            uploaded=len(durations), bandwidth=bandwidth, **chunked["infos"][label])
+            print(f"🔐 {label} 区间拼接完成，media_code: {media['media_code']}")
+        media_pipeline.complete_stage(post_id, "transcoded")
+        preview = stitch_preview(record["filename"], chunked)
+        media_pipeline.complete_stage(post_id, "encrypted", **({"preview": preview} if preview else {}))
+        media_pipeline.publish_media.send(post_id)
+    except BaseException as e:
+        print(f"拼接帖子 {post_id} 时出错：{media_pipeline.error_text(e)}")
+        media_pipeline.fail_stage(post_id, f"stitch: {media_pipeline.error_text(e)}")
+        if not isinstance(e, Exception):
+            raise
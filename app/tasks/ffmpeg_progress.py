@@ -0,0 +1,79 @@
+import json
+import subprocess
+import time
+from app.config import settings
+from app.core.logger import log_event
+
+# 进度推送最小间隔（秒）
+TRANSCODE_PROGRESS_INTERVAL = getattr(settings, "TRANSCODE_PROGRESS_INTERVAL", 3)
+
+
+def parse_speed(value: str) -> float:
+    """ ffmpeg 的 speed 形如 "1.52x"，未知时为 "N/A" """
+    try:
+        return float(value.rstrip("x"))
+    except (AttributeError, ValueError):
+        return 0.0
+
+
+def build_progress(block: dict, duration: float, started_at: float) -> dict:
+    """ 根据一段 -progress 输出计算百分比、帧率、速度和预计剩余时间 """
+    out_us = block.get("out_time_us") or block.get("out_time_ms") or "0"  # out_time_ms 实际单位也是微秒
+    try:
+        out_time = max(0.0, int(out_us) / 1_000_000)
+    except ValueError:
+        out_time = 0.0
+    speed = parse_speed(block.get("speed"))
+    try:
+        fps = float(block.get("fps", 0))
+    except ValueError:
+        fps = 0.0
+    finished = block.get("progress") == "end"
+    percent = 100.0 if finished else (min(99.9, out_time / duration * 100) if duration else 0.0)
+    eta = 0 if finished else (round((duration - out_time) / speed) if duration and speed else None)
+    return {
+        "stage": "transcode",
+        "percent": round(percent, 1),
+        "out_time": round(out_time, 1),
+        "duration": round(duration, 1),
+        "fps": fps,
+        "speed": speed,
+        "eta": eta,
+        "elapsed": round(time.monotonic() - started_at),
+        "status": "done" if finished else "running",
+    }
+
+
+def run_ffmpeg_with_progress(command: list, task_id: str, duration: float, aggregate=None):
+    """
+    以 -progress pipe:1 运行 ffmpeg，解析 out_time / fps / speed，
+    按 TRANSCODE_PROGRESS_INTERVAL 节流后通过 log_event 推送到 Redis 频道 logs:{task_id}
+    aggregate(progress) -> progress：推送前换算成整体进度（分段并行转码时多个区间共用一个频道），返回 None 时本次不推送
+    失败时抛出 CalledProcessError（与 subprocess.run(check=True) 一致）
+    """
+    command = [command[0], "-progress", "pipe:1", "-nostats"] + command[1:]
+    started_at = time.monotonic()
+    last_sent = 0.0
+    block = {}
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, universal_newlines=True)
+    for line in process.stdout:
+        key, _, value = line.strip().partition("=")
+        if not key:
+            continue
+        block[key] = value.strip()
+        if key != "progress":
+            continue
+        now = time.monotonic()
+        if value == "end" or now - last_sent >= TRANSCODE_PROGRESS_INTERVAL:
+            progress = build_progress(block, duration, started_at)
+            if aggregate:
+                progress = aggregate(progress)
+            if progress:
+                log_event(task_id, json.dumps(progress), "info", is_task_log=True)
+            last_sent = now
+        block = {}
+    returncode = process.wait()
+    if returncode != 0:
+        log_event(task_id, json.dumps({"stage": "transcode", "status": "failed", "returncode": returncode}),
+                  "error", is_task_log=True)
+        raise subprocess.CalledProcessError(returncode, command)
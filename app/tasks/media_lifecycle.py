@@ -0,0 +1,116 @@
+import os
+import time
+import shutil
+import socket
+import threading
+import dramatiq
+from app.config import settings
+from app.db.redis_client import redis_client
+from app.tasks.process_m3u8_crypto import BASE_DIR
+
+# 中间文件在下一阶段确认完成后保留的时长（秒），便于排查或人工重跑
+MEDIA_RETENTION_SECONDS = getattr(settings, "MEDIA_RETENTION_SECONDS", 24 * 3600)
+# 磁盘使用率高水位：超过后暂停接收新转码；回落到低水位以下才恢复（避免来回抖动）
+MEDIA_DISK_HIGH_WATERMARK = getattr(settings, "MEDIA_DISK_HIGH_WATERMARK", 0.85)
+MEDIA_DISK_LOW_WATERMARK = getattr(settings, "MEDIA_DISK_LOW_WATERMARK", 0.75)
+# 暂停期间转码任务延后重新投递的间隔（秒）
+MEDIA_INTAKE_RETRY_DELAY = getattr(settings, "MEDIA_INTAKE_RETRY_DELAY", 300)
+# 到期清理的执行间隔（秒）
+MEDIA_SWEEP_INTERVAL = getattr(settings, "MEDIA_SWEEP_INTERVAL", 300)
+
+# 只允许清理 static 目录下的文件
+MEDIA_ROOT = os.path.join(BASE_DIR, "static")
+# 中间文件在本机磁盘上，待清理队列与暂停标记均按主机区分
+HOST = socket.gethostname()
+
+
+def lifecycle_key() -> str:
+    return f"media:lifecycle:{HOST}"
+
+
+def intake_key() -> str:
+    return f"media:intake:paused:{HOST}"
+
+
+def sweep_lock_key() -> str:
+    return f"media:lifecycle:sweep:{HOST}"
+
+
+def schedule_delete(paths, retention: int = MEDIA_RETENTION_SECONDS):
+    """ 下一阶段已确认完成：登记待清理的中间文件（或目录），保留 retention 秒后由 sweep 删除 """
+    paths = [os.path.abspath(p) for p in paths if p]
+    if paths:
+        deadline = time.time() + retention
+        redis_client.zadd(lifecycle_key(), {path: deadline for path in paths})
+
+
+def sweep(now: float = None) -> int:
+    """ 删除保留期已过的中间文件，返回释放的字节数 """
+    now = now or time.time()
+    freed = 0
+    for path in redis_client.zrangebyscore(lifecycle_key(), 0, now):
+        if os.path.commonpath([path, MEDIA_ROOT]) != MEDIA_ROOT:
+            print(f"⚠️ 拒绝清理 static 目录以外的路径: {path}")
+        elif os.path.isdir(path):
+            freed += sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.exists(path):
+            freed += os.path.getsize(path)
+            os.remove(path)
+        redis_client.zrem(lifecycle_key(), path)
+    if freed:
+        print(f"🧹 已清理过期中间文件，释放 {freed / 1024 / 1024:.1f} MB")
+    return freed
+
+
+def sweep_if_due() -> int:
+    """
+    每台主机每个 MEDIA_SWEEP_INTERVAL 只清理一次：同一主机上的监听器与多个 worker 进程都会调用，
+    由 Redis 锁决定本周期由谁执行，其余直接返回 0
+    """
+    if not redis_client.set(sweep_lock_key(), os.getpid(), nx=True, ex=max(1, int(MEDIA_SWEEP_INTERVAL * 0.9))):
+        return 0
+    return sweep()
+
+
+class LifecycleSweeper(dramatiq.Middleware):
+    """
+    worker 进程启动后在后台线程中定期清理本机到期的中间文件
+    只运行转码 / 区间编码 worker、不运行 watchdog 监听器的主机同样需要清理（待清理队列按主机区分）
+    """
+
+    def after_worker_boot(self, broker, worker):
+        threading.Thread(target=self._loop, name="media-lifecycle-sweeper", daemon=True).start()
+
+    def _loop(self):
+        while True:
+            time.sleep(MEDIA_SWEEP_INTERVAL)
+            try:
+                sweep_if_due()
+            except Exception as e:
+                print(f"❌ 中间文件清理失败: {e}")
+
+
+def disk_usage_ratio(path: str = MEDIA_ROOT) -> float:
+    usage = shutil.disk_usage(path)
+    return usage.used / usage.total
+
+
+def intake_paused() -> bool:
+    """
+    本机是否暂停接收新转码：使用率 ≥ 高水位时暂停，回落到低水位以下才恢复
+    暂停标记存 Redis，同一主机上的所有转码进程看到一致的状态
+    """
+    ratio = disk_usage_ratio()
+    paused = redis_client.exists(intake_key())
+    if ratio >= MEDIA_DISK_HIGH_WATERMARK:
+        if not paused:
+            redis_client.set(intake_key(), f"{ratio:.3f}")
+            print(f"⏸️ 磁盘使用率 {ratio:.1%} 超过高水位，暂停接收新转码")
+        return True
+    if paused and ratio > MEDIA_DISK_LOW_WATERMARK:
+        return True
+    if paused:
+        redis_client.delete(intake_key())
+        print(f"▶️ 磁盘使用率回落到 {ratio:.1%}，恢复接收新转码")
+    return False
@@ -0,0 +1,301 @@
+import os
+import json
+from datetime import datetime, timedelta
+import dramatiq
+from contextlib import contextmanager
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from app.config import settings
+from app.models.base import WorkerSessionLocal
+from app.models.media_pipeline_model import MediaPipeline
+from app.services import oss_upload
+from app.tasks import media_lifecycle
+from app.tasks.transcode_scheduler import TRANSCODE_TIME_LIMIT
+from app.tasks.media_writer import media_writer
+from app.tasks.process_m3u8_crypto import BASE_DIR, parse_filename, generate_chunk_code, generate_chunk_name
+
+# 流水线阶段（按顺序），记录中的 stage 表示最后完成的阶段
+STAGES = ("uploaded", "transcoded", "encrypted", "published")
+
+# 流水线产出的加密分片目录（不在 watchdog 监听范围内，由 publish_media 负责上传）
+PIPELINE_OUTPUT_ROOT = os.path.join(BASE_DIR, "static", "encryption", "pipeline")
+
+# running 状态超过该时长（秒）未更新视为进程已崩溃，允许重新认领
+PIPELINE_RUNNING_TIMEOUT = getattr(settings, "PIPELINE_RUNNING_TIMEOUT", 6 * 3600)
+
+
+def to_dict(pipeline: MediaPipeline) -> dict:
+    return {
+        "post_id": pipeline.post_id,
+        "user_id": pipeline.user_id,
+        "filename": pipeline.filename,
+        "stage": pipeline.stage,
+        "status": pipeline.status,
+        "renditions": json.loads(pipeline.renditions or "{}"),
+        "artifacts": json.loads(pipeline.artifacts or "{}"),
+        "attempts": pipeline.attempts,
+        "last_error": pipeline.last_error,
+        "updated_at": pipeline.updated_at.isoformat() if pipeline.updated_at else None,
+    }
+
+
+def stage_reached(record: dict, stage: str) -> bool:
+    return STAGES.index(record["stage"]) >= STAGES.index(stage)
+
+
+def post_id_of(filename: str):
+    """ 从上传文件名（u<uid>_<yymmddhh>_<post_id>_<合集>）解析帖子 ID，无法解析返回 None """
+    parsed = parse_filename(os.path.basename(filename))
+    return parsed[2] if parsed else None
+
+
+@contextmanager
+def _locked(post_id: int):
+    """ 行锁读取流水线记录，退出时提交；记录不存在时抛出 LookupError """
+    db = WorkerSessionLocal()
+    try:
+        pipeline = db.execute(
+            select(MediaPipeline).where(MediaPipeline.post_id == post_id).with_for_update()
+        ).scalars().first()
+        if not pipeline:
+            raise LookupError(f"流水线记录不存在: post {post_id}")
+        yield pipeline
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def get_pipeline(post_id: int):
+    db = WorkerSessionLocal()
+    try:
+        pipeline = db.execute(select(MediaPipeline).where(MediaPipeline.post_id == post_id)).scalars().first()
+        return to_dict(pipeline) if pipeline else None
+    finally:
+        db.close()
+
+
+def ensure_pipeline(filename: str, **artifacts) -> dict:
+    """ 获取帖子的流水线记录，不存在时以 uploaded 阶段创建；artifacts 合并写入产物 """
+    post_id = post_id_of(filename)
+    parsed = parse_filename(os.path.basename(filename))
+    db = WorkerSessionLocal()
+    try:
+        db.add(MediaPipeline(
+            post_id=post_id, user_id=parsed[0], filename=os.path.basename(filename),
+            stage="uploaded", status="pending", attempts=0, artifacts=json.dumps(artifacts),
+        ))
+        db.commit()
+    except IntegrityError:
+        # 已存在（重试或并发创建），合并产物即可
+        db.rollback()
+        with _locked(post_id) as pipeline:
+            merged = json.loads(pipeline.artifacts or "{}")
+            merged.update({k: v for k, v in artifacts.items() if v is not None})
+            pipeline.artifacts = json.dumps(merged)
+    finally:
+        db.close()
+    return get_pipeline(post_id)
+
+
+def claim_stage(post_id: int, stage: str, force: bool = False) -> bool:
+    """
+    认领一个阶段：同一帖子同一时间只允许一个任务运行（接口链式触发与 watchdog 兜底可能重复投递）
+    已有任务在运行且未超时时返回 False；force=True 时强制认领（管理员手动继续）
+    """
+    with _locked(post_id) as pipeline:
+        stale_at = datetime.now() - timedelta(seconds=PIPELINE_RUNNING_TIMEOUT)
+        if pipeline.status == "running" and not force and (pipeline.updated_at or datetime.now()) > stale_at:
+            print(f"⏭️ 流水线 post {post_id} 已有任务运行中，忽略重复的 {stage}")
+            return False
+        pipeline.status = "running"
+        pipeline.attempts += 1
+        pipeline.last_error = None
+    print(f"▶️ 流水线 post {post_id} 开始阶段: {stage}")
+    return True
+
+
+def complete_stage(post_id: int, stage: str, **artifacts):
+    """ 标记阶段完成（只前进不后退），可同时写入该阶段的产物 """
+    with _locked(post_id) as pipeline:
+        if STAGES.index(stage) > STAGES.index(pipeline.stage):
+            pipeline.stage = stage
+        pipeline.status = "done" if pipeline.stage == STAGES[-1] else "pending"
+        if artifacts:
+            merged = json.loads(pipeline.artifacts or "{}")
+            merged.update(artifacts)
+            pipeline.artifacts = json.dumps(merged)
+    print(f"✅ 流水线 post {post_id} 完成阶段: {stage}")
+
+
+def update_artifacts(post_id: int, **artifacts):
+    """ 合并写入产物而不改变阶段，例如转码过程中生成的预览图 """
+    with _locked(post_id) as pipeline:
+        merged = json.loads(pipeline.artifacts or "{}")
+        merged.update(artifacts)
+        pipeline.artifacts = json.dumps(merged)
+
+
+def complete_range(post_id: int, part: str, durations: dict = None, peaks: dict = None) -> bool:
+    """
+    分段并行转码：记录一个区间完成（区间序号，durations 为该区间各清晰度的分片时长，
+    peaks 为该区间各清晰度的峰值码率）
+    在行锁内判断是否全部完成，只有最后完成的任务返回 True，由它投递拼接任务
+    """
+    with _locked(post_id) as pipeline:
+        artifacts = json.loads(pipeline.artifacts or "{}")
+        chunked = artifacts["chunked"]
+        chunked["done"][part] = durations or {}
+        chunked.setdefault("peaks", {})[part] = peaks or {}
+        pipeline.artifacts = json.dumps(artifacts)
+        return len(chunked["done"]) == len(chunked["spans"])
+
+
+def update_range_progress(post_id: int, part: str, out_time: float, speed: float):
+    """
+    分段并行转码：记录一个区间的编码进度（已编码秒数、速度），
+    在行锁内汇总所有区间：已完成的区间按整个区间计
+    :return: (已编码总秒数, 未完成区间的速度之和)
+    """
+    with _locked(post_id) as pipeline:
+        artifacts = json.loads(pipeline.artifacts or "{}")
+        chunked = artifacts["chunked"]
+        progress = chunked.setdefault("progress", {})
+        progress[part] = [out_time, speed]
+        pipeline.artifacts = json.dumps(artifacts)
+        encoded, total_speed = 0.0, 0.0
+        for index, (start, end) in enumerate(chunked["spans"]):
+            if str(index) in chunked["done"]:
+                encoded += end - start
+                continue
+            done_time, range_speed = progress.get(str(index), [0.0, 0.0])
+            encoded += min(done_time, end - start)
+            if done_time < end - start:
+                total_speed += range_speed
+        return encoded, total_speed
+
+
+def error_text(e: BaseException) -> str:
+    """ 写入 last_error 的错误描述；TimeLimitExceeded 等没有消息的异常使用类名 """
+    return str(e) or type(e).__name__
+
+
+def fail_stage(post_id: int, error: str):
+    with _locked(post_id) as pipeline:
+        pipeline.status = "failed"
+        pipeline.last_error = error[:2000]
+    print(f"❌ 流水线 post {post_id} 失败: {error}")
+
+
+def update_rendition(post_id: int, label: str, artifacts: dict = None, **fields):
+    """
+    合并更新某个清晰度的状态，例如 status="encrypted"、chunks=120、uploaded=40
+    artifacts 不为空时在同一事务内合并写入产物（例如加密完成时的视频描述 media）
+    """
+    with _locked(post_id) as pipeline:
+        renditions = json.loads(pipeline.renditions or "{}")
+        renditions.setdefault(label, {}).update(fields)
+        pipeline.renditions = json.dumps(renditions)
+        if artifacts:
+            merged = json.loads(pipeline.artifacts or "{}")
+            merged.update(artifacts)
+            pipeline.artifacts = json.dumps(merged)
+
+
+def complete_publish(post_id: int, labels: list, **artifacts):
+    """
+    发布完成：分片已全部落地 OSS，在同一事务内把清晰度和流水线标记为已发布，
+    并标记帖子 / 视频 / 合集信息待写入（media_pending），由 media_writer 按数量或时间批量写库
+    """
+    with _locked(post_id) as pipeline:
+        merged = json.loads(pipeline.artifacts or "{}")
+        merged.update(artifacts)
+        media = merged.get("media")
+        if not media:
+            raise RuntimeError("缺少视频描述（media），需要重新转码")
+        renditions = json.loads(pipeline.renditions or "{}")
+        for label in labels:
+            renditions[label].update(uploaded=renditions[label]["chunks"], status="published")
+        pipeline.renditions = json.dumps(renditions)
+        pipeline.artifacts = json.dumps(merged)
+        pipeline.stage = "published"
+        pipeline.status = "done"
+        pipeline.media_pending = True
+    media_writer.notify()
+    print(f"✅ 流水线 post {post_id} 完成阶段: published")
+
+
+def rendition_status(record: dict, label: str) -> str:
+    return record["renditions"].get(label, {}).get("status", "pending")
+
+
+def rendition_files(label: str, info: dict) -> list:
+    """ 按记录中的分片数与年月前缀还原一个清晰度的完整分片集合 [(本地路径, OSS Key), ...] """
+    chunk_code = generate_chunk_code(info["m3u8"])
+    files = []
+    for index in range(info["chunks"]):
+        chunk_name = generate_chunk_name(chunk_code, index)
+        files.append((os.path.join(PIPELINE_OUTPUT_ROOT, label, info["ym"], chunk_name),
+                      oss_upload.rendition_object_key(label, f"{info['ym']}{chunk_name}")))
+    return files
+
+
+def preview_files(preview: dict) -> list:
+    """ 封面 / 雪碧图 / vtt 的 [(本地路径, OSS Key), ...] """
+    local_dir = os.path.join(PIPELINE_OUTPUT_ROOT, "preview", preview["prefix"])
+    return [(os.path.join(local_dir, name), oss_upload.preview_object_key(f"{preview['prefix']}{name}"))
+            for name in preview["files"]]
+
+
+@dramatiq.actor(time_limit=TRANSCODE_TIME_LIMIT)
+def publish_media(post_id: int, force: bool = False):
+    """
+    发布阶段：所有待发布清晰度的分片作为一个集合并发上传 OSS（已存在且 ETag 一致的跳过），
+    整个集合全部落地后才写入视频信息，并把清晰度和流水线标记为已发布（同一事务）
+    """
+    record = get_pipeline(post_id)
+    if not record or stage_reached(record, "published"):
+        return
+    if not claim_stage(post_id, "published", force=force):
+        return
+    try:
+        labels = [label for label, info in record["renditions"].items() if info.get("status") == "encrypted"]
+        # 分段并行转码的清晰度已由各区间任务上传（uploaded == chunks），只上传本机产出的部分
+        local = [label for label in labels
+                 if record["renditions"][label].get("uploaded", 0) < record["renditions"][label]["chunks"]]
+        files = [f for label in local for f in rendition_files(label, record["renditions"][label])]
+        preview = record["artifacts"].get("preview")
+        if preview and not preview.get("published"):
+            files += preview_files(preview)
+        stats = oss_upload.upload_segment_set(files)
+        print(f"📤 帖子 {post_id} 分片上传完成：上传 {stats['uploaded']}，已存在跳过 {stats['skipped']}")
+        if preview:
+            preview["published"] = True
+        complete_publish(post_id, labels, **({"preview": preview} if preview else {}))
+        # 已全部落地 OSS，本地加密分片保留期后清理
+        media_lifecycle.schedule_delete([local_path for local_path, _ in files])
+    except BaseException as e:
+        # TimeLimitExceeded / 进程退出等非 Exception 也要记录失败，否则流水线一直停在 running
+        fail_stage(post_id, f"published: {error_text(e)}")
+        if not isinstance(e, Exception):
+            raise
+
+
+@dramatiq.actor
+def resume_pipeline(post_id: int):
+    """ 从最后完成的阶段继续：未加密完成则重新进入转码（已完成的清晰度会被跳过），否则继续发布 """
+    # 延迟导入：segment_video 所在模块依赖本模块记录流水线状态
+    from app.tasks.process_convert_2_ts import segment_video
+
+    record = get_pipeline(post_id)
+    if not record or stage_reached(record, "published"):
+        return
+    # 接口层已拦截运行中的流水线（管理员除外），这里强制认领
+    if stage_reached(record, "encrypted"):
+        publish_media.send(post_id, force=True)
+    else:
+        artifacts = record["artifacts"]
+        segment_video.send(artifacts.get("source") or record["filename"], source_key=artifacts.get("source_key"),
+                           force=True)
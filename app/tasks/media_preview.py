@@ -0,0 +1,105 @@
+import os
+import math
+import subprocess
+from app.config import settings
+
+# 封面：跳过开头 1 秒（片头黑场），取第一个场景变化分数超过阈值的帧
+POSTER_SCENE_THRESHOLD = getattr(settings, "POSTER_SCENE_THRESHOLD", 0.3)
+POSTER_MAX_HEIGHT = 720
+# 进度条预览：每 THUMB_INTERVAL 秒一张缩略图，拼成 THUMB_COLS x THUMB_ROWS 的雪碧图
+THUMB_INTERVAL = getattr(settings, "THUMB_INTERVAL", 5)
+THUMB_WIDTH = 160
+THUMB_COLS = 10
+THUMB_ROWS = 10
+
+POSTER_NAME = "poster.jpg"
+SPRITE_PATTERN = "sprite_%03d.jpg"
+VTT_NAME = "thumbs.vtt"
+
+
+def thumb_size(width: int, height: int):
+    """ 缩略图固定宽度，高度按源宽高比取偶数 """
+    return THUMB_WIDTH, max(2, int(round(THUMB_WIDTH * height / width / 2)) * 2)
+
+
+def range_sprite_pattern(index: int) -> str:
+    """ 分段并行转码时每个区间各自输出一组雪碧图，文件名带区间序号 """
+    return f"sprite_r{index:03d}_%03d.jpg"
+
+
+def preview_filter_chains(poster_height: int, thumb_w: int, thumb_h: int, poster: bool = True) -> list:
+    """
+    与各清晰度共用同一次解码的预览滤镜链，输入为 split 出来的 [pp]（封面）和 [ps]（雪碧图）
+    输出标签为 [poster] 和 [sprite]；poster=False 时只生成雪碧图（分段转码中第一个区间以外的区间）
+    """
+    chains = [f"[ps]fps=1/{THUMB_INTERVAL},scale={thumb_w}:{thumb_h},tile={THUMB_COLS}x{THUMB_ROWS}[sprite]"]
+    if poster:
+        chains.insert(0, f"[pp]select='gte(t,1)*gt(scene,{POSTER_SCENE_THRESHOLD})',scale=-2:{poster_height}[poster]")
+    return chains
+
+
+def preview_output_args(out_dir: str, poster: bool = True, sprite_pattern: str = SPRITE_PATTERN) -> list:
+    args = ["-map", "[poster]", "-frames:v", "1", "-q:v", "3", os.path.join(out_dir, POSTER_NAME)] if poster else []
+    return args + ["-map", "[sprite]", "-q:v", "5", os.path.join(out_dir, sprite_pattern)]
+
+
+def extract_poster_fallback(input_path: str, out_dir: str, duration: float, poster_height: int):
+    """ 整片没有明显场景变化时封面为空：改取 10% 处的一帧（只 seek 解码一帧，不是第二次完整解码） """
+    poster_path = os.path.join(out_dir, POSTER_NAME)
+    if os.path.exists(poster_path):
+        return
+    subprocess.run(
+        ["ffmpeg", "-y", "-ss", str(round(duration * 0.1, 2)), "-i", input_path,
+         "-frames:v", "1", "-vf", f"scale=-2:{poster_height}", "-q:v", "3", poster_path],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True
+    )
+
+
+def _vtt_time(seconds: float) -> str:
+    hours, rem = divmod(seconds, 3600)
+    minutes, secs = divmod(rem, 60)
+    return f"{int(hours):02d}:{int(minutes):02d}:{secs:06.3f}"
+
+
+def _sheet_groups(duration: float, spans: list = None) -> list:
+    """ [(起点, 终点, 雪碧图文件名模板), ...]：整片一组，分段转码时每个区间一组 """
+    if spans is None:
+        return [(0, duration, SPRITE_PATTERN)]
+    return [(start, end, range_sprite_pattern(index)) for index, (start, end) in enumerate(spans)]
+
+
+def _thumb_count(start: float, end: float) -> int:
+    return max(1, math.ceil((end - start) / THUMB_INTERVAL))
+
+
+def write_thumbnail_vtt(out_dir: str, duration: float, thumb_w: int, thumb_h: int, spans: list = None):
+    """
+    WebVTT 缩略图轨：每个区间指向雪碧图中的一格（#xywh=x,y,w,h），图片路径相对于 vtt 文件
+    spans 不为空时（分段并行转码）每个区间的缩略图从区间起点重新计时，指向该区间自己的雪碧图
+    """
+    per_sheet = THUMB_COLS * THUMB_ROWS
+    lines = ["WEBVTT", ""]
+    for group_start, group_end, pattern in _sheet_groups(duration, spans):
+        for i in range(_thumb_count(group_start, group_end)):
+            start = group_start + i * THUMB_INTERVAL
+            end = min(start + THUMB_INTERVAL, group_end)
+            sheet, cell = divmod(i, per_sheet)
+            x, y = (cell % THUMB_COLS) * thumb_w, (cell // THUMB_COLS) * thumb_h
+            lines.append(f"{_vtt_time(start)} --> {_vtt_time(end)}")
+            lines.append(f"{pattern % (sheet + 1)}#xywh={x},{y},{thumb_w},{thumb_h}")
+            lines.append("")
+    with open(os.path.join(out_dir, VTT_NAME), "w", encoding="utf-8") as f:
+        f.write("\n".join(lines))
+
+
+def range_preview_files(spans: list) -> list:
+    """ 分段并行转码的预览文件名（封面、各区间雪碧图、vtt），与 write_thumbnail_vtt 引用的一致 """
+    per_sheet = THUMB_COLS * THUMB_ROWS
+    sprites = [pattern % (sheet + 1) for start, end, pattern in _sheet_groups(0, spans)
+               for sheet in range(math.ceil(_thumb_count(start, end) / per_sheet))]
+    return sorted([POSTER_NAME, VTT_NAME] + sprites)
+
+
+def preview_files(out_dir: str) -> list:
+    """ 预览目录中需要发布的文件名（封面、雪碧图、vtt） """
+    return sorted(name for name in os.listdir(out_dir) if name.endswith((".jpg", ".vtt")))
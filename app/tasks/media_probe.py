@@ -0,0 +1,197 @@
+import os
+import json
+import subprocess
+from collections import namedtuple
+
+# 码率阶梯中的一档：标签、输出高度、视频目标码率 / 峰值码率 / 缓冲区（kbit/s）、音频码率（kbit/s）
+Rendition = namedtuple("Rendition", ["label", "height", "video_kbps", "maxrate_kbps", "bufsize_kbps", "audio_kbps"])
+
+# 自适应码率阶梯（从低到高），CRF 编码并用 maxrate/bufsize 限制峰值码率
+ABR_LADDER = [
+    Rendition("360p", 360, 800, 856, 1200, 64),
+    Rendition("540p", 540, 1400, 1498, 2100, 96),
+    Rendition("720p", 720, 2800, 2996, 4200, 96),
+    Rendition("1080p", 1080, 5000, 5350, 7500, 128),
+]
+RENDITION_LABELS = [r.label for r in ABR_LADDER]
+
+
+def probe_media(input_path: str) -> dict:
+    """
+    一次 ffprobe 获取完整 JSON（format + streams），同一转码任务内复用，不再重复探测
+    """
+    result = subprocess.run(
+        ["ffprobe", "-v", "error", "-print_format", "json", "-show_format", "-show_streams", input_path],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True
+    )
+    try:
+        return json.loads(result.stdout or "{}")
+    except ValueError:
+        return {}
+
+
+def video_stream(probe: dict) -> dict:
+    return next((s for s in probe.get("streams", []) if s.get("codec_type") == "video"), {})
+
+
+def audio_stream(probe: dict) -> dict:
+    return next((s for s in probe.get("streams", []) if s.get("codec_type") == "audio"), {})
+
+
+def probe_duration(probe: dict) -> float:
+    """ 总时长（秒），失败返回 0 """
+    try:
+        return float(probe.get("format", {}).get("duration", 0))
+    except ValueError:
+        return 0.0
+
+
+def probe_size(probe: dict) -> int:
+    """ 文件大小（字节），失败返回 0 """
+    try:
+        return int(probe.get("format", {}).get("size", 0))
+    except ValueError:
+        return 0
+
+
+def probe_dimensions(probe: dict):
+    """ 视频宽高，探测失败时默认 1280x720 """
+    stream = video_stream(probe)
+    width, height = stream.get("width"), stream.get("height")
+    if not width or not height:
+        return 1280, 720
+    return int(width), int(height)
+
+
+def select_ladder(probe: dict) -> list:
+    """
+    根据源视频高度选择码率阶梯：只保留不高于源视频的档位（不做放大），
+    源视频低于最低档时只输出最低档，输出高度保持源视频高度（取偶数），标签与 OSS 目录仍沿用最低档
+    返回从高到低排列，第一档为最高清晰度
+    """
+    _, height = probe_dimensions(probe)
+    ladder = [r for r in ABR_LADDER if r.height <= height]
+    if not ladder:
+        ladder = [ABR_LADDER[0]._replace(height=max(2, height // 2 * 2))]
+    return list(reversed(ladder))
+
+
+def output_width(probe: dict, height: int) -> int:
+    """ 与 scale=-2:<height> 一致：按源宽高比计算输出宽度并取偶数 """
+    src_width, src_height = probe_dimensions(probe)
+    return int(round(src_width * height / src_height / 2)) * 2
+
+
+def probe_keyframe_times(input_path: str) -> list:
+    """ 只解复用不解码，读取视频流所有关键帧的时间戳（秒） """
+    result = subprocess.run(
+        ["ffprobe", "-v", "error", "-select_streams", "v:0",
+         "-show_entries", "packet=pts_time,flags", "-of", "csv=p=0", input_path],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True
+    )
+    times = []
+    for line in result.stdout.splitlines():
+        pts_time, _, flags = line.partition(",")
+        if "K" in flags:
+            try:
+                times.append(float(pts_time))
+            except ValueError:
+                continue
+    return sorted(times)
+
+
+def can_copy_video(probe: dict, rendition) -> bool:
+    """
+    源视频是否可以不重新编码直接作为该档输出：H.264、8bit yuv420p、高度与该档完全一致
+    """
+    stream = video_stream(probe)
+    return (
+        stream.get("codec_name") == "h264"
+        and stream.get("pix_fmt") in ("yuv420p", "yuvj420p")
+        and stream.get("profile") in ("Constrained Baseline", "Baseline", "Main", "High")
+        and int(stream.get("height") or 0) == rendition.height
+    )
+
+
+def can_copy_audio(probe: dict) -> bool:
+    """ 源音频为 AAC（或没有音轨）时可直接复制 """
+    stream = audio_stream(probe)
+    return not stream or stream.get("codec_name") == "aac"
+
+
+def gop_usable(keyframes: list, duration: float, segment_seconds: int) -> bool:
+    """
+    关键帧间隔是否适合直接按关键帧切片：最大间隔不超过目标切片时长的 1.5 倍
+    （HLS 只能在关键帧处切分，GOP 过长会产生超长分片，此时回退为重新编码）
+    """
+    if not keyframes or keyframes[0] > 0.5:
+        return False
+    points = keyframes + [duration] if duration else keyframes
+    max_gap = max((b - a for a, b in zip(points, points[1:])), default=0)
+    return max_gap <= segment_seconds * 1.5
+
+
+def hls_cut_times(keyframes: list, segment_seconds: int) -> list:
+    """
+    按 HLS 切片器的规则推算直接复制时的切分点：第 k 个切分点为不早于 k*切片时长的第一个关键帧
+    重新编码的档位在这些时间点强制关键帧，各档分片边界、分片数与时长保持一致
+    返回相对第一个关键帧的时间（秒），不含起点 0
+    """
+    if not keyframes:
+        return []
+    start, cuts = keyframes[0], []
+    for t in keyframes[1:]:
+        if t - start >= (len(cuts) + 1) * segment_seconds:
+            cuts.append(round(t - start, 3))
+    return cuts
+
+
+def master_playlist_path(base_output_dir: str, base_name: str) -> str:
+    return os.path.join(base_output_dir, "master", f"{base_name}.m3u8")
+
+
+# H.264 profile 对应 RFC 6381 codecs 字符串中的 profile_idc + constraint 字节
+H264_PROFILE_CODES = {"Constrained Baseline": "42e0", "Baseline": "4200", "Main": "4d40", "High": "6400"}
+# AAC profile 对应的 mp4a 对象类型
+AAC_PROFILE_CODES = {"LC": "mp4a.40.2", "HE-AAC": "mp4a.40.5", "HE-AACv2": "mp4a.40.29"}
+
+
+def encoder_level(rendition, fps: int) -> str:
+    """ 重新编码档位声明的 H.264 level：1080p 高于 30fps 需要 4.2，其余 4.0 足够 """
+    return "4.2" if rendition.height >= 1080 and fps > 30 else "4.0"
+
+
+def rendition_codecs(probe: dict, rendition, fps: int, copied: bool) -> str:
+    """
+    该档 HLS 输出的 CODECS 字符串（RFC 6381），例如 "avc1.640028,mp4a.40.2"
+    重新编码的档位固定 High profile + encoder_level；直接复制的档位取源视频的 profile / level，
+    音频直接复制时取源音频的 AAC profile，没有音轨时只有视频
+    """
+    if copied:
+        stream = video_stream(probe)
+        video = f"avc1.{H264_PROFILE_CODES[stream['profile']]}{int(stream.get('level') or 40):02x}"
+    else:
+        video = f"avc1.6400{int(float(encoder_level(rendition, fps)) * 10):02x}"
+    audio = audio_stream(probe)
+    if not audio:
+        return video
+    if copied and can_copy_audio(probe):
+        return f"{video},{AAC_PROFILE_CODES.get(audio.get('profile'), 'mp4a.40.2')}"
+    return f"{video},mp4a.40.2"
+
+
+def rendition_info(probe: dict, rendition, fps: int, copied: bool) -> dict:
+    """ 该档的分辨率与 CODECS（峰值码率在分片生成后按实际大小统计，见 segment_peak_bitrate） """
+    return {
+        "resolution": f"{output_width(probe, rendition.height)}x{rendition.height}",
+        "codecs": rendition_codecs(probe, rendition, fps, copied),
+    }
+
+
+def read_master_renditions(path: str) -> list:
+    """ 从 master.m3u8 读取本视频包含的清晰度标签（从低到高），文件不存在时返回空列表 """
+    if not os.path.exists(path):
+        return []
+    with open(path, "r", encoding="utf-8") as f:
+        uris = [line.strip() for line in f if line.strip() and not line.startswith("#")]
+    return [uri.split("/")[-2] for uri in uris if uri.count("/") >= 2]
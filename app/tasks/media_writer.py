@@ -0,0 +1,175 @@
+import json
+import datetime
+import threading
+import dramatiq
+from sqlalchemy import select
+from sqlalchemy.dialects.mysql import insert
+from app.config import settings
+from app.models.base import worker_engine, WorkerSessionLocal
+from app.models.media_pipeline_model import MediaPipeline
+from app.models.post_model import Post, PostVideo, MediaCollectionItem
+
+# 待写入的视频达到该数量立即批量写库
+MEDIA_WRITE_BATCH = getattr(settings, "MEDIA_WRITE_BATCH", 50)
+# 最多等待该时长（秒）即批量写库
+MEDIA_WRITE_INTERVAL = getattr(settings, "MEDIA_WRITE_INTERVAL", 2)
+
+
+def media_rows(media: dict, preview: str = None, rendition_info: str = None):
+    """
+    由视频描述（record_media_info 的返回值）生成 Post / PostVideo / MediaCollectionItem 三行
+    描述保存在流水线记录中（JSON），created_at 为 ISO 字符串；rendition_info 为各清晰度码率信息（JSON）
+    :return: (post, video, item)，非系统合集以外 item 为 None
+    """
+    dt = datetime.datetime.fromisoformat(media["created_at"])
+    post = {"id": media["post_id"], "user_id": media["user_id"], "post_type": "video", "created_at": dt}
+    video = {
+        "post_id": media["post_id"], "media_code": media["media_code"], "definition": media["definition"],
+        "content_hash": media["content_hash"], "renditions": media["renditions"],
+        "media_manifest": media["media_manifest"], "preview": preview, "rendition_info": rendition_info,
+        "uploaded_at": dt,
+    }
+    item = None
+    # 非系统合集才写入合集条目
+    if media["collection_code"] != "0000":
+        item = {"collection_id": int(media["collection_code"]), "post_id": media["post_id"], "sort_order": 0}
+    return post, video, item
+
+
+def write_media_rows(conn, rows: list):
+    """
+    在调用方的连接 / 会话（及其事务）内写入 media_rows 生成的行，
+    各表用一条 INSERT ... ON DUPLICATE KEY UPDATE，重复执行结果不变
+    """
+    posts = [post for post, _, _ in rows]
+    videos = [video for _, video, _ in rows]
+    items = [item for _, _, item in rows if item]
+
+    # 帖子已存在时保持原样（只补齐缺失的帖子）
+    stmt = insert(Post.__table__).values(posts)
+    conn.execute(stmt.on_duplicate_key_update(id=stmt.inserted.id))
+
+    stmt = insert(PostVideo.__table__).values(videos)
+    conn.execute(stmt.on_duplicate_key_update(
+        media_code=stmt.inserted.media_code,
+        definition=stmt.inserted.definition,
+        renditions=stmt.inserted.renditions,
+        media_manifest=stmt.inserted.media_manifest,
+        preview=stmt.inserted.preview,
+        rendition_info=stmt.inserted.rendition_info,
+        content_hash=stmt.inserted.content_hash,
+    ))
+
+    if items:
+        stmt = insert(MediaCollectionItem.__table__).values(items)
+        conn.execute(stmt.on_duplicate_key_update(sort_order=MediaCollectionItem.__table__.c.sort_order))
+
+
+def rendition_info(media: dict, renditions: dict) -> str:
+    """
+    各清晰度的峰值码率 / 分辨率 / CODECS（从低到高，JSON），客户端据此生成 master 播放列表并自适应切换
+    [{"l": "360p", "b": 912000, "res": "640x360", "c": "avc1.64001e,mp4a.40.2"}, ...]
+    """
+    infos = []
+    for label in media["renditions"].split(","):
+        info = renditions.get(label, {})
+        if info.get("bandwidth"):
+            infos.append({"l": label, "b": info["bandwidth"], "res": info["resolution"], "c": info["codecs"]})
+    return json.dumps(infos, separators=(",", ":")) if infos else None
+
+
+def pipeline_rows(pipeline: MediaPipeline):
+    """ 由已发布的流水线记录（视频描述、预览目录、各清晰度状态）生成待写入的三行 """
+    artifacts = json.loads(pipeline.artifacts or "{}")
+    media, preview = artifacts["media"], artifacts.get("preview")
+    return media_rows(media, preview["prefix"] if preview else None,
+                      rendition_info(media, json.loads(pipeline.renditions or "{}")))
+
+
+def flush_pending(limit: int = MEDIA_WRITE_BATCH) -> int:
+    """
+    流水线表即发件箱：发布完成的记录带 media_pending 标记，这里取出一批，
+    一个事务内各用一条多行 INSERT ... ON DUPLICATE KEY UPDATE 写入三表并清除标记。
+    SKIP LOCKED：多个进程同时 flush 时各取不同的记录；失败整体回滚，标记保留，下次重试
+    :return: 本次写入的视频数
+    """
+    db = WorkerSessionLocal()
+    try:
+        pipelines = db.execute(
+            select(MediaPipeline).where(MediaPipeline.media_pending.is_(True))
+            .order_by(MediaPipeline.updated_at).limit(limit).with_for_update(skip_locked=True)
+        ).scalars().all()
+        if not pipelines:
+            return 0
+        write_media_rows(db, [pipeline_rows(pipeline) for pipeline in pipelines])
+        for pipeline in pipelines:
+            pipeline.media_pending = False
+        db.commit()
+        return len(pipelines)
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+class MediaInfoWriter(dramatiq.Middleware):
+    """
+    worker 端媒体信息批量写入：待写入的行持久化在流水线表中（与发布阶段同一事务标记），
+    本进程累计 batch_size 个待写入或等待满 interval 秒时批量写库；
+    进程崩溃不会丢失，重启后（或其他进程的周期 flush）会写入残留的标记
+    """
+
+    def __init__(self, batch_size: int, interval: float):
+        self.batch_size = batch_size
+        self.interval = interval
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def after_worker_boot(self, broker, worker):
+        # 启动即 flush 一次：写入上次进程退出时残留的待写入记录
+        with self._lock:
+            self._start()
+        self._wakeup.set()
+
+    def notify(self):
+        """ 本进程有一个视频标记为待写入 """
+        with self._lock:
+            self._pending += 1
+            full = self._pending >= self.batch_size
+            self._start()
+        if full:
+            self._wakeup.set()
+
+    def _start(self):
+        # 调用方持有 self._lock
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="media-writer", daemon=True)
+            self._thread.start()
+
+    def _loop(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            with self._lock:
+                self._pending = 0
+            try:
+                while True:
+                    written = flush_pending(self.batch_size)
+                    if written:
+                        print(f"💾 批量写入媒体信息：{written} 个视频")
+                    if written < self.batch_size:
+                        break
+            except Exception as e:
+                print(f"❌ 批量写入媒体信息失败，稍后重试：{e}")
+
+
+media_writer = MediaInfoWriter(MEDIA_WRITE_BATCH, MEDIA_WRITE_INTERVAL)
+
+
+def write_media_info(media: dict, preview: str = None):
+    """ 单独一个事务同步写入（没有流水线记录的旧版加密路径使用） """
+    with worker_engine.begin() as conn:
+        write_media_rows(conn, [media_rows(media, preview)])
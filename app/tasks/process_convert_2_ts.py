@@ -1,13 +1,146 @@
 import os
-import subprocess
+import shutil
 import dramatiq
+from app.config import settings
+from app.services import upload_session, oss_upload
+from app.tasks.transcode_scheduler import transcode_scheduler, TRANSCODE_TIME_LIMIT
+from app.tasks.ffmpeg_progress import run_ffmpeg_with_progress
+from app.tasks.media_probe import (probe_media, probe_dimensions, probe_duration, probe_size, select_ladder,
+                                   probe_keyframe_times, can_copy_video, can_copy_audio, gop_usable,
+                                   hls_cut_times, encoder_level, rendition_info)
+from app.tasks.process_m3u8_crypto import (parse_filename, derive_media_keys, write_key_info,
+                                           finalize_encrypted_rendition, get_current_ym_prefix)
+from app.tasks import media_pipeline, media_lifecycle, media_preview
+from app.utils.media_manifest import parse_m3u8_segments, segment_peak_bitrate
 
-@dramatiq.actor
-def segment_video(file_path: str, mode: str = "time", value: int = None, fps: int = None):
+# 源视频时长不低于该值（秒）时按区间拆分并行编码（见 chunked_transcode）
+CHUNKED_TRANSCODE_MIN_DURATION = getattr(settings, "CHUNKED_TRANSCODE_MIN_DURATION", 15 * 60)
+
+
+def build_split_filter(ladder, fps: int, preview_chains: list = None) -> str:
+    """
+    构造 filter_complex：统一帧率后 split 成 N 路，每路缩放到对应清晰度，输出标签为 [v0]、[v1]...
+    例如：[0:v]fps=25,split=2[s0][s1];[s0]scale=-2:1080[v0];[s1]scale=-2:720[v1]
+    preview_chains 不为空时再按各链的输入标签多 split 出 [pp]（封面）、[ps]（雪碧图），预览图与各清晰度共用同一次解码
+    """
+    branches = [f"[s{i}]" for i in range(len(ladder))] + [chain[:chain.index("]") + 1] for chain in preview_chains or []]
+    chains = [f"[s{i}]scale=-2:{r.height}[v{i}]" for i, r in enumerate(ladder)] + (preview_chains or [])
+    return f"[0:v]fps={fps},split={len(branches)}{''.join(branches)};{';'.join(chains)}"
+
+
+def hls_output_args(rendition, value: int, fps: int, output_pattern: str, m3u8_file: str, threads: int,
+                    key_info_file: str = None, range_args: list = None, cut_times: list = None) -> list:
+    """
+    单个清晰度的编码 + HLS 输出参数（放在对应 -map 之后）
+    CRF 编码，按码率阶梯用 maxrate/bufsize 限制峰值码率；threads 为该编码器的线程预算
+    key_info_file 不为空时由 ffmpeg 直接输出 AES-128 加密分片
+    range_args 为分段转码时该区间的输出参数（时间戳偏移、帧数上限）
+    cut_times 不为空时只在这些时间点强制关键帧（与直接复制档位的切分点对齐），否则每 value 秒一个
+    """
+    if cut_times:
+        # 切分点间隔最长约 2.5 个切片时长，GOP 上限放宽到 3 倍，避免在切分点之间插入额外关键帧
+        gop = int(value * fps * 3)
+        force_key_frames = ",".join(f"{t:.3f}" for t in cut_times)
+    else:
+        gop = int(value * fps)
+        force_key_frames = f"expr:gte(t,n_forced*{value})"
+    return [
+        "-c:v", "libx264", "-preset", "veryfast", "-crf", "24",
+        # 固定 profile / level，客户端拿到的 CODECS（media_probe.rendition_codecs）与实际码流一致
+        "-profile:v", "high", "-level:v", encoder_level(rendition, fps), "-pix_fmt", "yuv420p",
+        "-maxrate", f"{rendition.maxrate_kbps}k", "-bufsize", f"{rendition.bufsize_kbps}k",
+        "-threads", str(threads), "-x264-params", f"threads={threads}",
+        "-g", str(gop),  # GOP 长度
+        "-keyint_min", str(int(value * fps)),
+        "-sc_threshold", "0",
+        "-c:a", "aac", "-b:a", f"{rendition.audio_kbps}k", "-ar", "44100", "-ac", "2",
+        "-flush_packets", "1",
+        "-movflags", "+faststart",
+        "-force_key_frames", force_key_frames,
+        *(range_args or []),
+        "-f", "hls",
+        "-hls_time", str(value),
+        "-hls_segment_type", "mpegts",
+        "-hls_playlist_type", "vod",
+        *hls_key_args(key_info_file),
+        "-hls_segment_filename", output_pattern,
+        m3u8_file
+    ]
+
+
+def hls_key_args(key_info_file: str = None) -> list:
+    return ["-hls_key_info_file", key_info_file] if key_info_file else []
+
+
+def hls_copy_args(rendition, copy_audio: bool, value: int, output_pattern: str, m3u8_file: str,
+                  key_info_file: str = None) -> list:
+    """
+    直接复制（remux）输出参数：视频流不重新编码，HLS 只能在源视频关键帧处切分；
+    音频为 AAC 时一并复制，否则只重新编码音频
+    """
+    audio_args = ["-c:a", "copy"] if copy_audio else ["-c:a", "aac", "-b:a", f"{rendition.audio_kbps}k", "-ar", "44100", "-ac", "2"]
+    return [
+        "-c:v", "copy",
+        *audio_args,
+        "-f", "hls",
+        "-hls_time", str(value),
+        "-hls_segment_type", "mpegts",
+        "-hls_playlist_type", "vod",
+        *hls_key_args(key_info_file),
+        "-hls_segment_filename", output_pattern,
+        m3u8_file
+    ]
+
+
+def plan_remux(input_path: str, probe: dict, ladder: list, value: int):
+    """
+    判断哪些档位可以走 remux 快速通道（-c copy）：
+    源视频为 H.264 且高度正好等于某一档，并且关键帧间隔适合按目标切片时长切分；
+    GOP 不可用时全部回退为重新编码
+    ladder 传入完整阶梯（含上次已完成的档位），保证续跑时切分点与已完成的档位一致
+    :return: (可直接复制的档位标签, 切分时间点)；所有档位共用一个 media_code，
+             有档位直接复制时其余档位必须在同样的时间点切分
+    """
+    candidates = {r.label for r in ladder if can_copy_video(probe, r)}
+    if not candidates:
+        return set(), []
+    keyframes = probe_keyframe_times(input_path)
+    if not gop_usable(keyframes, probe_duration(probe), value):
+        print(f"⚠️ 源视频关键帧间隔过长，{'/'.join(candidates)} 回退为重新编码")
+        return set(), []
+    return candidates, hls_cut_times(keyframes, value)
+
+
+def finalize_preview(preview_dir: str, base_name: str) -> dict:
+    """
+    把暂存的封面 / 雪碧图 / vtt 整个目录 rename 到流水线输出目录 preview/<年月>/<chunk_code>/
+    目录名使用 chunk_code，不暴露包含用户 ID 的原始文件名
+    :return: {"prefix": "<年月>/<chunk_code>/", "files": [...]}
+    """
+    chunk_code, _, _ = derive_media_keys(f"{base_name}.m3u8")
+    prefix = f"{get_current_ym_prefix()}{chunk_code}/"
+    target = os.path.join(media_pipeline.PIPELINE_OUTPUT_ROOT, "preview", prefix)
+    shutil.rmtree(target, ignore_errors=True)
+    os.makedirs(os.path.dirname(os.path.normpath(target)), exist_ok=True)
+    os.replace(preview_dir, target)
+    return {"prefix": prefix, "files": media_preview.preview_files(target)}
+
+
+def progress_task_id(base_name: str) -> str:
+    """ 转码进度推送的 task_id：按帖子区分（logs:post_<post_id>），无法解析时使用文件名 """
+    parsed = parse_filename(base_name)
+    return f"post_{parsed[2]}" if parsed else base_name
+
+
+@dramatiq.actor(time_limit=TRANSCODE_TIME_LIMIT)
+def segment_video(file_path: str, mode: str = "time", value: int = None, fps: int = None, source_key: str = None,
+                  force: bool = False):
     """
-    根据输入视频分辨率转换输出格式：
-      - 若源视频长边 ≥ 1080，则转换为 1080p 和 720p 两种格式；
-      - 否则只转换为 720p。
+    根据输入视频分辨率选择码率阶梯（ABR_LADDER：360p/540p/720p/1080p）：
+      - 输出所有不高于源视频高度的档位，源视频低于 360p 时按源视频高度只输出一档（不放大）；
+      - 各档的峰值码率 / 分辨率 / CODECS 随视频信息入库（rendition_info），客户端据此生成 master 播放列表；
+      - 源视频已是 H.264 且正好是某档分辨率、关键帧间隔合适时，该档直接 -c copy 按关键帧切片，不重新编码。
+    所有清晰度由同一个 ffmpeg 进程一次解码、split 后分别编码输出，源视频只解码、读取一次。
 
     同时支持两种切片模式：
       - mode=="time": 按时间切片，默认时长根据文件大小动态设置；
@@ -15,46 +148,67 @@ def segment_video(file_path: str, mode: str = "time", value: int = None, fps: in
 
     可选参数 fps 用于压缩模式下指定输出帧率（默认 25fps）。
 
-    输出 TS 分片文件存放在当前工作目录下的 /static/convert/vol/<格式>/，
-    输出文件名模板为 {原文件名}_segment_%03d.ts。
-    同时生成对应的 .m3u8 文件。
+    source_key 不为空时表示源文件由客户端直传到对象存储，file_path 仅作为文件名使用，
+    ffprobe / ffmpeg 通过预签名 URL 直接从对象存储拉流。
+
+    ffmpeg 通过 -hls_key_info_file 直接输出 AES-128 加密分片（key / IV 与 process_m3u8_file 一致），
+    先写到 /static/encryption/staging/<清晰度>/<原文件名>/（不在 watchdog 监听范围内），
+    完成后按顺序重命名为派生的 chunk 名并移入 /static/encryption/pipeline/<清晰度>/<年月>/，
+    不再生成明文切片，也不再需要第二遍读写加密。
+
+    每个帖子的进度记录在 media_pipelines 中：已加密完成的清晰度重试时不再转码，
+    全部完成后交给 publish_media 上传 OSS。上传完成接口直接投递本任务，watchdog 只做兜底，
+    同一帖子重复投递时由流水线记录认领去重（force=True 时强制认领）。
+
+    时长超过 CHUNKED_TRANSCODE_MIN_DURATION 的视频，整条阶梯连同预览图按关键帧对齐的区间拆成多个
+    transcode_range 任务并行编码，完成后由 stitch_ranges 拼接（见 chunked_transcode）。
     """
+    post_id = media_pipeline.post_id_of(file_path)
     try:
-        # 1. 获取源视频分辨率
-        ffprobe_cmd = [
-            "ffprobe", "-v", "error",
-            "-select_streams", "v:0",
-            "-show_entries", "stream=width,height",
-            "-of", "csv=p=0", file_path
-        ]
-        result = subprocess.run(ffprobe_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-        dims_str = result.stdout.strip()
-        try:
-            dims = dims_str.split(',')
-            if len(dims) >= 2:
-                width = int(dims[0])
-                height = int(dims[1])
-            else:
-                width = 0
-                height = int(dims[0])
-            print(f"获取视频分辨率：宽 {width} 像素, 高 {height} 像素")
-        except Exception as e:
-            print(f"获取视频分辨率失败，默认设为 1280x720：{e}")
-            width = 1280
-            height = 720
-
-        # 2. 根据长边判断输出格式
-        long_side = max(width, height)
-        # 2. 根据高度判断输出格式
-        formats = []
-        if height >= 1080:
-            formats.append(("1080p", "scale=-2:1080"))
-            formats.append(("720p", "scale=-2:720"))
-        else:
-            formats.append(("720p", "scale=-2:720"))
+        # 0. 秒传命中：相同内容已转码过，直接复用，跳过转码
+        session = upload_session.get_session(os.path.basename(file_path))
+        if session and session.get("duplicate_of"):
+            print(f"⏭️ 内容与帖子 {session['duplicate_of']} 相同，跳过转码：{file_path}")
+            return
+
+        # 本机磁盘超过高水位：暂不接收新转码，延后重新投递
+        if media_lifecycle.intake_paused():
+            print(f"⏸️ 磁盘空间紧张，{media_lifecycle.MEDIA_INTAKE_RETRY_DELAY}s 后重试：{file_path}")
+            # 参数用关键字传递：去重中间件按第二个位置参数去重，不能让所有延后任务共用 mode 作为 key
+            segment_video.send_with_options(
+                args=(file_path,), kwargs=dict(mode=mode, value=value, fps=fps, source_key=source_key, force=force),
+                delay=media_lifecycle.MEDIA_INTAKE_RETRY_DELAY * 1000,
+            )
+            return
+
+        record = None
+        if post_id:
+            record = media_pipeline.ensure_pipeline(file_path, source=file_path, source_key=source_key)
+            if media_pipeline.stage_reached(record, "encrypted"):
+                print(f"⏭️ 帖子 {post_id} 已完成转码加密，继续发布：{file_path}")
+                media_pipeline.publish_media.send(post_id)
+                return
+            if not media_pipeline.claim_stage(post_id, "transcoded", force=force):
+                post_id = None  # 其他任务正在处理，不能改写它的状态
+                return
+
+        input_path = file_path
+        if source_key:
+            input_path = oss_upload.presign_download_url(source_key)
+
+        # 1. 一次 ffprobe 取得完整媒体信息，本任务内复用
+        probe = probe_media(input_path)
+        width, height = probe_dimensions(probe)
+        print(f"获取视频分辨率：宽 {width} 像素, 高 {height} 像素")
+
+        # 2. 根据源视频高度选择码率阶梯（360p/540p/720p/1080p，不做放大）
+        ladder = select_ladder(probe)
+        # 上次已加密完成的清晰度不再转码
+        done = {r.label for r in ladder if record and media_pipeline.rendition_status(record, r.label) != "pending"}
+        pending = [r for r in ladder if r.label not in done]
 
         # 3. 设置切片默认参数
-        file_size = os.path.getsize(file_path)
+        file_size = probe_size(probe) or (oss_upload.object_size(source_key) if source_key else os.path.getsize(file_path))
         if value is None:
             if mode == "time":
                 if file_size < 100 * 1024 * 1024:
@@ -71,51 +225,128 @@ def segment_video(file_path: str, mode: str = "time", value: int = None, fps: in
         if fps is None:
             fps = 25  # 默认帧率
 
-        # 输出根目录：保持原有结构
         BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-        base_output_dir = os.path.join(BASE_DIR, "static", "convert", "vods")
-        print(f"工作目录:{base_output_dir}")
-        os.makedirs(base_output_dir, exist_ok=True)
 
         # 提取源文件基本名
         base_name = os.path.splitext(os.path.basename(file_path))[0]
 
-        # 4. 针对每种格式进行转码、切片并生成 .m3u8
-        for label, scale_filter in formats:
-            out_dir = os.path.join(base_output_dir, label)
-            os.makedirs(out_dir, exist_ok=True)
-            # output_pattern = os.path.join(out_dir, f"{base_name}_segment_%03d.ts")
-            output_pattern = os.path.join(out_dir, f"{base_name}_segment_%03d.ts")
-
-            m3u8_file = os.path.join(out_dir, f"{base_name}.m3u8")
-
-            # 构造 ffmpeg 命令（直接生成 HLS）
-            command = [
-                "ffmpeg", "-i", file_path,
-                "-r", str(fps),
-                "-vf", scale_filter,
-                "-c:v", "libx264", "-preset", "veryfast", "-crf", "24",
-                "-g", str(int(value * fps)),  # GOP 长度
-                "-keyint_min", str(int(value * fps)),
-                "-sc_threshold", "0",
-                "-c:a", "aac", "-b:a", "96k", "-ar", "44100", "-ac", "2",
-                "-flush_packets", "1",
-                "-movflags", "+faststart",
-                "-force_key_frames", f"expr:gte(t,n_forced*{value})",
-                "-f", "hls",
-                "-hls_time", str(value),
-                "-hls_segment_type", "mpegts",
-                "-hls_playlist_type", "vod",
-                "-hls_segment_filename", output_pattern,
-                m3u8_file
-            ]
-
-            print(f"【{label}】执行命令: {' '.join(command)}")
-            subprocess.run(command, check=True)
-            print(f"【{label}】视频转码及切片完成：{file_path}，切片模式：{mode}，值：{value}，FPS: {fps}")
-
-    except Exception as e:
-        print(f"处理视频 {file_path} 时出错：{e}")
+        # 加密暂存目录与 key info（chunk_code / token / key 均由 m3u8 文件名派生）
+        staging_root = os.path.join(BASE_DIR, "static", "encryption", "staging")
+        _, token, encryption_key = derive_media_keys(f"{base_name}.m3u8")
+
+        # 4. 单次解码：split 滤镜把解码后的画面分发给各个清晰度，一个 ffmpeg 进程同时输出所有 HLS
+        #    由调度器控制本机同时转码数量，并给解码 / 滤镜 / 每个编码器分配明确的线程数
+        # 已经是目标分辨率的 H.264 源直接复制视频流，只转码真正需要重新编码的档位，
+        # 重新编码的档位在直接复制的切分点强制关键帧，所有档位分片对齐，共用一份 media_code
+        # 长视频按区间分段转码只能按固定间隔切分，整条阶梯都重新编码，不与直接复制混用
+        long_video = bool(post_id) and probe_duration(probe) >= CHUNKED_TRANSCODE_MIN_DURATION
+        copied, cut_times = (set(), []) if long_video else plan_remux(input_path, probe, ladder, value)
+        copied &= {r.label for r in pending}
+        encoded = [r for r in pending if r.label not in copied]
+        copy_audio = can_copy_audio(probe)
+        rendition_labels = [r.label for r in sorted(ladder, key=lambda r: r.height)]
+
+        # 封面 / 雪碧图 / WebVTT 缩略图轨在同一次解码中输出（上次已生成则跳过）
+        preview = record["artifacts"].get("preview") if record else None
+        thumb_w, thumb_h = media_preview.thumb_size(width, height)
+        poster_height = min(media_preview.POSTER_MAX_HEIGHT, ladder[0].height)
+
+        # 长视频：按区间拆成多个任务并行编码（可分布到多台主机），预览图也由各区间在同一次解码中生成，
+        # 本任务不再解码，全部区间完成后由 stitch_ranges 拼接
+        if long_video and encoded:
+            # 延迟导入：区间任务模块复用本模块的 ffmpeg 参数构造
+            from app.tasks import chunked_transcode
+            preview_plan = None if preview else {"thumb": [thumb_w, thumb_h], "poster_height": poster_height}
+            chunked_transcode.start_chunked(post_id, record, file_path, source_key, probe_duration(probe),
+                                            value, fps, encoded, rendition_labels,
+                                            {r.label: rendition_info(probe, r, fps, False) for r in encoded},
+                                            preview_plan)
+            # 本机上传的源文件已传到对象存储，各区间从对象存储读取
+            media_lifecycle.schedule_delete([None if source_key else file_path])
+            return
+
+        with_preview = preview is None and bool(pending)
+        preview_dir = os.path.join(staging_root, "preview", base_name)
+        preview_chains = media_preview.preview_filter_chains(poster_height, thumb_w, thumb_h) if with_preview else None
+
+        labels = "/".join(r.label + ("(copy)" if r.label in copied else "") for r in pending)
+        with transcode_scheduler.slot(f"{base_name} [{labels}]") as threads:
+            encoder_threads = transcode_scheduler.encoder_threads(len(encoded))
+            command = ["ffmpeg", "-threads", str(threads), "-i", input_path]
+            if encoded or with_preview:
+                command += [
+                    "-filter_complex_threads", str(min(threads, 2)),
+                    "-filter_complex", build_split_filter(encoded, fps, preview_chains),
+                ]
+            staging = {}
+            for rendition in pending:
+                out_dir = os.path.join(staging_root, rendition.label, base_name)
+                shutil.rmtree(out_dir, ignore_errors=True)  # 清理上次失败残留的分片
+                os.makedirs(out_dir, exist_ok=True)
+                key_info_file = write_key_info(out_dir, token, encryption_key)
+                output_pattern = os.path.join(out_dir, "segment_%05d.ts")
+                m3u8_file = os.path.join(out_dir, f"{base_name}.m3u8")
+                staging[rendition.label] = m3u8_file
+                if rendition.label in copied:
+                    command += ["-map", "0:v:0", "-map", "0:a?"]
+                    command += hls_copy_args(rendition, copy_audio, value, output_pattern, m3u8_file, key_info_file)
+                else:
+                    command += ["-map", f"[v{encoded.index(rendition)}]", "-map", "0:a?"]
+                    command += hls_output_args(rendition, value, fps, output_pattern, m3u8_file, encoder_threads,
+                                               key_info_file, cut_times=cut_times)
+            if with_preview:
+                shutil.rmtree(preview_dir, ignore_errors=True)
+                os.makedirs(preview_dir, exist_ok=True)
+                command += media_preview.preview_output_args(preview_dir)
+
+            if pending or with_preview:
+                print(f"【{labels}】执行命令: {' '.join(command)}")
+                run_ffmpeg_with_progress(command, progress_task_id(base_name), probe_duration(probe))
+        print(f"【{labels}】视频转码及切片完成：{file_path}，切片模式：{mode}，值：{value}，FPS: {fps}")
+
+        # 封面没有命中场景变化时补取一帧，写出 vtt 后整个目录移入流水线输出目录
+        if with_preview:
+            duration = probe_duration(probe)
+            media_preview.extract_poster_fallback(input_path, preview_dir, duration, poster_height)
+            media_preview.write_thumbnail_vtt(preview_dir, duration, thumb_w, thumb_h)
+            preview = finalize_preview(preview_dir, base_name)
+            if post_id:
+                media_pipeline.update_artifacts(post_id, preview=preview)
+
+        # 5. 加密分片已由 ffmpeg 写好：按顺序重命名移入流水线输出目录，生成 media_code 入库
+        #    所有清晰度共用一份 media_code，分片数不一致说明切分点没有对齐，不能发布
+        chunk_counts = {label: record["renditions"][label]["chunks"] for label in done} if record else {}
+        chunk_counts.update({label: len(parse_m3u8_segments(m3u8_file)) for label, m3u8_file in staging.items()})
+        if len(set(chunk_counts.values())) > 1:
+            raise RuntimeError(f"各清晰度分片数不一致，不能共用 media_code：{chunk_counts}")
+        renditions = {r.label: r for r in pending}
+        for label, m3u8_file in staging.items():
+            # 峰值码率按实际分片大小统计（直接复制的档位没有 maxrate 上限），连同分辨率 / CODECS 供客户端自适应切换
+            info = dict(rendition_info(probe, renditions[label], fps, label in copied),
+                        bandwidth=segment_peak_bitrate(m3u8_file))
+            media, chunks, ym = finalize_encrypted_rendition(m3u8_file, f"{base_name}.m3u8", label, rendition_labels,
+                                                             media_pipeline.PIPELINE_OUTPUT_ROOT)
+            shutil.rmtree(os.path.dirname(m3u8_file), ignore_errors=True)
+            if post_id:
+                # 视频描述随清晰度状态一起写入流水线记录，发布阶段上传完成后再入库
+                media_pipeline.update_rendition(post_id, label, artifacts={"media": media}, status="encrypted",
+                                                chunks=chunks, ym=ym, m3u8=f"{base_name}.m3u8", uploaded=0, **info)
+            print(f"🔐 {label} 加密分片已就绪，media_code: {media['media_code']}")
+
+        # 6. 交给发布阶段上传 OSS；原始上传文件已不再需要，保留期后清理
+        if post_id:
+            media_pipeline.complete_stage(post_id, "transcoded")
+            media_pipeline.complete_stage(post_id, "encrypted")
+            media_pipeline.publish_media.send(post_id)
+        media_lifecycle.schedule_delete([None if source_key else file_path])
+
+    except BaseException as e:
+        # TimeLimitExceeded 等非 Exception 也要记录失败，否则流水线一直停在 running
+        print(f"处理视频 {file_path} 时出错：{media_pipeline.error_text(e)}")
+        if post_id:
+            media_pipeline.fail_stage(post_id, f"transcoded: {media_pipeline.error_text(e)}")
+        if not isinstance(e, Exception):
+            raise
 
 
 if __name__ == "__main__":
@@ -5,72 +5,24 @@ import json
 import base64
 import hashlib
 import hmac
+from concurrent.futures import ThreadPoolExecutor
 from Crypto.Cipher import AES
 from typing import Tuple
 from app.config import settings
-from app.models.user_model import User
-from app.models.base import get_async_db
 from app.core.logger import log_event
+from app.services import upload_session
+from app.tasks.media_writer import write_media_info
+from app.utils.media_manifest import parse_m3u8_segments, encode_manifest
+from app.tasks.media_probe import RENDITION_LABELS, master_playlist_path, read_master_renditions
 import datetime
-from sqlalchemy.future import select
-from app.models import PostVideo, MediaCollectionItem,Post
-from sqlalchemy.ext.asyncio import AsyncSession
-import asyncio
 
 # 获取项目根目录
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
-def inster_mediainfo(user_id, post_id, dt, collection_code, media_code, definition=False):
-    async def write_db():
-        async with get_async_db() as db:
-            # ✅ 检查 Post 是否存在（必须存在才能有 user_id）
-            result = await db.execute(select(Post).where(Post.id == post_id))
-            post = result.scalars().first()
-
-            if not post:
-                post = Post(
-                    id=post_id,
-                    user_id=user_id,
-                    post_type="video",  # 你也可以动态传入
-                    created_at=dt
-                )
-                db.add(post)
-
-            # ✅ 插入 PostVideo（确保视频一对一）
-            result = await db.execute(select(PostVideo).where(PostVideo.post_id == post_id))
-            post_video = result.scalars().first()
-            if not post_video:
-                post_video = PostVideo(
-                    post_id=post_id,
-                    media_code=media_code,
-                    definition=definition,
-                    uploaded_at=dt
-                )
-                db.add(post_video)
-
-            # ✅ 插入 MediaCollectionItem（非系统合集）
-            if collection_code != "0000":
-                collection_id = int(collection_code)
-                result = await db.execute(select(MediaCollectionItem).where(
-                    MediaCollectionItem.collection_id == collection_id,
-                    MediaCollectionItem.post_id == post_id
-                ))
-                existing = result.scalars().first()
-                if not existing:
-                    collection_item = MediaCollectionItem(
-                        collection_id=collection_id,
-                        post_id=post_id,
-                        sort_order=0
-                    )
-                    db.add(collection_item)
-
-            await db.commit()
-
-    # ⚠️ 注意：这个方法是 async 内嵌的，但没有调用
-    # 所以在外部使用的时候要调用它：
-    # await inster_mediainfo(...).write_db()
-    return write_db
-
+# 分片加密并发线程数（pycryptodome 加密时释放 GIL，多线程可并行利用多核）
+MEDIA_ENCRYPT_WORKERS = getattr(settings, "MEDIA_ENCRYPT_WORKERS", min(4, os.cpu_count() or 1))
+# 流式加密每次读取的块大小（必须是 16 的整数倍）
+MEDIA_ENCRYPT_BLOCK = getattr(settings, "MEDIA_ENCRYPT_BLOCK", 1024 * 1024)
 
 def parse_filename(filename: str):
     pattern = r"u(\d+)_(\d{8})_(\d+)_(\d{4})"
@@ -104,32 +56,41 @@ def generate_chunk_name(chunk_code: str, index: int) -> str:
     return base64.urlsafe_b64encode(hash_digest).decode().rstrip("=")[:16] + ".mct"
 
 
+# 与播放端约定的固定 IV（ffmpeg 的 key info 文件第三行使用其十六进制形式）
+AES_IV = b'1234567890123456'
+
+
 def pad(data: bytes) -> bytes:
     pad_len = 16 - len(data) % 16
     return data + bytes([pad_len] * pad_len)
 
 
-def encrypt_aes128(input_path: str, output_path: str, key: bytes):
-    cipher = AES.new(key, AES.MODE_CBC, iv=b'1234567890123456')
-    with open(input_path, 'rb') as f:
-        plaintext = f.read()
-    padded = pad(plaintext)
-    ciphertext = cipher.encrypt(padded)
-    with open(output_path, 'wb') as f:
-        f.write(ciphertext)
+def encrypt_aes128(input_path: str, output_path: str, key: bytes, block_size: int = MEDIA_ENCRYPT_BLOCK):
+    """
+    流式 AES-128-CBC 加密：按 block_size 分块读写，CBC 状态由 cipher 对象跨块延续，
+    只在最后一块做 PKCS7 填充，结果与整体读入后 pad + encrypt 完全一致，内存占用与分片大小无关
+    """
+    cipher = AES.new(key, AES.MODE_CBC, iv=AES_IV)
+    with open(input_path, 'rb') as src, open(output_path, 'wb') as dst:
+        block = src.read(block_size)
+        while True:
+            next_block = src.read(block_size)
+            if not next_block:
+                dst.write(cipher.encrypt(pad(block)))
+                break
+            dst.write(cipher.encrypt(block))
+            block = next_block
 
 
 def shorten_floats(float_list, precision=1):
     return [round(f, precision) for f in float_list]
 
 
-def process_m3u8_file(m3u8_path: str, output_root: str = None) -> Tuple[str, str]:
-    with open(m3u8_path, "r", encoding="utf-8") as f:
-        lines = f.readlines()
-
-    ts_files = [line.strip() for line in lines if line.strip().endswith(".ts")]
-    m3u8_dir = os.path.dirname(m3u8_path)
-    base_filename = os.path.basename(m3u8_path)
+def derive_media_keys(base_filename: str):
+    """
+    由 m3u8 文件名派生 chunk_code、token 与 AES key（与解密端 /decode/{token} 保持一致）
+    :return: (chunk_code, token, encryption_key)
+    """
     chunk_code = generate_chunk_code(base_filename)
 
     # ✅ 先生成 token（基于 chunk_code）
@@ -139,40 +100,130 @@ def process_m3u8_file(m3u8_path: str, output_root: str = None) -> Tuple[str, str
 
     # ✅ 然后用 token 派生 encryption_key（与解密端保持一致）
     encryption_key = hmac.new(to_bytes(settings.MEDIA_SECRET_KEY), token.encode(), hashlib.sha256).digest()[:16]
+    return chunk_code, token, encryption_key
+
+
+def encryption_output_dir(resolution: str, current_ym_prefix: str, output_root: str = None) -> str:
+    if output_root:
+        output_dir = os.path.join(output_root, resolution, current_ym_prefix)
+    else:
+        output_dir = os.path.join(BASE_DIR, "static", "encryption", "vods", resolution, current_ym_prefix)
+    os.makedirs(output_dir, exist_ok=True)
+    return output_dir
+
+
+def write_key_info(staging_dir: str, token: str, encryption_key: bytes) -> str:
+    """
+    生成 ffmpeg -hls_key_info_file 所需文件：第一行 key URI（token），第二行 key 文件路径，第三行 IV
+    key 文件只存在于暂存目录（不在监听/上传目录中），转码完成后随暂存目录一起删除
+    """
+    key_path = os.path.join(staging_dir, "media.key")
+    with open(key_path, "wb") as f:
+        f.write(encryption_key)
+    key_info_path = os.path.join(staging_dir, "media.keyinfo")
+    with open(key_info_path, "w", encoding="utf-8") as f:
+        f.write(f"{token}\n{key_path}\n{AES_IV.hex()}\n")
+    return key_info_path
+
+
+def record_media_info(base_filename: str, chunk_count: int, durations: list, chunk_code: str, token: str,
+                      current_ym_prefix: str, labels: list, discontinuities: list = None) -> dict:
+    """
+    生成 media_code 与二进制清单，返回视频描述（可 JSON 序列化）
+    分片时长只写入清单（media_manifest），旧版 media_code 保持 "s" 为空，避免超出 String(255)
+    discontinuities 为分段并行转码拼接处的分片序号，写入清单供播放器插入 #EXT-X-DISCONTINUITY
+    描述不在这里入库：流水线在发布阶段分片全部上传后，与阶段状态在同一事务内写入（见 media_writer）
+    """
+    media_info = {
+        "v": 3,
+        "t": 8,
+        "s": [],
+        "c": chunk_count,
+        "m": chunk_code,
+        "e": token,
+        "d":current_ym_prefix
+    }
+
+    media_json = json.dumps(media_info, separators=(",", ":"))
+    media = {
+        "media_code": base64.urlsafe_b64encode(media_json.encode()).decode().rstrip("="),
+        "media_manifest": encode_manifest(shorten_floats(durations), chunk_code, token, current_ym_prefix,
+                                          discontinuities),
+        "renditions": ",".join(labels),
+        "definition": "1080p" in labels,
+    }
+    parsed = parse_filename(base_filename)
+    if parsed:
+        user_id, dt, post_id, collection_code = parsed
+        # 原始上传文件的 SHA-256（上传完成时已算好），写入后供后续秒传去重
+        session = upload_session.get_session(base_filename.replace(".m3u8", ".mp4"))
+        media.update(user_id=user_id, post_id=post_id, created_at=dt.isoformat(), collection_code=collection_code,
+                     content_hash=session.get("sha256") if session else None)
+    return media
+
+
+def finalize_encrypted_rendition(staging_m3u8: str, base_filename: str, resolution: str, labels: list,
+                                 output_root: str = None, current_ym_prefix: str = None):
+    """
+    ffmpeg 已直接输出 AES-128 加密分片（-hls_key_info_file）时的收尾：
+    按播放列表顺序把暂存目录中的分片重命名（同一文件系统内 rename，不再读写数据）为派生的 chunk 名，
+    然后生成视频描述（由发布阶段入库）。不再需要 process_m3u8_file 的第二遍加密
+    current_ym_prefix 为空时取当前年月（分段并行转码时由规划阶段统一指定，保证各清晰度一致）
+    :return: (视频描述, 分片数, 年月前缀)
+    """
+    chunk_code, token, _ = derive_media_keys(base_filename)
+    staging_dir = os.path.dirname(staging_m3u8)
+    current_ym_prefix = current_ym_prefix or get_current_ym_prefix()
+    output_dir = encryption_output_dir(resolution, current_ym_prefix, output_root)
+
+    segments = parse_m3u8_segments(staging_m3u8)
+    for i, (segment, _) in enumerate(segments):
+        os.replace(os.path.join(staging_dir, segment), os.path.join(output_dir, generate_chunk_name(chunk_code, i)))
+
+    durations = [duration for _, duration in segments]
+    media = record_media_info(base_filename, len(segments), durations, chunk_code, token, current_ym_prefix, labels)
+    return media, len(segments), current_ym_prefix
+
+
+def process_m3u8_file(m3u8_path: str, output_root: str = None) -> Tuple[str, str]:
+    segments = parse_m3u8_segments(m3u8_path)
+    ts_files = [ts_file for ts_file, _ in segments]
+    m3u8_dir = os.path.dirname(m3u8_path)
+    base_filename = os.path.basename(m3u8_path)
+    chunk_code, token, encryption_key = derive_media_keys(base_filename)
 
     # ✅ 构建解密用 key URI
     # key_uri = f"http://127.0.0.1:1992/mbticompass/decode/{token}"
 
     # 构建 key URI
-    durations = []
+    durations = [duration for _, duration in segments]
     chunk_map = {}
     for i, ts_file in enumerate(ts_files):
         chunk_name = generate_chunk_name(chunk_code, i)
         chunk_map[ts_file] = chunk_name
 
-    # 目标输出目录（按 720p/1080p 自动分类）
+    # 目标输出目录（按清晰度目录 360p/540p/720p/1080p 自动分类）
     rel = os.path.normpath(m3u8_path).split(os.sep)
-    resolution = "720p" if "720p" in rel else "1080p"
+    resolution = next((label for label in RENDITION_LABELS if label in rel), "720p")
 
-    definition = False
-    if "1080p" in rel:
-        definition=True
+    # 本视频的清晰度列表来自转码阶段生成的 master.m3u8，缺失时只记录当前清晰度
+    labels = read_master_renditions(master_playlist_path(os.path.dirname(m3u8_dir), base_filename[:-len(".m3u8")]))
+    labels = labels or [resolution]
 
     current_ym_prefix = get_current_ym_prefix()
-    if output_root:
-        output_dir = os.path.join(output_root, resolution,current_ym_prefix)
-    else:
-        output_dir = os.path.join(BASE_DIR, "static", "encryption", "vods", resolution,current_ym_prefix)
+    output_dir = encryption_output_dir(resolution, current_ym_prefix, output_root)
 
-    os.makedirs(output_dir, exist_ok=True)
-
-    # 加密 TS 并输出
-    for ts_file, chunk_name in chunk_map.items():
+    # 加密 TS 并输出（线程池并发处理各分片，任一分片失败时抛出异常）
+    def encrypt_segment(item):
+        ts_file, chunk_name = item
         original_path = os.path.join(m3u8_dir, ts_file)
         if os.path.exists(original_path):
             encrypted_path = os.path.join(output_dir, chunk_name)
             encrypt_aes128(original_path, encrypted_path, encryption_key)
 
+    with ThreadPoolExecutor(max_workers=MEDIA_ENCRYPT_WORKERS) as executor:
+        list(executor.map(encrypt_segment, chunk_map.items()))
+
     # 构建新 m3u8 文件
     # new_lines = []
     # for line in lines:
@@ -196,23 +247,12 @@ def process_m3u8_file(m3u8_path: str, output_root: str = None) -> Tuple[str, str
     # with open(new_m3u8_path, "w", encoding="utf-8") as f:
     #     f.writelines(new_lines)
 
-
-    media_info = {
-        "v": 3,
-        "t": 8,
-        "s": shorten_floats(durations),
-        "c": len(ts_files),
-        "m": chunk_code,
-        "e": token,
-        "d":current_ym_prefix
-    }
-
-    media_json = json.dumps(media_info, separators=(",", ":"))
-    parsed = parse_filename(base_filename)
-    media_code = base64.urlsafe_b64encode(media_json.encode()).decode().rstrip("=")
-    if parsed:
-        user_id, dt, post_id, collection_code = parsed
-        inster_mediainfo(user_id, post_id, dt, collection_code, media_code,definition)
+    # 旧版路径没有流水线记录：加密完成后同步入库
+    media = record_media_info(base_filename, len(ts_files), durations, chunk_code, token,
+                              current_ym_prefix, labels)
+    if "post_id" in media:
+        write_media_info(media)
+    media_code = media["media_code"]
 
     # return new_m3u8_path, media_code
-    return media_code
\ No newline at end of file
+    return media_code
@@ -0,0 +1,58 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from app.config import settings
+
+# 本机 CPU 核数
+CPU_CORES = os.cpu_count() or 1
+# 本机 dramatiq worker 进程数（与启动参数 --processes 保持一致）
+TRANSCODE_WORKER_PROCESSES = getattr(settings, "TRANSCODE_WORKER_PROCESSES", 1)
+# 每个转码任务希望使用的线程数，决定本机可同时运行的转码数
+TRANSCODE_THREADS_PER_JOB = getattr(settings, "TRANSCODE_THREADS_PER_JOB", 4)
+# 转码 / 发布类任务的 dramatiq 时间上限（毫秒）：任务在 slot() 中排队的时间也计入，
+# 必须远大于默认的 10 分钟，否则排队中的长视频会被 TimeLimitExceeded 中断
+TRANSCODE_TIME_LIMIT = getattr(settings, "TRANSCODE_TIME_LIMIT", 24 * 3600 * 1000)
+
+
+class TranscodeScheduler:
+    """
+    CPU 感知的转码调度器：
+      - 根据核数计算同时运行的转码数量，超出的任务在此排队等待，避免多个 libx264 抢占全部核心；
+      - 为每个 ffmpeg 进程分配明确的线程预算（解码 / 每个编码器）。
+    """
+
+    def __init__(self, cores: int, processes: int, threads_per_job: int):
+        cores_per_process = max(1, cores // max(1, processes))
+        self.max_concurrent = max(1, cores_per_process // max(1, threads_per_job))
+        self.threads_per_job = max(1, cores_per_process // self.max_concurrent)
+        self._slots = threading.BoundedSemaphore(self.max_concurrent)
+        self._lock = threading.Lock()
+        self.running = 0
+        self.waiting = 0
+
+    @contextmanager
+    def slot(self, name: str):
+        """ 占用一个转码名额，返回本任务的线程预算 """
+        with self._lock:
+            self.waiting += 1
+        queued_at = time.monotonic()
+        print(f"⏳ 转码排队：{name}（运行中 {self.running}/{self.max_concurrent}，排队 {self.waiting}）")
+        self._slots.acquire()
+        with self._lock:
+            self.waiting -= 1
+            self.running += 1
+        print(f"▶️ 开始转码：{name}，等待 {time.monotonic() - queued_at:.1f}s，线程预算 {self.threads_per_job}")
+        try:
+            yield self.threads_per_job
+        finally:
+            with self._lock:
+                self.running -= 1
+            self._slots.release()
+
+    def encoder_threads(self, renditions: int) -> int:
+        """ 一个 ffmpeg 同时输出多个清晰度时，每个 libx264 编码器分到的线程数 """
+        return max(1, self.threads_per_job // max(1, renditions))
+
+
+transcode_scheduler = TranscodeScheduler(CPU_CORES, TRANSCODE_WORKER_PROCESSES, TRANSCODE_THREADS_PER_JOB)
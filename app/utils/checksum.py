@@ -0,0 +1,52 @@
+import zlib
+
+try:
+    import crc32c as _crc32c  # 可选依赖：pip install crc32c
+except ImportError:
+    _crc32c = None
+
+try:
+    import xxhash as _xxhash  # 可选依赖：pip install xxhash
+except ImportError:
+    _xxhash = None
+
+
+class ChunkChecksum:
+    """
+    分片校验和，支持流式 update
+    客户端格式为 "<算法>:<十六进制值>"，例如 "crc32c:1a2b3c4d"、"xxh64:..."，不带算法前缀时按 crc32 处理
+    """
+
+    def __init__(self, spec: str):
+        algo, _, expected = spec.strip().rpartition(":")
+        self.algo = (algo or "crc32").lower()
+        self.expected = expected.lower()
+        self._value = 0
+        self._hasher = None
+        if self.algo == "crc32":
+            pass
+        elif self.algo == "crc32c":
+            if _crc32c is None:
+                raise ValueError("服务端未安装 crc32c，无法校验 crc32c")
+        elif self.algo == "xxh64":
+            if _xxhash is None:
+                raise ValueError("服务端未安装 xxhash，无法校验 xxh64")
+            self._hasher = _xxhash.xxh64()
+        else:
+            raise ValueError(f"不支持的校验算法: {self.algo}")
+
+    def update(self, data: bytes):
+        if self.algo == "crc32":
+            self._value = zlib.crc32(data, self._value)
+        elif self.algo == "crc32c":
+            self._value = _crc32c.crc32c(data, self._value)
+        else:
+            self._hasher.update(data)
+
+    def hexdigest(self) -> str:
+        if self._hasher is not None:
+            return self._hasher.hexdigest()
+        return f"{self._value & 0xFFFFFFFF:08x}"
+
+    def matches(self) -> bool:
+        return self.hexdigest() == self.expected.zfill(len(self.hexdigest()))
@@ -0,0 +1,107 @@
+import os
+import re
+import base64
+
+# 二进制清单版本号，格式变更时递增，解码端按版本分支
+MANIFEST_VERSION = 1
+# 分段并行转码拼接的视频：在版本 1 之后追加不连续点（EXT-X-DISCONTINUITY）列表
+MANIFEST_VERSION_DISCONTINUITY = 2
+
+# #EXTINF:<时长>,[标题]\n<分片 URI>
+_EXTINF_RE = re.compile(r"^#EXTINF:([0-9.]+)[^\n]*\n(?:#[^\n]*\n)*([^#\s][^\n]*)", re.MULTILINE)
+
+
+def parse_m3u8_segments(m3u8_path: str) -> list:
+    """ 解析 m3u8，按顺序返回 [(分片文件名, 时长), ...]；整份读入后用一个正则提取，不逐行判断 """
+    with open(m3u8_path, "r", encoding="utf-8") as f:
+        text = f.read().replace("\r\n", "\n")
+    return [(uri.strip(), float(duration)) for duration, uri in _EXTINF_RE.findall(text)]
+
+
+def segment_peak_bitrate(m3u8_path: str) -> int:
+    """
+    按 HLS 规范的 BANDWIDTH 定义统计峰值码率（bit/s）：各分片 文件大小 / 时长 的最大值
+    不足 0.5 秒的尾片容器开销占比过高，不参与统计（只有这一片时除外）
+    """
+    m3u8_dir = os.path.dirname(m3u8_path)
+    rates = [(os.path.getsize(os.path.join(m3u8_dir, segment)) * 8 / duration, duration)
+             for segment, duration in parse_m3u8_segments(m3u8_path) if duration > 0]
+    full = [rate for rate, duration in rates if duration >= 0.5] or [rate for rate, _ in rates]
+    return int(max(full, default=0))
+
+
+def _write_varint(out: bytearray, value: int):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data: bytes, pos: int):
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def _write_str(out: bytearray, value: str):
+    raw = value.encode()
+    _write_varint(out, len(raw))
+    out += raw
+
+
+def _read_str(data: bytes, pos: int):
+    length, pos = _read_varint(data, pos)
+    return data[pos:pos + length].decode(), pos + length
+
+
+def encode_manifest(durations: list, chunk_code: str, token: str, date_prefix: str,
+                    discontinuities: list = None) -> str:
+    """
+    紧凑二进制清单（urlsafe base64，无填充）：
+      版本(1 字节) | 分片数(varint) | 每片时长(varint，单位 0.1 秒) | chunk_code | token | 年月前缀
+    字符串均为 varint 长度前缀 + UTF-8。8 秒分片每片只占 1 字节，一小时视频约 450 字节
+    discontinuities 不为空时写版本 2，末尾追加：个数(varint) | 各不连续点分片序号与前一个的差值(varint)，
+    播放器在这些分片前插入 #EXT-X-DISCONTINUITY；没有不连续点时仍写版本 1，旧客户端不受影响
+    """
+    out = bytearray([MANIFEST_VERSION_DISCONTINUITY if discontinuities else MANIFEST_VERSION])
+    _write_varint(out, len(durations))
+    for duration in durations:
+        _write_varint(out, max(0, int(round(duration * 10))))
+    _write_str(out, chunk_code)
+    _write_str(out, token)
+    _write_str(out, date_prefix)
+    if discontinuities:
+        _write_varint(out, len(discontinuities))
+        previous = 0
+        for index in discontinuities:
+            _write_varint(out, index - previous)
+            previous = index
+    return base64.urlsafe_b64encode(bytes(out)).decode().rstrip("=")
+
+
+def decode_manifest(manifest: str) -> dict:
+    """ 解码 encode_manifest 的结果，返回与旧 media_code JSON 相同含义的字段 """
+    data = base64.urlsafe_b64decode(manifest + "=" * (-len(manifest) % 4))
+    if not data or data[0] not in (MANIFEST_VERSION, MANIFEST_VERSION_DISCONTINUITY):
+        raise ValueError(f"不支持的清单版本: {data[0] if data else None}")
+    count, pos = _read_varint(data, 1)
+    durations = []
+    for _ in range(count):
+        value, pos = _read_varint(data, pos)
+        durations.append(value / 10)
+    chunk_code, pos = _read_str(data, pos)
+    token, pos = _read_str(data, pos)
+    date_prefix, pos = _read_str(data, pos)
+    discontinuities = []
+    if data[0] == MANIFEST_VERSION_DISCONTINUITY:
+        total, pos = _read_varint(data, pos)
+        for _ in range(total):
+            delta, pos = _read_varint(data, pos)
+            discontinuities.append((discontinuities[-1] if discontinuities else 0) + delta)
+    return {"v": data[0], "s": durations, "c": count, "m": chunk_code, "e": token, "d": date_prefix,
+            "x": discontinuities}
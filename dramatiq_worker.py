@@ -1,6 +1,14 @@
 from app.dramatiq_setup import *  # 确保 worker 启动前加载配置
 from app.tasks.check_m3u8_handler import  check_m3u8 # 导入 actor 模块以注册 actor
 from app.tasks.process_convert_2_ts import  segment_video # 导入 actor 模块以注册 actor
+from app.tasks.chunked_transcode import  transcode_range, stitch_ranges # 导入 actor 模块以注册 actor
+from app.tasks.media_lifecycle import LifecycleSweeper
+from app.tasks.media_writer import media_writer
+
+# worker 启动后定期清理本机到期的中间文件（不运行 watchdog 的转码主机也需要）
+redis_broker.add_middleware(LifecycleSweeper())
+# worker 启动后批量写入已发布视频的帖子 / 视频信息（含上次退出时残留的待写入记录）
+redis_broker.add_middleware(media_writer)
 
 if __name__ == "__main__":
     import logging
@@ -0,0 +1,59 @@
+import hashlib
+import pytest
+from app.services import oss_upload
+
+
+class FakeCosClient:
+    """
+    内存版对象存储客户端，只实现 oss_upload 用到的接口
+    failures: {Key: [状态码, ...]}，对该 Key 的 put_object 依次抛出对应状态码的 CosServiceError
+    """
+
+    def __init__(self, error_cls):
+        self.error_cls = error_cls
+        self.objects = {}
+        self.failures = {}
+        self.puts = []
+        self.parts = {}
+        self.completed = []
+        self.presigned = []
+
+    def error(self, status: int):
+        return self.error_cls("PUT", {"code": str(status), "message": "fake", "resource": "", "requestid": "",
+                                      "traceid": ""}, status)
+
+    def head_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise self.error(404)
+        return {"ETag": f'"{self.objects[Key]}"', "Content-Length": "0"}
+
+    def put_object(self, Bucket, Body, Key):
+        self.puts.append(Key)
+        pending = self.failures.get(Key)
+        if pending:
+            raise self.error(pending.pop(0))
+        self.objects[Key] = hashlib.md5(Body.read()).hexdigest()
+
+    def get_presigned_url(self, Bucket, Key, Method, Expired, Params):
+        self.presigned.append((Key, Method, Params))
+        return f"https://fake/{Key}?partNumber={Params['partNumber']}&uploadId={Params['uploadId']}"
+
+    def list_parts(self, Bucket, Key, UploadId, MaxParts, PartNumberMarker):
+        numbers = sorted(n for n in self.parts if n > PartNumberMarker)
+        page = numbers[:MaxParts]
+        response = {"Part": [{"PartNumber": str(n), "ETag": self.parts[n]} for n in page]}
+        if len(numbers) > MaxParts:
+            response.update(IsTruncated="true", NextPartNumberMarker=str(page[-1]))
+        return response
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self.completed.append((Key, UploadId, MultipartUpload["Part"]))
+
+
+@pytest.fixture
+def fake_cos(monkeypatch):
+    client = FakeCosClient(oss_upload.CosServiceError)
+    monkeypatch.setattr(oss_upload, "cos_client", client)
+    # 退避等待不影响断言，测试中跳过
+    monkeypatch.setattr(oss_upload.time, "sleep", lambda seconds: None)
+    return client
@@ -0,0 +1,77 @@
+import asyncio
+from types import SimpleNamespace
+import pytest
+from app.api import upload_res as upload_res_module
+from app.services import oss_upload
+
+OBJECT_KEY = "/v1/raw/vods/2503/u4_25032921_30_0000.mp4"
+
+
+@pytest.fixture
+def upload_res(monkeypatch, fake_cos):
+    """ 直传完成接口：会话写入与转码投递替换为记录调用 """
+    module = upload_res_module
+    calls = {"sessions": [], "sent": []}
+    monkeypatch.setattr(module.upload_session, "update_session",
+                        lambda filename, **fields: calls["sessions"].append((filename, fields)))
+    monkeypatch.setattr(module, "segment_video",
+                        SimpleNamespace(send=lambda *args, **kwargs: calls["sent"].append((args, kwargs))))
+    monkeypatch.setattr(module, "log_event", lambda *args, **kwargs: None)
+    monkeypatch.setattr(module, "calls", calls, raising=False)
+    return module
+
+
+def direct_session(total_chunks: int, status: str = "uploading") -> dict:
+    return {"filename": "u4_25032921_30_0000.mp4", "user_id": 4, "storage": "cos", "object_key": OBJECT_KEY,
+            "upload_id": "upload-1", "total_chunks": total_chunks, "status": status}
+
+
+def test_presign_part_urls_sign_each_part(fake_cos):
+    urls = oss_upload.presign_part_urls(OBJECT_KEY, "upload-1", [1, 2, 3])
+    assert [u["part_number"] for u in urls] == [1, 2, 3]
+    assert [params for _, _, params in fake_cos.presigned] == [
+        {"partNumber": str(n), "uploadId": "upload-1"} for n in (1, 2, 3)
+    ]
+    assert all(method == "PUT" and key == OBJECT_KEY for key, method, _ in fake_cos.presigned)
+
+
+def test_list_uploaded_parts_follows_pagination(fake_cos):
+    fake_cos.parts = {n: f'"etag-{n}"' for n in range(1, 1501)}
+    parts = oss_upload.list_uploaded_parts(OBJECT_KEY, "upload-1")
+    assert len(parts) == 1500 and parts[1500] == '"etag-1500"'
+
+
+def test_choose_part_size_respects_part_limits():
+    assert oss_upload.choose_part_size(1024, 1024) == oss_upload.MULTIPART_MIN_PART_SIZE
+    huge = oss_upload.MULTIPART_MAX_PARTS * oss_upload.MULTIPART_MIN_PART_SIZE * 3
+    assert oss_upload.choose_part_size(huge, 0) * oss_upload.MULTIPART_MAX_PARTS >= huge
+
+
+def test_complete_rejects_missing_parts(upload_res, fake_cos):
+    fake_cos.parts = {1: '"a"', 2: '"b"', 5: '"e"'}
+    with pytest.raises(upload_res.HTTPException) as error:
+        asyncio.run(upload_res.complete_direct_video_upload(direct_session(6), SimpleNamespace(id=4)))
+    assert error.value.status_code == 409
+    assert error.value.detail["missing"] == [[2, 3], [5, 5]]
+    assert fake_cos.completed == [] and upload_res.calls["sent"] == []
+
+
+def test_complete_merges_parts_and_hands_off_to_transcode(upload_res, fake_cos):
+    fake_cos.parts = {2: '"b"', 1: '"a"', 3: '"c"'}
+    asyncio.run(upload_res.complete_direct_video_upload(direct_session(3), SimpleNamespace(id=4)))
+    assert fake_cos.completed == [(OBJECT_KEY, "upload-1", [
+        {"PartNumber": 1, "ETag": '"a"'}, {"PartNumber": 2, "ETag": '"b"'}, {"PartNumber": 3, "ETag": '"c"'},
+    ])]
+    assert upload_res.calls["sessions"] == [("u4_25032921_30_0000.mp4", {"status": "complete"})]
+    assert upload_res.calls["sent"] == [(("u4_25032921_30_0000.mp4",), {"source_key": OBJECT_KEY})]
+
+
+def test_complete_is_idempotent_once_merged(upload_res, fake_cos):
+    asyncio.run(upload_res.complete_direct_video_upload(direct_session(3, status="complete"), SimpleNamespace(id=4)))
+    assert fake_cos.completed == [] and upload_res.calls["sent"] == []
+
+
+def test_complete_rejects_other_users(upload_res, fake_cos):
+    with pytest.raises(upload_res.HTTPException) as error:
+        asyncio.run(upload_res.complete_direct_video_upload(direct_session(3), SimpleNamespace(id=5)))
+    assert error.value.status_code == 403
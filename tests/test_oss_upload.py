@@ -0,0 +1,73 @@
+import pytest
+from app.services import oss_upload
+
+
+@pytest.fixture
+def segment(tmp_path):
+    path = tmp_path / "segment_00000.ts"
+    path.write_bytes(b"\x47" * 188 * 10)
+    return str(path)
+
+
+def test_put_segment_uploads_missing_object(fake_cos, segment):
+    assert oss_upload.put_segment(segment, "/v1/vol/7/2503/a.mct") is True
+    assert fake_cos.puts == ["/v1/vol/7/2503/a.mct"]
+
+
+def test_put_segment_skips_matching_etag(fake_cos, segment):
+    fake_cos.objects["/v1/vol/7/2503/a.mct"] = oss_upload.file_md5(segment)
+    assert oss_upload.put_segment(segment, "/v1/vol/7/2503/a.mct") is False
+    assert fake_cos.puts == []
+
+
+def test_put_segment_replaces_mismatched_etag(fake_cos, segment):
+    fake_cos.objects["/v1/vol/7/2503/a.mct"] = "0" * 32
+    assert oss_upload.put_segment(segment, "/v1/vol/7/2503/a.mct") is True
+    assert fake_cos.objects["/v1/vol/7/2503/a.mct"] == oss_upload.file_md5(segment)
+
+
+@pytest.mark.parametrize("status", [500, 503, 429, 408])
+def test_put_segment_retries_transient_errors(fake_cos, segment, status):
+    fake_cos.failures["/v1/vol/7/2503/a.mct"] = [status, status]
+    assert oss_upload.put_segment(segment, "/v1/vol/7/2503/a.mct") is True
+    assert len(fake_cos.puts) == 3
+
+
+def test_put_segment_does_not_retry_client_errors(fake_cos, segment):
+    fake_cos.failures["/v1/vol/7/2503/a.mct"] = [403]
+    with pytest.raises(oss_upload.CosServiceError):
+        oss_upload.put_segment(segment, "/v1/vol/7/2503/a.mct")
+    assert len(fake_cos.puts) == 1
+
+
+def test_put_segment_gives_up_after_retries(fake_cos, segment, monkeypatch):
+    monkeypatch.setattr(oss_upload, "OSS_UPLOAD_RETRIES", 2)
+    fake_cos.failures["/v1/vol/7/2503/a.mct"] = [500] * 10
+    with pytest.raises(oss_upload.CosServiceError):
+        oss_upload.put_segment(segment, "/v1/vol/7/2503/a.mct")
+    assert len(fake_cos.puts) == 3
+
+
+def test_upload_segment_set_counts_uploaded_and_skipped(fake_cos, tmp_path):
+    files = []
+    for i in range(6):
+        path = tmp_path / f"segment_{i:05d}.ts"
+        path.write_bytes(bytes([i]) * 1024)
+        files.append((str(path), f"/v1/vol/7/2503/{i}.mct"))
+    fake_cos.objects[files[0][1]] = oss_upload.file_md5(files[0][0])
+    fake_cos.failures[files[1][1]] = [500]
+
+    assert oss_upload.upload_segment_set(files, workers=3) == {"uploaded": 5, "skipped": 1}
+    assert set(fake_cos.objects) == {key for _, key in files}
+
+
+def test_upload_segment_set_propagates_failure(fake_cos, tmp_path):
+    files = []
+    for i in range(4):
+        path = tmp_path / f"segment_{i:05d}.ts"
+        path.write_bytes(bytes([i]) * 1024)
+        files.append((str(path), f"/v1/vol/7/2503/{i}.mct"))
+    fake_cos.failures[files[2][1]] = [403]
+
+    with pytest.raises(oss_upload.CosServiceError):
+        oss_upload.upload_segment_set(files, workers=2)
@@ -1,12 +1,22 @@
 import os
 import time
 import logging
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 from app.tasks.check_m3u8_handler import check_m3u8
 from app.tasks.process_convert_2_ts import segment_video
-from qcloud_cos import CosConfig, CosS3Client
+from app.tasks import media_pipeline, media_lifecycle
+from app.services import upload_session
 from app.config import settings
+from app.db.redis_client import redis_client
+from app.services.oss_upload import rendition_object_key, put_segment
+from app.tasks.media_probe import RENDITION_LABELS
+from app.models.base import WorkerSessionLocal
+from app.models.post_model import PostVideo
+from sqlalchemy import select
 
 # 配置日志输出
 log_dir = os.path.join(os.path.dirname(__file__), "logs")
@@ -24,112 +34,260 @@ logging.basicConfig(
 
 logger = logging.getLogger("watchdog")
 
-# 腾讯云 OSS 配置（可改为读取 config.ini）
-SECRET_ID = settings.ACCESS_KEY_ID
-SECRET_KEY = settings.ACCESS_KEY_SECRET
-REGION = settings.JAPAN_REGION
-BUCKET = settings.JAPAN_BUCKET_NAME
-OSS_PREFIX = "/v1/vol/"
+# 各阶段处理线程数（上传 OSS 以网络 IO 为主，可以多开）
+WATCH_STAGE_WORKERS = {
+    "upload": getattr(settings, "WATCH_UPLOAD_WORKERS", 2),
+    "m3u8": getattr(settings, "WATCH_M3U8_WORKERS", 2),
+    "encrypted": getattr(settings, "WATCH_ENCRYPTED_WORKERS", 8),
+}
+# 队列深度 / 延迟报告间隔（秒）
+WATCH_REPORT_INTERVAL = getattr(settings, "WATCH_REPORT_INTERVAL", 60)
+# 补偿扫描间隔（秒），启动时先执行一次
+WATCH_RECONCILE_INTERVAL = getattr(settings, "WATCH_RECONCILE_INTERVAL", 600)
+# 补偿扫描投递节流：各阶段排队超过该数量时暂停投递；转码类文件每个之间的最小间隔（秒）
+WATCH_RECONCILE_MAX_QUEUE = getattr(settings, "WATCH_RECONCILE_MAX_QUEUE", 50)
+WATCH_RECONCILE_TRANSCODE_GAP = getattr(settings, "WATCH_RECONCILE_TRANSCODE_GAP", 5)
+
+def playlist_finished(file_path):
+    """ VOD 播放列表写完时末尾带 #EXT-X-ENDLIST（ffmpeg 转码过程中会多次改写播放列表） """
+    try:
+        with open(file_path, "r", encoding="utf-8") as f:
+            return "#EXT-X-ENDLIST" in f.read()
+    except OSError:
+        return False
+
+def upload_to_oss(file_path, base_path):
+    # 相对于监听目录的路径（用于构造 OSS 路径）；失败时抛出，由分发器记录且不写入台账
+    relative_path = os.path.relpath(file_path, base_path).replace("\\", "/")
+    label = os.path.basename(os.path.normpath(base_path))
+    key = rendition_object_key(label, relative_path)
+    logger.info(f"📤 上传文件到 OSS: {key}")
+    put_segment(file_path, key)
+    logger.info(f"✅ 上传完成: {key}")
+    media_lifecycle.schedule_delete([file_path])
 
-cos_config = CosConfig(Region=REGION, SecretId=SECRET_ID, SecretKey=SECRET_KEY)
-cos_client = CosS3Client(cos_config)
 
-def is_file_fully_written(file_path, wait_time=3, max_retries=5, check_interval=1):
+class WatchLedger:
     """
-    检查文件是否完全写入完成
-    :param file_path: 文件路径
-    :param wait_time: 初始等待时间（秒）
-    :param max_retries: 最大重试次数
-    :param check_interval: 检查间隔（秒）
-    :return: bool 是否写入完成
+    已处理文件台账（Redis Hash，按主机 + 阶段区分）：path -> "mtime:size"
+    监听器停机期间落地的文件没有实时事件，补偿扫描据此找出未处理或处理后又被改写的文件
     """
-    try:
-        # 1️⃣ 首先等待一段时间，让文件系统完成写入
-        time.sleep(wait_time)
-        
-        # 2️⃣ 检查文件是否存在
-        if not os.path.exists(file_path):
-            logger.warning(f"❌ 文件不存在: {file_path}")
-            return False
-            
-        # 3️⃣ 获取初始文件大小
-        size1 = os.path.getsize(file_path)
-        if size1 == 0:
-            logger.warning(f"⚠️ 文件大小为0: {file_path}")
-            return False
-            
-        # 4️⃣ 多次检查文件大小是否稳定
-        for i in range(max_retries):
-            time.sleep(check_interval)
-            size2 = os.path.getsize(file_path)
-            
-            # 如果文件大小相同，说明写入完成
-            if size1 == size2:
-                # 额外检查文件是否可访问
-                try:
-                    with open(file_path, 'rb') as f:
-                        f.seek(0, 2)  # 移动到文件末尾
-                    logger.info(f"✅ 文件写入完成: {file_path}, 大小: {size1} 字节")
-                    return True
-                except Exception as e:
-                    logger.warning(f"⚠️ 文件访问异常: {file_path}, 错误: {e}")
-                    continue
-                    
-            # 如果文件大小增加，更新size1继续检查
-            elif size2 > size1:
-                size1 = size2
-                logger.info(f"📈 文件仍在写入: {file_path}, 当前大小: {size2} 字节")
-            # 如果文件大小减小，说明可能有问题
-            else:
-                logger.warning(f"⚠️ 文件大小异常减小: {file_path}, 从 {size1} 变为 {size2}")
+
+    def __init__(self, host: str):
+        self.host = host
+
+    def key(self, stage: str) -> str:
+        return f"watch:ledger:{self.host}:{stage}"
+
+    @staticmethod
+    def signature(path: str):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return f"{int(st.st_mtime)}:{st.st_size}"
+
+    def mark(self, stage: str, path: str):
+        signature = self.signature(path)
+        if signature:
+            redis_client.hset(self.key(stage), path, signature)
+
+    def load(self, stage: str) -> dict:
+        return redis_client.hgetall(self.key(stage))
+
+    def forget(self, stage: str, paths):
+        if paths:
+            redis_client.hdel(self.key(stage), *paths)
+
+    def seeded(self, stage: str) -> bool:
+        return bool(redis_client.exists(f"{self.key(stage)}:seeded"))
+
+    def seed(self, stage: str, paths):
+        """ 首次部署：把磁盘上已有的文件直接记入台账而不投递（历史文件早已处理过，不能整库重新转码 / 加密） """
+        batch = {}
+        for path in paths:
+            signature = self.signature(path)
+            if signature:
+                batch[path] = signature
+            if len(batch) >= 1000:
+                redis_client.hset(self.key(stage), mapping=batch)
+                batch = {}
+        if batch:
+            redis_client.hset(self.key(stage), mapping=batch)
+        redis_client.set(f"{self.key(stage)}:seeded", int(time.time()))
+
+
+ledger = WatchLedger(socket.gethostname())
+
+
+
+class EventDispatcher:
+    """
+    事件分发器：observer 线程只负责投递，耗时的处理（查询会话 / 上传 OSS）在各阶段独立的有界线程池中执行，
+    一个慢文件不会阻塞其他事件。同一阶段同一路径尚未开始处理时，重复事件直接合并。
+    """
+
+    def __init__(self, limits: dict, ledger: WatchLedger = None):
+        self.ledger = ledger
+        self._pools = {stage: ThreadPoolExecutor(max_workers=n, thread_name_prefix=f"watch-{stage}")
+                       for stage, n in limits.items()}
+        self._pending = {}  # (stage, path) -> 入队时间
+        self._running = {stage: 0 for stage in limits}
+        self._done = {stage: 0 for stage in limits}
+        self._max_lag = {stage: 0.0 for stage in limits}
+        self._lock = threading.Lock()
+
+    def submit(self, stage: str, path: str, fn, *args) -> bool:
+        key = (stage, path)
+        with self._lock:
+            if key in self._pending:
                 return False
-                
-        logger.warning(f"⚠️ 文件写入超时: {file_path}, 最终大小: {size1} 字节")
-        return False
-        
-    except Exception as e:
-        logger.error(f"❌ 检查文件写入状态时出错: {file_path}, 错误: {e}")
-        return False
+            self._pending[key] = time.monotonic()
+        self._pools[stage].submit(self._run, key, fn, args)
+        return True
 
-def upload_to_oss(file_path, base_path):
+    def _run(self, key, fn, args):
+        stage = key[0]
+        with self._lock:
+            # 开始处理即出队：处理过程中再次发生的事件会重新入队
+            lag = time.monotonic() - self._pending.pop(key)
+            self._running[stage] += 1
+            self._max_lag[stage] = max(self._max_lag[stage], lag)
+        try:
+            # 返回 False 表示暂不处理（例如播放列表未写完），不记入台账
+            if fn(*args) is not False and self.ledger:
+                self.ledger.mark(stage, key[1])
+        except Exception as e:
+            logger.error(f"❌ [{stage}] 处理失败: {key[1]} -> {e}")
+        finally:
+            with self._lock:
+                self._running[stage] -= 1
+                self._done[stage] += 1
+
+    def depth(self, stage: str) -> int:
+        with self._lock:
+            return sum(1 for s, _ in self._pending if s == stage)
+
+    def report(self):
+        """ 输出各阶段队列深度、运行数、最早排队事件的等待时间，以及本周期处理量和最大延迟 """
+        now = time.monotonic()
+        with self._lock:
+            for stage in self._pools:
+                waits = [now - t for (s, _), t in self._pending.items() if s == stage]
+                logger.info(f"📊 [{stage}] 排队 {len(waits)}，运行中 {self._running[stage]}，"
+                            f"最早等待 {max(waits, default=0):.1f}s，"
+                            f"本周期完成 {self._done[stage]}，最大延迟 {self._max_lag[stage]:.1f}s")
+                self._done[stage] = 0
+                self._max_lag[stage] = 0.0
+
+    def shutdown(self):
+        for pool in self._pools.values():
+            pool.shutdown(wait=True)
+
+
+dispatcher = EventDispatcher(WATCH_STAGE_WORKERS, ledger)
+
+
+def video_recorded(post_id) -> bool:
+    """ 帖子是否已有视频记录（流水线上线前处理完成的历史视频没有流水线记录） """
+    db = WorkerSessionLocal()
     try:
-        # 相对于监听目录的路径（用于构造 OSS 路径）
-        relative_path = os.path.relpath(file_path, base_path).replace("\\", "/")
-        subdir = "7" if "720p" in base_path else "10"
-        key = f"{OSS_PREFIX}{subdir}/{relative_path}"
-        logger.info(f"📤 上传文件到 OSS: {key}")
-        cos_client.upload_file(
-            Bucket=BUCKET,
-            LocalFilePath=file_path,
-            Key=key
-        )
-        logger.info(f"✅ 上传完成: {key}")
-    except Exception as e:
-        logger.error(f"❌ 上传失败: {file_path} -> {e}")
+        return db.execute(select(PostVideo.id).where(PostVideo.post_id == post_id)).first() is not None
+    finally:
+        db.close()
+
+
+def dispatch_upload(file_path):
+    # 经由上传接口写入的文件：未完成时忽略，完成时接口已投递
+    if upload_session.get_session(os.path.basename(file_path)):
+        return
+    post_id = media_pipeline.post_id_of(file_path)
+    if post_id and (media_pipeline.get_pipeline(post_id) or video_recorded(post_id)):
+        return
+    logger.info(f"📥 检测到新上传文件，开始处理: {file_path}")
+    segment_video.send(file_path)
+
+
+def dispatch_m3u8(file_path):
+    if not playlist_finished(file_path): return False
+    logger.info(f"🎬 M3U8 写入完成，发送任务: {file_path}")
+    check_m3u8.send(file_path)
+
+
+def submit(stage, path, base_dir=None):
+    """ 实时事件与补偿扫描共用的投递入口 """
+    if stage == "upload":
+        return dispatcher.submit(stage, path, dispatch_upload, path)
+    if stage == "m3u8":
+        return path.endswith(".m3u8") and dispatcher.submit(stage, path, dispatch_m3u8, path)
+    return dispatcher.submit(stage, path, upload_to_oss, path, base_dir)
+
 
+def reconcile(trees):
+    """
+    补偿扫描：遍历 [(阶段, 监听目录), ...]，台账中没有或 mtime/size 已变化的文件批量投递到分发器；
+    排队过多时暂停投递，转码类文件之间保持间隔，避免故障恢复后瞬间压垮转码进程。
+    台账中已不存在于磁盘的路径一并清理。
+    某阶段第一次扫描（台账尚未初始化）时只把现有文件记入台账，不投递。
+    """
+    started = time.monotonic()
+    total = 0
+    for stage in {stage for stage, _ in trees}:
+        if not ledger.seeded(stage):
+            paths = [os.path.join(root, file) for tree_stage, base_dir in trees if tree_stage == stage
+                     for root, _, files in os.walk(base_dir) for file in files]
+            ledger.seed(stage, paths)
+            logger.info(f"📒 [{stage}] 首次补偿扫描：{len(paths)} 个已有文件记入台账，不投递")
+            continue
+        known = ledger.load(stage)
+        seen = set()
+        for tree_stage, base_dir in trees:
+            if tree_stage != stage:
+                continue
+            for root, dirs, files in os.walk(base_dir):
+                for file in files:
+                    path = os.path.join(root, file)
+                    seen.add(path)
+                    if known.get(path) == WatchLedger.signature(path):
+                        continue
+                    while dispatcher.depth(stage) >= WATCH_RECONCILE_MAX_QUEUE:
+                        time.sleep(1)
+                    if submit(stage, path, base_dir):
+                        total += 1
+                        if stage == "upload":
+                            time.sleep(WATCH_RECONCILE_TRANSCODE_GAP)
+        ledger.forget(stage, [path for path in known if path not in seen])
+    logger.info(f"🔁 补偿扫描完成：投递 {total} 个遗漏文件，耗时 {time.monotonic() - started:.1f}s")
+
+
+def run_reconcile(trees):
+    try:
+        reconcile(trees)
+    except Exception as e:
+        logger.error(f"❌ 补偿扫描失败: {e}")
 
 
 class UploadEventHandler(FileSystemEventHandler):
-    def on_created(self, event):
+    """
+    兜底：上传完成接口已直接投递 segment_video，这里只处理绕过上传接口写入目录的文件
+    写完关闭（IN_CLOSE_WRITE）或 rename 进入目录时触发，不再轮询文件大小
+    """
+    def on_closed(self, event):
         if event.is_directory: return
-        file_path = event.src_path
-        logger.info(f"📥 检测到新上传文件: {file_path}")
-        while not is_file_fully_written(file_path):
-            logger.info(f"⏳ 等待上传文件写入完成: {file_path}")
-            time.sleep(1)
-        logger.info(f"✅ 上传文件写入完成，开始处理: {file_path}")
-        segment_video.send(file_path)
+        submit("upload", event.src_path)
+
+    def on_moved(self, event):
+        if event.is_directory: return
+        submit("upload", event.dest_path)
 
 class M3U8EventHandler(FileSystemEventHandler):
-    def on_created(self, event):
-        if event.is_directory or not event.src_path.endswith(".m3u8"): return
-        file_path = event.src_path
-        logger.info(f"🎬 新增 M3U8 文件: {file_path}")
-        while not is_file_fully_written(file_path):
-            logger.info(f"⏳ 等待 M3U8 写入完成: {file_path}")
-            time.sleep(1)
-        logger.info(f"✅ M3U8 写入完成，发送任务: {file_path}")
-        check_m3u8.send(file_path)
+    def on_closed(self, event):
+        if event.is_directory: return
+        submit("m3u8", event.src_path)
+
+    def on_moved(self, event):
+        if event.is_directory: return
+        submit("m3u8", event.dest_path)
 
 class EncryptedFileEventHandler(FileSystemEventHandler):
     def __init__(self, base_dir):
@@ -137,21 +295,22 @@ class EncryptedFileEventHandler(FileSystemEventHandler):
 
     def on_created(self, event):
         if event.is_directory:
-            # 是新目录，递归处理里面已有的文件
+            # 是新目录，递归处理里面已有的文件（监听建立前已写完），同样投递到线程池
             for root, dirs, files in os.walk(event.src_path):
                 for file in files:
-                    file_path = os.path.join(root, file)
-                    self.process_file(file_path)
-        else:
-            self.process_file(event.src_path)
+                    self.process_file(os.path.join(root, file))
+
+    def on_closed(self, event):
+        if event.is_directory: return
+        self.process_file(event.src_path)
+
+    def on_moved(self, event):
+        # 原子 rename 进入目录的文件内容已完整
+        if event.is_directory: return
+        self.process_file(event.dest_path)
 
     def process_file(self, file_path):
-        logger.info(f"🛡️ 新加密文件: {file_path}")
-        while not is_file_fully_written(file_path):
-            logger.info(f"⏳ 等待加密文件写入完成: {file_path}")
-            time.sleep(1)
-        logger.info(f"✅ 加密文件写入完成，准备上传 OSS: {file_path}")
-        upload_to_oss(file_path, self.base_dir)
+        submit("encrypted", file_path, self.base_dir)
 
 
 if __name__ == "__main__":
@@ -167,13 +326,13 @@ if __name__ == "__main__":
     # M3U8 输出目录
     m3u8_dirs = [
         os.path.join(BASE_DIR, "MbtiCompass", "app", "static", "convert", "vods", sub)
-        for sub in ["720p", "1080p"]
+        for sub in RENDITION_LABELS
     ]
 
     # 加密后输出目录
     encrypted_dirs = [
         os.path.join(BASE_DIR, "MbtiCompass", "app", "static", "encryption", "vods", sub)
-        for sub in ["720p", "1080p"]
+        for sub in RENDITION_LABELS
     ]
 
     observer = Observer()
@@ -195,13 +354,35 @@ if __name__ == "__main__":
         observer.schedule(EncryptedFileEventHandler(base_dir=d), path=d, recursive=True)
 
     observer.start()
+
+    # 启动后立即补偿一次停机期间遗漏的文件，之后定期扫描（上一轮未结束时跳过）
+    trees = ([("upload", d) for d in upload_dirs] + [("m3u8", d) for d in m3u8_dirs]
+             + [("encrypted", d) for d in encrypted_dirs])
+    reconciler = None
+    last_report = last_reconcile = last_sweep = time.monotonic()
     try:
         while True:
+            if reconciler is None or (not reconciler.is_alive()
+                                      and time.monotonic() - last_reconcile >= WATCH_RECONCILE_INTERVAL):
+                reconciler = threading.Thread(target=run_reconcile, args=(trees,), name="watch-reconcile", daemon=True)
+                reconciler.start()
+                last_reconcile = time.monotonic()
             time.sleep(1)
+            if time.monotonic() - last_report >= WATCH_REPORT_INTERVAL:
+                dispatcher.report()
+                last_report = time.monotonic()
+            # 本机中间文件到期清理（待清理队列按主机区分，与本机 worker 进程的清理线程共用一把锁）
+            if time.monotonic() - last_sweep >= media_lifecycle.MEDIA_SWEEP_INTERVAL:
+                try:
+                    media_lifecycle.sweep_if_due()
+                except Exception as e:
+                    logger.error(f"❌ 中间文件清理失败: {e}")
+                last_sweep = time.monotonic()
     except KeyboardInterrupt:
         logger.warning("🛑 中止监听，退出中...")
         observer.stop()
     observer.join()
+    dispatcher.shutdown()
 
 '''
 # 示例：按时间切片，每 10 秒一片